@@ -0,0 +1,194 @@
+"""Ad hoc benchmarks for the API hot paths.
+
+Run from the api folder (benchmarks hitting the database need the AWS_RDS_* environmental variables set):
+    python benchmarks.py forecast_concurrency energy_balance
+    BENCHMARK_VRT=/vsis3/bucket/run.vrt python benchmarks.py raster_loader
+"""
+import asyncio
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+import connection_pool
+import data_management
+import numpy as np
+import predictions
+import shovel_time
+
+# Rough bounding box of southern Canada where most of the traffic lands.
+LATITUDE_RANGE = (43.0, 53.0)
+LONGITUDE_RANGE = (-123.0, -63.0)
+
+
+def random_coordinates(count: int, seed: int = 0) -> list[tuple[float, float]]:
+    """Returns a reproducible list of (latitude, longitude) pairs."""
+    rng = random.Random(seed)
+    return [
+        (rng.uniform(*LATITUDE_RANGE), rng.uniform(*LONGITUDE_RANGE))
+        for _ in range(count)
+    ]
+
+
+def report(name: str, request_count: int, elapsed: float) -> dict[str, Any]:
+    results = {
+        "benchmark": name,
+        "count": request_count,
+        "seconds": round(elapsed, 3),
+        "per second": round(request_count / elapsed, 1),
+    }
+    print(results)
+    return results
+
+
+def benchmark_forecast_concurrency(
+    conn_details: dict[str, str], request_count: int = 500, concurrency: int = 200
+) -> list[dict[str, Any]]:
+    """Compares forecast lookup throughput of the sync path, limited by the 40 thread
+    starlette threadpool, with the async path running `concurrency` lookups at once.
+    Each path gets a pool as large as the number of lookups it can have in flight."""
+    coordinates = random_coordinates(request_count)
+    settings = connection_pool.pool_settings_from_env()
+
+    connection_pool.open_pool(conn_details, {**settings, "max_size": 40})
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=40) as executor:
+        list(
+            executor.map(
+                lambda coords: predictions.get_predictions_as_dfs(
+                    conn_details, *coords
+                ),
+                coordinates,
+            )
+        )
+    sync_results = report("sync", request_count, time.perf_counter() - start)
+    connection_pool.close_pool()
+
+    async def run_async() -> float:
+        await connection_pool.open_async_pool(
+            conn_details, {**settings, "max_size": concurrency}
+        )
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def lookup(latitude: float, longitude: float):
+            async with semaphore:
+                return await predictions.get_predictions_as_dfs_async(
+                    conn_details, latitude, longitude
+                )
+
+        start = time.perf_counter()
+        await asyncio.gather(*(lookup(*coords) for coords in coordinates))
+        elapsed = time.perf_counter() - start
+        await connection_pool.close_async_pool()
+        return elapsed
+
+    async_results = report("async", request_count, asyncio.run(run_async()))
+    return [sync_results, async_results]
+
+
+def energy_balance_loop(
+    snow_latent_heat_equivalent: list[float],
+    interval_heat_transfer_potential: list[float],
+) -> list[float]:
+    """Per row energy balance as originally implemented in format_predictions."""
+    energy_balance: list[float] = []
+    for latent, potential in zip(
+        snow_latent_heat_equivalent, interval_heat_transfer_potential
+    ):
+        incremental_latent_energy = latent + min(potential, 0)
+        if not energy_balance:
+            energy_balance.append(max(incremental_latent_energy, 0))
+            continue
+        energy_balance.append(max(energy_balance[-1] + incremental_latent_energy, 0))
+    return energy_balance
+
+
+def benchmark_energy_balance(
+    points: int = 5000, hours: int = 48
+) -> list[dict[str, Any]]:
+    """Compares the per row energy balance loop with the vectorized shovel_time kernel scoring all points in one call."""
+    rng = np.random.default_rng(0)
+    snowfall = np.where(
+        rng.random((points, hours)) < 0.6, 0, rng.gamma(1, 3, (points, hours))
+    )
+    temperature = rng.normal(-3, 5, (points, hours))
+    fields = shovel_time.shovel_time_fields(snowfall, temperature)
+
+    start = time.perf_counter()
+    looped = [
+        energy_balance_loop(latent, potential)
+        for latent, potential in zip(
+            fields["snow_latent_heat_equivalent"].tolist(),
+            fields["interval_heat_transfer_potential"].tolist(),
+        )
+    ]
+    loop_results = report("energy balance loop", points, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    vectorized = shovel_time.clipped_cumulative_sum(
+        fields["snow_latent_heat_equivalent"]
+        + np.minimum(fields["interval_heat_transfer_potential"], 0)
+    )
+    kernel_results = report(
+        "energy balance kernel", points, time.perf_counter() - start
+    )
+
+    assert np.array_equal(np.array(looped), vectorized)
+    return [loop_results, kernel_results]
+
+
+def benchmark_raster_loader(
+    conn_details: dict[str, str], vrt_path: str
+) -> list[dict[str, Any]]:
+    """Compares loading a VRT with the raster2pgsql | psql chain and with the in process binary COPY loader.
+    Both load into a scratch table which is dropped afterwards. Counts are the tiles loaded."""
+    connection_pool.open_pool(conn_details)
+    with connection_pool.connection(conn_details) as conn:
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS public.benchmark_predictions (
+                rid serial PRIMARY KEY,
+                raster raster NOT NULL,
+                filename text NOT NULL
+            )"""
+        )
+
+    def load(name: str, loader: Callable) -> dict[str, Any]:
+        with connection_pool.connection(conn_details) as conn:
+            conn.execute("TRUNCATE public.benchmark_predictions")
+        start = time.perf_counter()
+        loaded = loader(
+            vrt_path, "public", "benchmark_predictions", conn_details, "990001"
+        )
+        elapsed = time.perf_counter() - start
+        assert isinstance(loaded, str), loaded
+        with connection_pool.connection(conn_details) as conn:
+            tiles = conn.execute(
+                "SELECT count(*) FROM public.benchmark_predictions"
+            ).fetchone()[0]
+        return report(name, tiles, elapsed)
+
+    results = [
+        load("raster2pgsql", data_management.raster2pgsql_to_postgis),
+        load("binary copy", data_management.copy_to_postgis),
+    ]
+    with connection_pool.connection(conn_details) as conn:
+        conn.execute("DROP TABLE public.benchmark_predictions")
+    connection_pool.close_pool()
+    return results
+
+
+BENCHMARKS: dict[str, Callable] = {
+    "forecast_concurrency": lambda: benchmark_forecast_concurrency(
+        connection_pool.pg_connection_dict_from_env()
+    ),
+    "energy_balance": benchmark_energy_balance,
+    "raster_loader": lambda: benchmark_raster_loader(
+        connection_pool.pg_connection_dict_from_env(), os.environ["BENCHMARK_VRT"]
+    ),
+}
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS.keys():
+        BENCHMARKS[name]()
@@ -0,0 +1,135 @@
+import os
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Iterator, Optional
+
+import psycopg
+from psycopg_pool import AsyncConnectionPool, ConnectionPool
+
+# Process wide pools. Created by open_pool() / open_async_pool() when the API starts up.
+_pool: Optional[ConnectionPool] = None
+_async_pool: Optional[AsyncConnectionPool] = None
+
+
+def pg_connection_dict_from_env() -> dict[str, str]:
+    """Connection details of the PostGIS database, for the scripts run outside of the API."""
+    return {
+        "dbname": os.environ["AWS_RDS_DB"],
+        "user": os.environ["AWS_RDS_USER"],
+        "password": os.environ["AWS_RDS_PASSWORD"],
+        "port": os.environ["AWS_RDS_PORT"],
+        "host": os.environ["AWS_RDS_HOST"],
+    }
+
+
+def pool_settings_from_env() -> dict[str, Any]:
+    """Returns the pool sizing and lifetime settings read from the environmental variables."""
+    return {
+        "min_size": int(os.environ.get("DB_POOL_MIN_SIZE", 2)),
+        "max_size": int(os.environ.get("DB_POOL_MAX_SIZE", 10)),
+        "timeout": float(os.environ.get("DB_POOL_TIMEOUT", 30)),  # seconds
+        "max_lifetime": float(os.environ.get("DB_POOL_MAX_LIFETIME", 30 * 60)),
+        "max_idle": float(os.environ.get("DB_POOL_MAX_IDLE", 10 * 60)),
+    }
+
+
+def open_pool(
+    conn_details: dict[str, str], settings: Optional[dict[str, Any]] = None
+) -> ConnectionPool:
+    """Create the process wide connection pool.
+    Connections are health checked when handed out and recycled after max_lifetime seconds.
+
+    Calling it again while a pool is open returns the existing pool."""
+    global _pool
+    if _pool is not None:
+        return _pool
+
+    settings = settings or pool_settings_from_env()
+    _pool = ConnectionPool(
+        kwargs={**conn_details, "autocommit": True},
+        check=ConnectionPool.check_connection,
+        name="postgis",
+        open=True,
+        **settings,
+    )
+    print("Connection pool opened:", settings)
+    return _pool
+
+
+def close_pool() -> None:
+    """Close the process wide connection pool, waiting for connections in use to be returned."""
+    global _pool
+    if _pool is None:
+        return
+    _pool.close()
+    _pool = None
+    print("Connection pool closed.")
+
+
+async def open_async_pool(
+    conn_details: dict[str, str], settings: Optional[dict[str, Any]] = None
+) -> AsyncConnectionPool:
+    """Create the process wide asyncio connection pool used by the async request handlers.
+    Same settings and health checks as open_pool().
+
+    Calling it again while a pool is open returns the existing pool."""
+    global _async_pool
+    if _async_pool is not None:
+        return _async_pool
+
+    settings = settings or pool_settings_from_env()
+    _async_pool = AsyncConnectionPool(
+        kwargs={**conn_details, "autocommit": True},
+        check=AsyncConnectionPool.check_connection,
+        name="postgis-async",
+        open=False,
+        **settings,
+    )
+    await _async_pool.open()
+    print("Async connection pool opened:", settings)
+    return _async_pool
+
+
+async def close_async_pool() -> None:
+    """Close the process wide asyncio connection pool."""
+    global _async_pool
+    if _async_pool is None:
+        return
+    await _async_pool.close()
+    _async_pool = None
+    print("Async connection pool closed.")
+
+
+@contextmanager
+def connection(conn_details: dict[str, str]) -> Iterator[psycopg.Connection]:
+    """Yields an autocommit connection.
+    Borrowed from the pool when it is open, otherwise a dedicated connection is made using conn_details (scripts, notebooks)."""
+    if _pool is None:
+        with psycopg.connect(**conn_details, autocommit=True) as conn:
+            yield conn
+        return
+
+    with _pool.connection() as conn:
+        yield conn
+
+
+@asynccontextmanager
+async def async_connection(
+    conn_details: dict[str, str]
+) -> AsyncIterator[psycopg.AsyncConnection]:
+    """Async version of connection()."""
+    if _async_pool is None:
+        async with await psycopg.AsyncConnection.connect(
+            **conn_details, autocommit=True
+        ) as conn:
+            yield conn
+        return
+
+    async with _async_pool.connection() as conn:
+        yield conn
+
+
+def pool_stats() -> dict[str, Any]:
+    """Returns the size and wait metrics of each open pool."""
+    return {
+        pool.name: pool.get_stats() for pool in (_pool, _async_pool) if pool is not None
+    }
@@ -1,52 +1,150 @@
+import hashlib
+import json
+import multiprocessing
 import os
+import shutil
+import struct
 import subprocess
+import threading
+import time
+import uuid
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from contextlib import contextmanager, nullcontext
 from datetime import datetime, timedelta, timezone
 from fileinput import filename
-from io import BytesIO
 from tempfile import NamedTemporaryFile, TemporaryDirectory
-from typing import Any
+from typing import Any, Iterable, Iterator, Optional
 
 import boto3
+import connection_pool
+import grib_cache
+import local_store
+import numpy as np
 import pandas as pd
+import pipeline
 import psycopg
+import raster_loader
+import refresh_jobs
 import requests
-from predictions import execute_sql_as_dataframe
+import shovel_time
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import BotoCoreError, ClientError
+from predictions import SHOVEL_TIME_INPUTS, execute_sql_as_dataframe
 from psycopg import sql
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# Datamart serving the forecasts, overridable to point at a mirror or a local test server.
+DATAMART_DOMAIN = os.environ.get("DATAMART_DOMAIN", "https://hpfx.collab.science.gc.ca")
+# Folder of the HRDPS continental GRIB files in each day of the datamart
+HRDPS_URL_PATH = "WXO-DD/model_hrdps/continental/2.5km/grib2"
+PROBE_TIMEOUT = float(os.environ.get("PROBE_TIMEOUT", 10))
+# Model runs are every 6 hours, the latest run found stays the latest until the next one is due.
+# While the run of the current block is not published yet it is looked for again after LATEST_FORECAST_RETRY_SECONDS.
+MODEL_RUN_HOURS = 6
+LATEST_FORECAST_RETRY_SECONDS = float(
+    os.environ.get("LATEST_FORECAST_RETRY_SECONDS", 300)
+)
+_latest_forecasts: dict[tuple, tuple[dict[str, str], datetime]] = {}
+
+
+def next_model_run(current_date: datetime) -> datetime:
+    """Start of the next 6 hour model run block after current_date."""
+    block_start = current_date.replace(
+        hour=current_date.hour - current_date.hour % MODEL_RUN_HOURS,
+        minute=0,
+        second=0,
+        microsecond=0,
+    )
+    return block_start + timedelta(hours=MODEL_RUN_HOURS)
 
 
 def find_latest_forecast(
     forecast_hour: int,
-    url_path: str = "WXO-DD/model_hrdps/continental/2.5km/grib2",
-    domain: str = "https://hpfx.collab.science.gc.ca",
+    url_path: str = HRDPS_URL_PATH,
+    domain: str = DATAMART_DOMAIN,
 ) -> dict[str, str]:
     """Find the latest model run.
     Starting at the current date working backwards 5 days, for each day and for each forecasts [18, 12, 06, 00] a HEAD request is sent to the forecast_hour.
-    First 200 OK response is returned."""
+    The requests are sent concurrently, the newest run answering 200 OK is returned.
+    The result is kept until the next model run is due when it is the run of the current 6 hour block,
+    for LATEST_FORECAST_RETRY_SECONDS otherwise as the run of the block may be published any time."""
     current_date = datetime.now(timezone.utc)
+    memo_key = (forecast_hour, url_path, domain)
+    memo = _latest_forecasts.get(memo_key)
+    if memo is not None and current_date < memo[1]:
+        return memo[0]
 
     # url parameters
     forecasts = [f"{i:02}" for i in range(0, 24, 6)][::-1]
     dates = [(current_date - timedelta(days=i)).strftime("%Y%m%d") for i in range(5)]
+    candidates = [
+        {
+            "baseurl": f"{domain.strip('/')}/{date}/{url_path.strip('/')}/{forecast}/",
+            "date": date,
+            "forecast": forecast,
+        }
+        for date in dates
+        for forecast in forecasts
+        # runs later than now cannot have been published yet
+        if datetime.strptime(f"{date}{forecast} +0000", "%Y%m%d%H %z") <= current_date
+    ]
 
-    for date in dates:
-        for forecast in forecasts:
-            baseurl = f"{domain.strip('/')}/{date}/{url_path.strip('/')}/{forecast}/"
-            request_url = f"{baseurl}{forecast_hour:03}/"
-            res = requests.head(request_url)
-            if res.status_code == 200:
-                print(
-                    "Latest forecast is:",
-                    baseurl,
-                    "date:",
-                    date,
-                    "forecast hour:",
-                    forecast,
-                )
-                return {"baseurl": baseurl, "date": date, "forecast": forecast}
-            # else:
-            # print("Status code:", res.status_code, request_url)
-
-    return {"baseurl": "", "date": "", "forecast": ""}
+    def probe(candidate: dict[str, str]) -> bool:
+        try:
+            res = session.head(
+                f"""{candidate["baseurl"]}{forecast_hour:03}/""", timeout=PROBE_TIMEOUT
+            )
+        except requests.RequestException as e:
+            print("Error:", candidate["baseurl"], e)
+            return False
+        return res.status_code == 200
+
+    latest = {"baseurl": "", "date": "", "forecast": ""}
+    session = http_session(pool_size=len(candidates), retries=1)
+    executor = ThreadPoolExecutor(max_workers=len(candidates))
+    futures = [executor.submit(probe, candidate) for candidate in candidates]
+    # newest first, the first hit makes the older candidates irrelevant
+    for candidate, future in zip(candidates, futures):
+        if future.result():
+            latest = candidate
+            break
+    # probes still in flight finish in the background, the session is closed once they are done
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    def close_session() -> None:
+        # cancelled probes never complete
+        wait([future for future in futures if not future.cancelled()])
+        session.close()
+
+    threading.Thread(target=close_session, name="probe-session", daemon=True).start()
+
+    if latest["baseurl"]:
+        print(
+            "Latest forecast is:",
+            latest["baseurl"],
+            "date:",
+            latest["date"],
+            "forecast hour:",
+            latest["forecast"],
+        )
+        block_start = next_model_run(current_date) - timedelta(hours=MODEL_RUN_HOURS)
+        latest_start = datetime.strptime(
+            f"""{latest["date"]}{latest["forecast"]} +0000""", "%Y%m%d%H %z"
+        )
+        _latest_forecasts[memo_key] = (
+            latest,
+            next_model_run(current_date)
+            if latest_start == block_start
+            else current_date + timedelta(seconds=LATEST_FORECAST_RETRY_SECONDS),
+        )
+    return latest
 
 
 def create_urls_polar_stereo(
@@ -104,118 +202,381 @@ def create_urls_rotated_lat_lon(
     return urls
 
 
+# raster2pgsql to load with the raster2pgsql | psql chain, anything else for the in process loader.
+RASTER_LOADER = os.environ.get("RASTER_LOADER", "copy")
+
+# Variables of the HRDPS rotated lat-lon grid refreshed by the API and the subscriber.
+ROTATED_LAT_LON_VARIABLES = [
+    {"variable": "TMP", "level_type": "Sfc", "level": ""},  # Temperature
+    {
+        "variable": "CONDASNOW",
+        "level_type": "Sfc",
+        "level": "",
+    },  # Conditional amount of snow
+    # {"variable": "CSNOW", "level_type": "Sfc", "level": ""}, # Probability of snow
+]
+
+# Bounded concurrency of the downloader, each worker streams one file at a time.
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", 16))
+DOWNLOAD_RETRIES = int(os.environ.get("DOWNLOAD_RETRIES", 3))
+DOWNLOAD_TIMEOUT = float(os.environ.get("DOWNLOAD_TIMEOUT", 60))
+# Response headers of the datamart stored as metadata of the bucket objects, to tell whether a file changed since it was uploaded.
+SOURCE_VALIDATORS = {
+    "ETag": "source-etag",
+    "Last-Modified": "source-last-modified",
+    "Content-Length": "source-length",
+}
+# delete_objects takes at most 1000 keys per request.
+DELETE_BATCH_SIZE = 1000
+DELETE_WORKERS = int(os.environ.get("DELETE_WORKERS", 8))
+# Parts are buffered in memory while uploading: at most max_concurrency * multipart_chunksize per file.
+UPLOAD_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=2,
+)
+
+
+def http_session(
+    pool_size: int = DOWNLOAD_WORKERS, retries: int = DOWNLOAD_RETRIES
+) -> requests.Session:
+    """Session reusing connections to the datamart, retrying failed requests with exponential backoff."""
+    retry = Retry(
+        total=retries,
+        backoff_factor=1,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["HEAD", "GET"],
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class HashingReader:
+    """File like wrapper counting and hashing the bytes read through it, and copying them to sink when given."""
+
+    def __init__(self, raw, sink=None):
+        self.raw = raw
+        self.sink = sink
+        self.size = 0
+        self.md5 = hashlib.md5()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.raw.read(size)
+        self.size += len(data)
+        self.md5.update(data)
+        if self.sink is not None:
+            self.sink.write(data)
+        return data
+
+
+def source_validators(s3_client, aws_bucket: str, key: str) -> dict[str, Any] | None:
+    """Datamart validators recorded on the bucket object by stream_to_bucket, with the object size.
+    None when the object does not exist, was uploaded without them or its size is not the recorded
+    source-length, the object can then not be trusted to be the datamart file."""
+    try:
+        head = s3_client.head_object(Bucket=aws_bucket, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+    metadata = head.get("Metadata", {})
+    if not (metadata.get("source-etag") or metadata.get("source-last-modified")):
+        return None
+    if metadata.get("source-length") != str(head["ContentLength"]):
+        return None
+    return {**metadata, "size": head["ContentLength"]}
+
+
+def conditional_headers(validators: dict[str, Any] | None) -> dict[str, str]:
+    """Headers making the GET conditional on the validators of the bucket object."""
+    headers = {}
+    if validators is not None:
+        if validators.get("source-etag"):
+            headers["If-None-Match"] = validators["source-etag"]
+        if validators.get("source-last-modified"):
+            headers["If-Modified-Since"] = validators["source-last-modified"]
+    return headers
+
+
+def is_unchanged(res: requests.Response, validators: dict[str, Any] | None) -> bool:
+    """True when the datamart file is the one already in the bucket: the conditional GET was
+    answered 304, or the response carries the validators recorded on the object."""
+    if validators is None:
+        return False
+    if res.status_code == 304:
+        return True
+    return all(
+        res.headers.get(header) == validators.get(name)
+        for header, name in SOURCE_VALIDATORS.items()
+        if validators.get(name)
+    )
+
+
+def stream_to_bucket(
+    session: requests.Session,
+    s3_client,
+    url: str,
+    aws_bucket: str,
+    key: str,
+    retries: int = DOWNLOAD_RETRIES,
+) -> dict[str, Any]:
+    """Streams the url into the bucket with a multipart upload, without holding the file in memory.
+    The bytes are also written to the GRIB cache (see grib_cache.py) so later stages read them locally.
+    Failures while streaming restart the file after an exponential backoff.
+
+    The datamart's ETag, Last-Modified and Content-Length are stored as metadata of the object, and
+    the GET is made conditional on them when the object has the size recorded: a file unchanged since
+    it was uploaded is skipped without transferring its body. Only the body of a 200 is uploaded.
+
+    Returns the manifest entry of the object: key, size and md5 of the bytes uploaded,
+    and whether they were transferred. Skipped files have no md5."""
+    cache = grib_cache.cache
+    attempt = 0
+    while True:
+        staged = cache.staging_path() if cache is not None else None
+        try:
+            validators = source_validators(s3_client, aws_bucket, key)
+            res = session.get(
+                url,
+                stream=True,
+                timeout=DOWNLOAD_TIMEOUT,
+                headers=conditional_headers(validators),
+            )
+            if res.status_code == 304 and not is_unchanged(res, validators):
+                # not validated against the bucket object, the file is downloaded again
+                res.close()
+                res = session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT)
+
+            with res:
+                res.raise_for_status()
+                if is_unchanged(res, validators):
+                    return {
+                        "Key": key,
+                        "Size": validators["size"],
+                        "md5": None,
+                        "url": url,
+                        "transferred": False,
+                    }
+                if res.status_code != 200:
+                    # only the body of a complete response is the file
+                    raise requests.HTTPError(
+                        f"Unexpected status {res.status_code} for url: {url}",
+                        response=res,
+                    )
+                metadata = {
+                    name: res.headers[header]
+                    for header, name in SOURCE_VALIDATORS.items()
+                    if header in res.headers
+                }
+                res.raw.decode_content = True
+                with open(staged, "wb") if staged else nullcontext() as sink:
+                    reader = HashingReader(res.raw, sink)
+                    s3_client.upload_fileobj(
+                        reader,
+                        aws_bucket,
+                        key,
+                        ExtraArgs={"Metadata": metadata},
+                        Config=UPLOAD_CONFIG,
+                    )
+            if cache is not None:
+                cache.admit(staged, cache.object_path(aws_bucket, key))
+            return {
+                "Key": key,
+                "Size": reader.size,
+                "md5": reader.md5.hexdigest(),
+                "url": url,
+                "transferred": True,
+            }
+        except requests.HTTPError:
+            # status codes worth retrying were already retried by the session
+            raise
+        except (requests.RequestException, BotoCoreError, ClientError) as e:
+            if attempt == retries:
+                raise
+            print("Retrying:", url, e)
+            time.sleep(2**attempt)
+            attempt += 1
+        finally:
+            if staged is not None and os.path.exists(staged):
+                os.remove(staged)
+
+
 def download_predictions(
-    download_urls: list[str], aws_bucket: str, path: str
+    download_urls: list[str],
+    aws_bucket: str,
+    path: str,
+    max_workers: int = DOWNLOAD_WORKERS,
 ) -> dict[str, Any]:
     """Download list of urls to aws bucket.
-    Executed via CLI using wget and AWS CLI.
+    Files are streamed straight into the bucket, max_workers at a time over a shared connection pool.
+
+    Files already in the bucket and unchanged on the datamart are skipped, see stream_to_bucket.
 
-    Returns dictionary containing download results and file paths.
+    Returns dictionary containing download results, file paths, the manifest entries of the files
+    and the count and bytes of the files transferred and skipped.
     """
 
     errors: list[Exception] = []
     completed_downloads: list[str] = []
+    files: list[dict[str, Any]] = []
 
-    for url in download_urls:
-        filename = url.split("/")[-1]
-        s3_bucket_path = "s3://" + os.path.join(aws_bucket, path, filename)
-        try:
-            downloader = subprocess.run(
-                ["wget", "-O", "-", url], capture_output=True, check=True
-            )
-            s3_upload = subprocess.run(
-                ["aws", "s3", "cp", "-", s3_bucket_path],
-                input=downloader.stdout,
-                check=True,
-            )
-        except subprocess.CalledProcessError as e:
-            print("Error:", url, s3_bucket_path)
-            print(e)
-            errors.append(e)
-        else:
-            print("Upload done:", s3_bucket_path)
-            completed_downloads.append(s3_bucket_path)
-
+    session = http_session(pool_size=max_workers)
+    s3_client = boto3.client("s3")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                stream_to_bucket,
+                session,
+                s3_client,
+                url,
+                aws_bucket,
+                os.path.join(path, url.split("/")[-1]),
+            ): url
+            for url in download_urls
+        }
+        for future in as_completed(futures):
+            try:
+                file = future.result()
+            except (requests.RequestException, BotoCoreError, ClientError) as e:
+                print("Error:", futures[future])
+                print(e)
+                errors.append(e)
+            else:
+                s3_bucket_path = f"""s3://{aws_bucket}/{file["Key"]}"""
+                if file["transferred"]:
+                    print("Upload done:", s3_bucket_path)
+                else:
+                    print("Unchanged, skipped:", s3_bucket_path)
+                completed_downloads.append(s3_bucket_path)
+                files.append(file)
+    session.close()
+
+    transferred = [file for file in files if file["transferred"]]
+    skipped = [file for file in files if not file["transferred"]]
     return {
         "download count": len(completed_downloads),
         "error count": len(errors),
         "download urls": completed_downloads,
+        "files": files,
+        "transferred count": len(transferred),
+        "transferred bytes": sum(file["Size"] for file in transferred),
+        "skipped count": len(skipped),
+        "skipped bytes": sum(file["Size"] for file in skipped),
         "errors": errors,
     }
 
 
+def download_summary(download_results: dict[str, Any]) -> str:
+    """Transferred and skipped files of download_predictions."""
+    return (
+        f"""Transferred {download_results["transferred count"]} files ({download_results["transferred bytes"]} bytes), """
+        f"""skipped {download_results["skipped count"]} unchanged files ({download_results["skipped bytes"]} bytes)"""
+    )
+
+
 def download_predictions_bulk(
     download_urls: list[str], aws_bucket: str, prefix: str
 ) -> list[Exception] | str:
-    """Download list of urls to aws bucket.
-    Executed via CLI using wget and AWS CLI.
+    """Download list of urls to aws bucket, see download_predictions.
 
-    If successful returns aws cli std output.
+    If successful returns a summary of the upload.
     On error return list of exceptions."""
-    errors: list[Exception] = []
-    # print("\n".join(download_urls))
-
-    download_list = BytesIO("\n".join(download_urls).encode())
-    s3_bucket_path = "s3://" + os.path.join(aws_bucket, prefix)
-    with TemporaryDirectory() as tmp_dir_name:
-        try:
-            downloader = subprocess.run(
-                ["wget", "-i", "-", "-P", tmp_dir_name],
-                input=download_list.read(),
-                check=True,
-                capture_output=True,
-            )
-            print("files downloaded:", os.listdir(tmp_dir_name))
-            s3_upload = subprocess.run(
-                [
-                    "aws",
-                    "s3",
-                    "cp",
-                    "--recursive",
-                    "--no-progress",
-                    tmp_dir_name,
-                    s3_bucket_path,
-                ],
-                check=True,
-                capture_output=True,
-            )
-        except subprocess.CalledProcessError as e:
-            print(e)
-            errors.append(e)
-        else:
-            print("Upload done:", len(download_urls), "files")
-            return s3_upload.stdout.decode()
-    return errors
+    download_results = download_predictions(download_urls, aws_bucket, prefix)
+    if download_results["errors"]:
+        return download_results["errors"]
 
+    print("Upload done:", len(download_urls), "files")
+    return f"""Uploaded {download_results["download count"]} files to s3://{aws_bucket}/{prefix}. {download_summary(download_results)}"""
 
-def get_s3_filelisting(aws_bucket: str, prefix: str = "") -> list[dict[str, Any]]:
-    """Fetches list of S3 objects from the specified bucket filtered for the provided prefix.
-    Credentials are read from the environmental variables.
-
-    Each item in the list is a dictionary.
-    """
-    contents = []
 
+def iter_s3_objects(aws_bucket: str, prefix: str = "") -> Iterator[dict[str, Any]]:
+    """Yields the S3 objects of the bucket under the prefix a page at a time.
+    Credentials are read from the environmental variables."""
     s3_client = boto3.client("s3")
     paginator = s3_client.get_paginator("list_objects_v2")
     response = paginator.paginate(
         Bucket=aws_bucket, Prefix=prefix, PaginationConfig={"PageSize": 1000}
     )
+    for page in response:
+        yield from page.get("Contents", [])
 
+
+def get_s3_filelisting(aws_bucket: str, prefix: str = "") -> list[dict[str, Any]]:
+    """Fetches list of S3 objects from the specified bucket filtered for the provided prefix.
+    Credentials are read from the environmental variables.
+
+    Each item in the list is a dictionary.
+    """
     print("Retriving AWS S3 file listing...", end=" ")
-    for page in response:
-        files = page.get("Contents")
-        if not files:
-            # print("None")
-            return contents
-
-        for file in files:
-            # print(f"file_name: {file['Key']}, size: {file['Size']}")
-            contents.append(file)
+    contents = list(iter_s3_objects(aws_bucket, prefix))
     print(f"{len(contents)} files")
     return contents
 
 
+def manifest_key(prefix: str, forecast_string: str) -> str:
+    """Bucket key of the manifest of a run, next to its files."""
+    return f"{prefix}/{forecast_string}.manifest.json"
+
+
+def write_manifest(
+    aws_bucket: str,
+    key: str,
+    forecast_info: dict[str, Any],
+    files: list[dict[str, Any]],
+) -> dict[str, Any]:
+    """Writes the manifest of the files downloaded for a run to the bucket.
+    Files are ordered by forecast hour, the band order of the run.
+
+    Returns the manifest."""
+    manifest = {
+        "forecast_string": forecast_info["forecast_string"],
+        "files": sorted(
+            (
+                {
+                    **file,
+                    "forecast_hour": int(
+                        file_name_info(file["Key"], "rotated_lat_lon")["forecast_hour"]
+                    ),
+                }
+                for file in files
+            ),
+            key=lambda file: file["forecast_hour"],
+        ),
+    }
+    boto3.client("s3").put_object(
+        Bucket=aws_bucket,
+        Key=key,
+        Body=json.dumps(manifest).encode(),
+        ContentType="application/json",
+    )
+    return manifest
+
+
+def read_manifest(aws_bucket: str, key: str) -> dict[str, Any]:
+    """Reads a manifest written by write_manifest."""
+    res = boto3.client("s3").get_object(Bucket=aws_bucket, Key=key)
+    return json.loads(res["Body"].read())
+
+
+def reconcile_manifest(
+    manifest: dict[str, Any], listing: Iterable[dict[str, Any]]
+) -> list[str]:
+    """Compares a manifest with a listing of the bucket, the keys are matched with set operations.
+
+    Returns the keys of the manifest missing from the bucket or of a different size."""
+    sizes = {file["Key"]: file["Size"] for file in listing}
+    return [
+        file["Key"]
+        for file in manifest["files"]
+        if sizes.get(file["Key"]) != file["Size"]
+    ]
+
+
 def file_name_info(full_path: str, format: str) -> dict[str, str]:
     """Returns a dictionary of the filename split into its component parts.
 
@@ -343,35 +704,70 @@ def create_vrt(
     input_file_listing: list[dict[str, Any]], output_path: str, bucket: str
 ) -> list[Exception] | str:
     """Executes gdalbuildvrt to create virtual dataset.
+    With the GRIB cache enabled the files are read through the cache and the VRT is written to the
+    cache, with a copy pointing to the bucket files uploaded as the durable VRT.
     Returns the GDAL path the output file, or a list of errors."""
 
     errors: list[Exception] = []
-    file_list = [f"/vsis3/{bucket}/{file['Key']}\n" for file in input_file_listing]
-    vrt_path = f"/vsis3/{bucket}/{output_path}"
-
-    with NamedTemporaryFile(mode="w+t") as input_list:
-        input_list.writelines(file_list)
-        input_list.seek(0)
+    cache = grib_cache.cache
+    # downloads of the later files must not evict the earlier ones before gdalbuildvrt has read them
+    pinned = (
+        cache.pinned(
+            [cache.object_path(bucket, file["Key"]) for file in input_file_listing]
+        )
+        if cache is not None
+        else nullcontext()
+    )
+    with pinned:
         try:
-            print("Creating virtual dataset:")
-            buildvrt = subprocess.run(
-                [
-                    "gdalbuildvrt",
-                    "-separate",
-                    "-input_file_list",
-                    input_list.name,
-                    vrt_path,
-                ],
-                capture_output=True,
-                check=True,
-            )
-        except subprocess.CalledProcessError as e:
+            file_list = [
+                f"{grib_cache.gdal_path(bucket, file['Key'])}\n"
+                for file in input_file_listing
+            ]
+        except (BotoCoreError, ClientError) as e:
             print("Error:", e)
             errors.append(e)
+            return errors
+        if cache is not None:
+            vrt_path = f"{cache.staging_path()}.vrt"
         else:
-            print(buildvrt.args)
-            print(buildvrt.stdout.decode())
-            return vrt_path
+            vrt_path = f"/vsis3/{bucket}/{output_path}"
+
+        with NamedTemporaryFile(mode="w+t") as input_list:
+            input_list.writelines(file_list)
+            input_list.seek(0)
+            try:
+                print("Creating virtual dataset:")
+                buildvrt = subprocess.run(
+                    [
+                        "gdalbuildvrt",
+                        "-separate",
+                        "-input_file_list",
+                        input_list.name,
+                        vrt_path,
+                    ],
+                    capture_output=True,
+                    check=True,
+                )
+                if cache is not None:
+                    vrt_path = cache.admit(
+                        vrt_path, cache.vrt_path(bucket, output_path)
+                    )
+                    boto3.client("s3").put_object(
+                        Bucket=bucket,
+                        Key=output_path,
+                        Body=cache.bucket_vrt(bucket, vrt_path).encode(),
+                    )
+            except (subprocess.CalledProcessError, BotoCoreError, ClientError) as e:
+                print("Error:", e)
+                errors.append(e)
+                if cache is not None and vrt_path.startswith(cache.staging_dir):
+                    if os.path.exists(vrt_path):
+                        os.remove(vrt_path)
+            else:
+                print(buildvrt.args)
+                print(buildvrt.stdout.decode())
+                return vrt_path
     return errors
 
 
@@ -381,21 +777,85 @@ def load_to_postgis(
     table_name: str,
     conn_details: dict[str, str],
     srid: str = "990000",
+    index: bool = True,
 ) -> list[Exception] | str:
-    """Using raster2pgsql and the virtual dataset (VRT), insert the data into PostGIS.
+    """Insert the data of the virtual dataset (VRT) into PostGIS, one row per tile named after the file.
+    Uses the in process loader (copy_to_postgis) unless RASTER_LOADER is set to raster2pgsql.
+    index=False skips creating the spatial index with raster2pgsql, for staging tables.
 
     Return psql stdout"""
-    assert vrt_path[:7] == "/vsis3/"
+    # bucket VRTs, or the derived variables staged on local disk
+    assert vrt_path[:7] == "/vsis3/" or os.path.isfile(vrt_path)
+    # cached sources are kept until the load has read them
+    with grib_cache.pinned(vrt_path):
+        if RASTER_LOADER == "raster2pgsql":
+            return raster2pgsql_to_postgis(
+                vrt_path, schema, table_name, conn_details, srid, index
+            )
+        return copy_to_postgis(vrt_path, schema, table_name, conn_details, srid)
 
+
+def copy_to_postgis(
+    vrt_path: str,
+    schema: str,
+    table_name: str,
+    conn_details: dict[str, str],
+    srid: str = "990000",
+    tile_size: int = raster_loader.TILE_SIZE,
+    workers: int = raster_loader.ENCODE_WORKERS,
+) -> list[Exception] | str:
+    """Decodes the dataset to a local float32 cube with gdal_translate, cuts it into tile_size tiles
+    encoded as raster WKB by a pool of workers and streams them into PostGIS with a binary COPY
+    (see raster_loader.py).
+
+    Return the status of the insert"""
+    errors: list[Exception] = []
+    try:
+        metadata = raster_loader.raster_metadata(vrt_path)
+        with TemporaryDirectory() as tmp_dir:
+            cube_path = export_raw_cube(vrt_path, os.path.join(tmp_dir, "cube"))
+            if not isinstance(cube_path, str):
+                return cube_path
+            cube = np.memmap(
+                cube_path, dtype="<f4", mode="r", shape=raw_cube_shape(cube_path)
+            )
+            tiles = raster_loader.encode_tiles(
+                cube, metadata, int(srid), tile_size, workers
+            )
+            copy = raster_loader.copy_tiles(
+                tiles, os.path.basename(vrt_path), schema, table_name, conn_details
+            )
+    except (subprocess.CalledProcessError, psycopg.Error, OSError, struct.error) as e:
+        print("Error:", e)
+        errors.append(e)
+        return errors
+    else:
+        print(copy)
+        return copy["statusmessage"]
+
+
+def raster2pgsql_to_postgis(
+    vrt_path: str,
+    schema: str,
+    table_name: str,
+    conn_details: dict[str, str],
+    srid: str = "990000",
+    index: bool = True,
+) -> list[Exception] | str:
+    """Using raster2pgsql and the virtual dataset (VRT), insert the data into PostGIS.
+
+    Return psql stdout"""
     errors: list[Exception] = []
     schema_table = f"{schema}.{table_name}"
+    # Create a GIST spatial index on the raster column.
+    index_option = ["-I"] if index else []
     try:
         print("raster2pgsql creating VRT")
         vrt = subprocess.Popen(
             [
                 "raster2pgsql",
                 "-a",  # Append to the existing table
-                "-I",  # Create a GIST spatial index on the raster column.
+                *index_option,
                 "-q",  # Wrap PostgreSQL identifiers in quotes.
                 "-t",  # Cut raster into tiles to be inserted one per table row.
                 "auto",
@@ -413,6 +873,8 @@ def load_to_postgis(
         psql = subprocess.run(
             [
                 "psql",
+                "-v",
+                "ON_ERROR_STOP=1",
                 "-d",
                 conn_details["dbname"],
                 "-h",
@@ -426,6 +888,10 @@ def load_to_postgis(
             check=True,
             stdin=vrt.stdout,
         )
+        if vrt.wait() != 0:
+            raise subprocess.CalledProcessError(
+                vrt.returncode, vrt.args, stderr=b"raster2pgsql failed"
+            )
 
     except subprocess.CalledProcessError as e:
         print("Error:", e.stderr)
@@ -436,19 +902,646 @@ def load_to_postgis(
         return psql.stdout.decode()
 
 
+def run_table_name(file_name: str) -> str:
+    """Prefix of the tables holding the tiles of a run (VRT file name). Each load of the run stages its tiles
+    in a table of its own named with a suffix, which replaces the run's partition of predictions once loaded."""
+    return f"predictions_{hashlib.md5(file_name.encode()).hexdigest()[:16]}"
+
+
+def run_tables(curr: psycopg.Cursor, file_name: str) -> list[tuple[str, bool]]:
+    """Tables of the run (VRT file name), with whether each is attached to predictions: the partition of
+    the run, and the staging tables of loads in progress or interrupted."""
+    return curr.execute(
+        """SELECT c.relname, EXISTS (
+                SELECT FROM pg_inherits i
+                WHERE i.inhrelid = c.oid
+                AND i.inhparent = 'public.predictions'::regclass
+            )
+        FROM pg_class c
+            INNER JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = 'public'
+            AND c.relkind = 'r'
+            AND starts_with(c.relname, %s)""",
+        (run_table_name(file_name),),
+    ).fetchall()
+
+
+def ingest_ledger_statement(
+    forecast_info: dict[str, Any], tile_count: int, band_count: int, checksum: str
+) -> sql.Composed:
+    """Records a loaded run in ingest_ledger, replacing the entry of an earlier load of the run.
+    The checksum is the md5 of the md5 of every tile in load order."""
+    return sql.SQL(
+        """
+        INSERT INTO public.ingest_ledger (
+            filename,
+            forecast_string,
+            variable,
+            status,
+            band_count,
+            tile_count,
+            checksum
+        )
+        VALUES ({val_filename}, {val_forecast_string}, {val_variable}, 'loaded',
+            {val_band_count}, {val_tile_count}, {val_checksum})
+        ON CONFLICT (filename) DO UPDATE
+        SET (status, band_count, tile_count, checksum, loaded_at) = (
+            EXCLUDED.status,
+            EXCLUDED.band_count,
+            EXCLUDED.tile_count,
+            EXCLUDED.checksum,
+            now())
+        """
+    ).format(
+        val_filename=sql.Literal(f"""{forecast_info["forecast_string"]}.vrt"""),
+        val_forecast_string=sql.Literal(forecast_info["forecast_string"]),
+        val_variable=sql.Literal(forecast_info["variable"]),
+        val_band_count=sql.Literal(band_count),
+        val_tile_count=sql.Literal(tile_count),
+        val_checksum=sql.Literal(checksum),
+    )
+
+
+def load_run(
+    vrt_path: str,
+    forecast_info: dict[str, Any],
+    conn_details: dict[str, str],
+    srid: str = "990001",
+) -> list[Exception] | str:
+    """Loads a run into a staging table of its own, indexes and analyzes it, then records the run in
+    variables and ingest_ledger and attaches the table as the run's partition of predictions in one short
+    transaction. Live queries never see a partly loaded run and a failed load leaves nothing behind,
+    the staging table is dropped.
+    A run loaded again stays served from its current partition until the transaction attaching the new
+    one detaches and drops it.
+
+    Return the output of load_to_postgis"""
+    file_name = f"""{forecast_info["forecast_string"]}.vrt"""
+    table_name = f"{run_table_name(file_name)}_{uuid.uuid4().hex[:8]}"
+    table = sql.Identifier("public", table_name)
+
+    with connection_pool.connection(conn_details) as conn:
+        conn.execute(
+            sql.SQL(
+                """CREATE TABLE {table} (LIKE public.predictions INCLUDING DEFAULTS);
+                ALTER TABLE {table} ADD PRIMARY KEY (rid, filename);"""
+            ).format(table=table)
+        )
+
+    psql: list[Exception] | str = []
+    try:
+        psql = load_to_postgis(
+            vrt_path, "public", table_name, conn_details, srid=srid, index=False
+        )
+        assert isinstance(psql, str), psql
+        with connection_pool.connection(conn_details) as conn:
+            # the index matches the one of predictions so the attach adopts it rather than building one,
+            # the check constraint proves the partition bound so the attach does not scan the tiles
+            conn.execute(
+                sql.SQL(
+                    """CREATE INDEX ON {table} USING gist (st_convexhull(raster));
+                    ALTER TABLE {table} ADD CONSTRAINT {bound} CHECK (filename = {val_filename});
+                    ANALYZE {table};"""
+                ).format(
+                    table=table,
+                    bound=sql.Identifier(f"{table_name}_bound"),
+                    val_filename=sql.Literal(file_name),
+                )
+            )
+            ledger_entry = conn.execute(
+                sql.SQL(
+                    """SELECT
+                        count(*) AS tile_count,
+                        min(ST_NumBands(raster)) AS band_count,
+                        md5(string_agg(md5(raster::bytea), '' ORDER BY rid)) AS checksum
+                    FROM {table}"""
+                ).format(table=table)
+            ).fetchone()
+            assert ledger_entry[0] > 0, f"No tiles loaded for {file_name}"
+            with conn.transaction():
+                # fail rather than queue live queries behind the attach
+                conn.execute("SET LOCAL lock_timeout = '10s'")
+                with conn.cursor() as curr:
+                    for replaced, attached in run_tables(curr, file_name):
+                        if attached:
+                            curr.execute(
+                                sql.SQL(
+                                    """ALTER TABLE public.predictions DETACH PARTITION {replaced};
+                                    DROP TABLE {replaced};"""
+                                ).format(replaced=sql.Identifier("public", replaced))
+                            )
+                conn.execute(variables_record_rotated_lat_lon_statement(forecast_info))
+                conn.execute(ingest_ledger_statement(forecast_info, *ledger_entry))
+                conn.execute(
+                    sql.SQL(
+                        """ALTER TABLE public.predictions ATTACH PARTITION {table} FOR VALUES IN ({val_filename});
+                        ALTER TABLE {table} DROP CONSTRAINT {bound};"""
+                    ).format(
+                        table=table,
+                        bound=sql.Identifier(f"{table_name}_bound"),
+                        val_filename=sql.Literal(file_name),
+                    )
+                )
+    except Exception as e:
+        print("Error:", e)
+        with connection_pool.connection(conn_details) as conn:
+            conn.execute(sql.SQL("DROP TABLE IF EXISTS {table}").format(table=table))
+        # failures of the load are returned, anything unexpected is raised once the table is dropped
+        if not isinstance(e, (AssertionError, psycopg.Error)):
+            raise
+        return psql if isinstance(psql, list) and psql else [e]
+
+    print("Run attached:", file_name, table_name)
+    return psql
+
+
+def export_raw_cube(
+    vrt_path: str, output_path: str, interleave: str = "BSQ"
+) -> list[Exception] | str:
+    """Executes gdal_translate to write every band of the dataset to a raw ENVI cube
+    (float32 plus a .hdr header) which can be memory mapped with numpy.
+    BSQ cubes are (bands, lines, samples), BIP cubes (lines, samples, bands).
+    Returns the path of the output file, or a list of errors."""
+    errors: list[Exception] = []
+    try:
+        with grib_cache.pinned(vrt_path):
+            translate = subprocess.run(
+                [
+                    "gdal_translate",
+                    "-q",
+                    "-of",
+                    "ENVI",
+                    "-ot",
+                    "Float32",
+                    "-co",
+                    f"INTERLEAVE={interleave}",
+                    vrt_path,
+                    output_path,
+                ],
+                capture_output=True,
+                check=True,
+            )
+    except subprocess.CalledProcessError as e:
+        print("Error:", e.stderr)
+        errors.append(e)
+    else:
+        print(translate.args)
+        return output_path
+    return errors
+
+
+def read_envi_header(output_path: str) -> dict[str, str]:
+    """Fields of the .hdr header of an ENVI cube written by export_raw_cube."""
+    header: dict[str, str] = {}
+    with open(local_store.header_file_name(output_path)) as f:
+        for line in f:
+            key, sep, value = line.partition("=")
+            if sep:
+                header[key.strip()] = value.strip()
+    return header
+
+
+def raw_cube_shape(output_path: str) -> tuple[int, int, int]:
+    """(bands, lines, samples) of an ENVI cube written by export_raw_cube."""
+    header = read_envi_header(output_path)
+    return int(header["bands"]), int(header["lines"]), int(header["samples"])
+
+
+def _derive_shovel_time_rows(task: dict[str, Any]) -> int:
+    """Process pool worker: applies the shoveltime algorithm to a block of grid rows of the memory mapped cubes.
+    Returns the number of rows processed."""
+    shape = task["shape"]
+    rows = slice(task["first_row"], task["last_row"])
+    snowfall = np.memmap(task["snowfall_path"], dtype="<f4", mode="r", shape=shape)
+    temperature = np.memmap(
+        task["temperature_path"], dtype="<f4", mode="r", shape=shape
+    )
+
+    # (points, hours) as expected by the kernel
+    fields = shovel_time.shovel_time_fields(
+        snowfall[:, rows, :].reshape(shape[0], -1).T,
+        temperature[:, rows, :].reshape(shape[0], -1).T,
+    )
+    for field, output_path in task["output_paths"].items():
+        output = np.memmap(output_path, dtype="<f4", mode="r+", shape=shape)
+        output[:, rows, :] = fields[field].T.reshape(shape[0], -1, shape[2])
+        output.flush()
+        del output
+    return rows.stop - rows.start
+
+
+def derive_shovel_time_cubes(
+    snowfall_path: str,
+    temperature_path: str,
+    output_paths: dict[str, str],
+    workers: int,
+    memory_budget_mb: int,
+) -> dict[str, str]:
+    """Writes the derived shoveltime fields (output_paths: field -> path) of the whole grid as ENVI cubes.
+
+    The grid is split into blocks of rows processed by a pool of worker processes. Blocks are sized so the
+    workers together stay within memory_budget_mb: the kernel needs about 80 bytes per cell and hour
+    for its float64 intermediates on top of the float32 inputs."""
+    bands, lines, samples = raw_cube_shape(snowfall_path)
+    assert raw_cube_shape(temperature_path) == (bands, lines, samples)
+
+    for output_path in output_paths.values():
+        np.memmap(
+            output_path, dtype="<f4", mode="w+", shape=(bands, lines, samples)
+        ).flush()
+        shutil.copyfile(
+            local_store.header_file_name(snowfall_path),
+            local_store.header_file_name(output_path),
+        )
+
+    bytes_per_row = samples * bands * 80
+    rows_per_block = max(1, memory_budget_mb * 1024 * 1024 // (workers * bytes_per_row))
+    tasks = [
+        {
+            "snowfall_path": snowfall_path,
+            "temperature_path": temperature_path,
+            "output_paths": output_paths,
+            "shape": (bands, lines, samples),
+            "first_row": first_row,
+            "last_row": min(first_row + rows_per_block, lines),
+        }
+        for first_row in range(0, lines, rows_per_block)
+    ]
+    print(
+        f"Deriving shoveltime: {lines} rows in {len(tasks)} blocks on {workers} workers"
+    )
+    # spawned rather than forked: the API runs this on its refresh thread, next to the event loop and the
+    # connection pool threads, whose locks a forked child could inherit held
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        assert sum(executor.map(_derive_shovel_time_rows, tasks)) == lines
+    return output_paths
+
+
+def derive_shovel_time(
+    snowfall: tuple[dict[str, Any], str],
+    temperature: tuple[dict[str, Any], str],
+    conn_details: dict[str, str],
+    work_dir: str,
+    workers: int = os.cpu_count() or 1,
+    memory_budget_mb: int = 1024,
+) -> dict[str, str]:
+    """Precomputes the estimated snow depth and shoveltime of the whole grid from the loaded
+    CONDASNOW and TMP runs, given as (forecast_info, vrt_path), and loads them into PostGIS as
+    the variables of shovel_time.DERIVED_VARIABLES. Intermediate files are written to work_dir.
+
+    Returns the VRT file names of the loaded derived variables and the VRT paths in work_dir."""
+    loaded_files: dict[str, str] = {}
+    snowfall_path = export_raw_cube(snowfall[1], os.path.join(work_dir, "snowfall"))
+    temperature_path = export_raw_cube(
+        temperature[1], os.path.join(work_dir, "temperature")
+    )
+    assert isinstance(snowfall_path, str) and isinstance(temperature_path, str)
+
+    snowfall_info = snowfall[0]
+    derived_info = {
+        variable: file_name_info(
+            snowfall_info["full_path"].replace(
+                f"""_{snowfall_info["variable"]}_""", f"_{variable}_"
+            ),
+            "rotated_lat_lon",
+        )
+        for variable in shovel_time.DERIVED_VARIABLES
+    }
+    derive_shovel_time_cubes(
+        snowfall_path,
+        temperature_path,
+        {
+            field: os.path.join(work_dir, variable)
+            for variable, field in shovel_time.DERIVED_VARIABLES.items()
+        },
+        workers,
+        memory_budget_mb,
+    )
+
+    for variable, forecast_info in derived_info.items():
+        # raster2pgsql names the tiles after the input file, as for the bucket VRTs
+        vrt = os.path.join(work_dir, f"""{forecast_info["forecast_string"]}.vrt""")
+        subprocess.run(
+            [
+                "gdal_translate",
+                "-q",
+                "-of",
+                "VRT",
+                os.path.join(work_dir, variable),
+                vrt,
+            ],
+            capture_output=True,
+            check=True,
+        )
+
+        psql = load_run(vrt, forecast_info, conn_details, srid="990001")
+        assert isinstance(psql, str)
+        loaded_files[f"""{forecast_info["forecast_string"]}.vrt"""] = vrt
+
+    return loaded_files
+
+
+def derive_published_runs(
+    sources: dict[str, str],
+    aws_bucket: str,
+    conn_details: dict[str, str],
+    work_dir: str,
+) -> dict[str, str]:
+    """Derives the shoveltime variables of the published CONDASNOW and TMP runs (see derive_shovel_time)
+    and publishes them, unless they were derived already. Derived variables of an older model run are
+    unpublished first, so they are never served along runs they were not computed from.
+
+    sources maps VRT file names to GDAL paths, the bucket VRT is read for the runs without one.
+    Returns the VRT file names of the newly derived variables and the VRT paths in work_dir."""
+    derived_variables = list(shovel_time.DERIVED_VARIABLES)
+    unpublished = unpublish_stale_runs(derived_variables, conn_details)
+    print("Unpublished stale derived runs:", unpublished)
+
+    runs = {
+        run["variable"]: run
+        for run in execute_sql_as_dataframe(
+            conn_details,
+            sql.SQL(
+                """
+                SELECT v.variable, v.forecast_string, c.filename, c.forecast_start_timestamp, c.band_count
+                FROM public.current_runs c
+                    INNER JOIN public.variables v ON v.filename = c.filename
+                WHERE v.variable = ANY({val_variables})
+                """
+            ).format(val_variables=sql.Literal(list(SHOVEL_TIME_INPUTS))),
+        ).to_dict("records")
+    }
+    if len(runs) < len(SHOVEL_TIME_INPUTS) or (
+        len(
+            {
+                (run["forecast_start_timestamp"], run["band_count"])
+                for run in runs.values()
+            }
+        )
+        > 1
+    ):
+        print("Published CONDASNOW and TMP runs do not match, not deriving")
+        return {}
+
+    snowfall, temperature = (runs[variable] for variable in SHOVEL_TIME_INPUTS)
+    derived_files = [
+        f"""{snowfall["forecast_string"].replace(f"_{snowfall['variable']}_", f"_{variable}_")}.vrt"""
+        for variable in derived_variables
+    ]
+    derived_sources: dict[str, str] = {}
+    # the subscriber and full_refresh both derive once a model run is complete, only one of them does
+    with run_lock(derived_files[0], conn_details):
+        if any(
+            run_band_count(file_name, conn_details) != snowfall["band_count"]
+            for file_name in derived_files
+        ):
+            # left over by an interrupted derivation, or derived from a partially loaded run,
+            # load_run replaces them
+            derived_sources = derive_shovel_time(
+                *(
+                    (
+                        # any hour, derive_shovel_time only reads the run's components
+                        file_name_info(
+                            f"""{run["forecast_string"]}_PT001H.grib2""",
+                            "rotated_lat_lon",
+                        ),
+                        sources.get(run["filename"])
+                        or grib_cache.vrt_gdal_path(aws_bucket, run["filename"]),
+                    )
+                    for run in (snowfall, temperature)
+                ),
+                conn_details,
+                work_dir,
+                workers=int(os.environ.get("DERIVED_WORKERS", os.cpu_count() or 1)),
+                memory_budget_mb=int(os.environ.get("DERIVED_MEMORY_BUDGET_MB", 1024)),
+            )
+            print("Derived variables:", list(derived_sources))
+
+        if not all(
+            is_run_published(file_name, conn_details) for file_name in derived_files
+        ):
+            published = publish_current_runs(derived_files, conn_details)
+            print("Published derived runs:", published)
+    return derived_sources
+
+
+def local_store_runs_query() -> sql.SQL:
+    """Published run of each variable with the details returned along the predictions."""
+    return sql.SQL(
+        """
+        SELECT
+            c.filename,
+            c.unit,
+            c.forecast_start_timestamp,
+            c.band_count,
+            v.model,
+            v.variable,
+            variable_definitions.description AS "variable_description",
+            v.leveltype,
+            v.level
+        FROM current_runs c
+            INNER JOIN variables v ON v.filename = c.filename
+            LEFT JOIN variable_definitions ON
+                v.variable = variable_definitions.variable
+                AND v.model = variable_definitions.model
+        ORDER BY variable, leveltype, level
+        """
+    )
+
+
+def refresh_local_store(
+    sources: dict[str, str],
+    conn_details: dict[str, str],
+    store_dir: str = local_store.STORE_DIR,
+) -> str:
+    """Writes the published runs to the local store (see local_store.py) and swaps it in.
+
+    sources maps VRT file names to GDAL paths of the datasets. Runs already in the store are kept
+    as is, runs without a source are left out and the API falls back to PostGIS until they are stored.
+    Returns the path of the store manifest."""
+    runs = execute_sql_as_dataframe(conn_details, local_store_runs_query())
+    os.makedirs(store_dir, exist_ok=True)
+
+    variables: list[dict[str, Any]] = []
+    # staged on the same file system so that publishing is a rename
+    with TemporaryDirectory(dir=store_dir) as staging_dir:
+        staged: list[str] = []
+        for run in runs.to_dict("records"):
+            cube_file = local_store.cube_file_name(run["filename"], run["band_count"])
+            cube_path = os.path.join(store_dir, cube_file)
+            if not os.path.isfile(cube_path):
+                if run["filename"] not in sources:
+                    print("No source for the local store, skipping:", run["filename"])
+                    continue
+                cube_path = export_raw_cube(
+                    sources[run["filename"]],
+                    os.path.join(staging_dir, cube_file),
+                    interleave="BIP",
+                )
+                assert isinstance(cube_path, str)
+                staged += [cube_path, local_store.header_file_name(cube_path)]
+
+            header = read_envi_header(cube_path)
+            bands, lines, samples = raw_cube_shape(cube_path)
+            nodata = header.get("data ignore value")
+            variables.append(
+                {
+                    **run,
+                    "file": cube_file,
+                    "shape": [lines, samples, bands],
+                    "nodata": float(nodata) if nodata is not None else None,
+                }
+            )
+
+        manifest = local_store.publish(store_dir, variables, staged)
+    print("Local store published:", manifest)
+    return manifest
+
+
+def refresh_download_stage(job: dict[str, Any]) -> dict[str, Any]:
+    """full_refresh pipeline stage: downloads the files of a variable to the bucket and writes
+    the manifest of the run, which the following stages read instead of listing the bucket."""
+    forecast_info = job["forecast_info"]
+    s3_prefix = f"""gribs/{forecast_info["forecast_base_string"]}"""
+    print("Downloading prediction data for:", forecast_info["forecast_string"])
+
+    download_results = download_predictions(
+        download_urls=job["download_urls"],
+        aws_bucket=job["aws_bucket"],
+        path=s3_prefix,
+    )
+    assert not download_results["errors"], download_results["errors"]
+    assert len(download_results["files"]) == len(job["download_urls"])
+
+    manifest = write_manifest(
+        job["aws_bucket"],
+        manifest_key(s3_prefix, forecast_info["forecast_string"]),
+        forecast_info,
+        download_results["files"],
+    )
+    # a single listing of the run's files to check the manifest against the bucket
+    mismatched = reconcile_manifest(
+        manifest,
+        iter_s3_objects(
+            job["aws_bucket"], f"""{s3_prefix}/{forecast_info["forecast_string"]}"""
+        ),
+    )
+    assert not mismatched, f"Files missing from the bucket: {mismatched}"
+    download = (
+        f"""{forecast_info["forecast_string"]}: {download_summary(download_results)}"""
+    )
+    print(download)
+    return {**job, "manifest": manifest, "download": download}
+
+
+def refresh_vrt_stage(job: dict[str, Any]) -> dict[str, Any]:
+    """full_refresh pipeline stage: builds the virtual dataset of the files in the manifest, in forecast hour order."""
+    vrt = create_vrt(
+        job["manifest"]["files"],
+        f"""{job["forecast_info"]["forecast_string"]}.vrt""",
+        bucket=job["aws_bucket"],
+    )
+    print(vrt)
+    assert isinstance(vrt, str)
+    return {**job, "vrt": vrt}
+
+
+def restore_vrt(job: dict[str, Any]) -> dict[str, Any]:
+    """Path of a VRT recorded by an earlier refresh attempt. The local VRT may have been evicted from
+    the GRIB cache, or been built in another container, the bucket copy is read instead."""
+    if job["vrt"][:7] == "/vsis3/" or os.path.isfile(job["vrt"]):
+        return job
+    return {
+        **job,
+        "vrt": grib_cache.vrt_gdal_path(
+            job["aws_bucket"], f"""{job["forecast_info"]["forecast_string"]}.vrt"""
+        ),
+    }
+
+
+def refresh_load_stage(job: dict[str, Any]) -> dict[str, Any]:
+    """full_refresh pipeline stage: loads the virtual dataset into PostGIS, or appends the hours
+    missing from a run the subscriber (subscriber.py) loaded part of."""
+    file_name = f"""{job["forecast_info"]["forecast_string"]}.vrt"""
+    band_count = job["loaded_bands"]
+    if not band_count:
+        with run_lock(file_name, job["conn_details"]):
+            # the subscriber may have loaded the first hours since the run was discovered
+            band_count = run_band_count(file_name, job["conn_details"])
+            if not band_count:
+                psql = load_run(
+                    job["vrt"], job["forecast_info"], job["conn_details"], srid="990001"
+                )
+    if band_count:
+        psql = append_missing_bands(
+            job["manifest"]["files"],
+            band_count,
+            file_name,
+            job["aws_bucket"],
+            job["conn_details"],
+        )
+    assert isinstance(psql, str)
+    print(psql)
+    return {**job, "psql": psql}
+
+
 def full_refresh(
     variables: list[dict[str, str]],
     aws_bucket: str,
     last_forecast_hour: int,
     conn_details: dict[str, str],
+    progress: Optional[dict[str, Any]] = None,
 ):
+    """Downloads and loads the latest run of the variables, then publishes them.
+
+    Variables go through a download -> VRT -> load pipeline (see pipeline.run_pipeline) so the
+    network, GDAL and database work of different variables overlap. The workers of each stage and
+    the overall concurrency are set by pipeline.pipeline_settings_from_env.
+
+    The refresh of a model run is a persistent job (see refresh_jobs.py): each stage completed by a
+    variable is checkpointed and refreshing the run again, after a failure or not, resumes every
+    variable at its first incomplete stage.
+
+    progress, when given, is updated with the current stage and the id of the job."""
     print("Refreshing weather data...")
+    progress = progress if progress is not None else {}
 
     # get latest forecast hour
+    progress["stage"] = "finding latest forecast"
     latest_url = find_latest_forecast(last_forecast_hour)
+    job_id = refresh_jobs.job_id(latest_url["date"], latest_url["forecast"])
+    job = refresh_jobs.start_job(job_id, conn_details)
+    progress["refresh_job"] = job_id
+    print("Refresh job:", job_id, "attempt", job["attempts"])
+    try:
+        results = refresh_model_run(
+            job_id, latest_url, variables, aws_bucket, conn_details, progress
+        )
+    except Exception as e:
+        refresh_jobs.finish_job(job_id, conn_details, error=e)
+        raise
+    refresh_jobs.finish_job(job_id, conn_details)
+    return results
+
+
+def refresh_model_run(
+    job_id: str,
+    latest_url: dict[str, str],
+    variables: list[dict[str, str]],
+    aws_bucket: str,
+    conn_details: dict[str, str],
+    progress: dict[str, Any],
+) -> list[str]:
+    """The refresh job of full_refresh for the model run at latest_url."""
+    checkpoints = refresh_jobs.job_checkpoints(job_id, conn_details)
     results: list[str] = []
+    loaded_files: list[str] = []
+    # GDAL path of each VRT for the local store
+    sources: dict[str, str] = {}
 
-    # cycle through variables and update each
+    jobs = []
     for var in variables:
         download_urls = create_urls_rotated_lat_lon(
             latest_url["baseurl"],
@@ -460,79 +1553,214 @@ def full_refresh(
 
         forecast_info = file_name_info(download_urls[0], "rotated_lat_lon")
         # print("forecast_info:", forecast_info)
-        s3_prefix = f"""gribs/{forecast_info["forecast_base_string"]}"""
+        forecast_string = forecast_info["forecast_string"]
+        refresh_jobs.record_checkpoint(
+            job_id,
+            forecast_string,
+            "discovered",
+            {"download_urls": download_urls},
+            conn_details,
+        )
 
-        if does_prediction_data_exist(
-            conn_details=conn_details, forecast_string=forecast_info["forecast_string"]
-        ):
+        # runs are partially loaded while the subscriber (subscriber.py) ingests them hour by hour,
+        # unpublished leftovers of an interrupted subscriber are reloaded in full, published ones are
+        # completed with the missing hours so they stay served meanwhile
+        file_name = f"""{forecast_info["forecast_string"]}.vrt"""
+        band_count = run_band_count(file_name, conn_details)
+        if 0 < band_count < len(download_urls):
+            if is_run_published(file_name, conn_details):
+                print(
+                    f"Completing partially loaded run ({band_count} hours):",
+                    forecast_info["forecast_string"],
+                )
+            else:
+                print(
+                    f"Reloading partially loaded run ({band_count} hours):",
+                    forecast_info["forecast_string"],
+                )
+                delete_variable_record(file_name, conn_details)
+                band_count = 0
+        elif band_count > 0:
             message = f"""Prediction data already exists. Skipping: {forecast_info["forecast_string"]}"""
             print(message)
             results.append(message)
+            refresh_jobs.record_checkpoint(
+                job_id, forecast_string, "loaded", {"psql": message}, conn_details
+            )
+            sources[
+                f"""{forecast_info["forecast_string"]}.vrt"""
+            ] = grib_cache.vrt_gdal_path(
+                aws_bucket, f"""{forecast_info["forecast_string"]}.vrt"""
+            )
+            # loaded by an earlier attempt which failed before publishing, it is published with the
+            # variables loaded now so readers never mix model runs
+            if (forecast_string, "published") not in checkpoints and run_status(
+                file_name, conn_details
+            ) == "loaded":
+                loaded_files.append(file_name)
             continue
-
-        print("Downloading prediction data for:", forecast_info["forecast_string"])
-
-        prior_folder_contents = get_s3_filelisting(
-            aws_bucket=aws_bucket, prefix=s3_prefix
-        )  # to be delete if update was successful.
-
-        download_results = download_predictions_bulk(
-            download_urls=download_urls,
-            aws_bucket=aws_bucket,
-            prefix=s3_prefix,
+        # the ledger has the final say on what is loaded, the run was deleted since it was checkpointed
+        checkpoints.pop((forecast_string, "loaded"), None)
+
+        jobs.append(
+            {
+                "forecast_info": forecast_info,
+                "download_urls": download_urls,
+                "aws_bucket": aws_bucket,
+                "conn_details": conn_details,
+                "loaded_bands": band_count,
+            }
         )
-        print(download_results)
-        assert isinstance(download_results, str)
-
-        after_folder_contents = get_s3_filelisting(
-            aws_bucket=aws_bucket, prefix=s3_prefix
-        )
-
-        downloaded_files = []
-        for file in after_folder_contents:
-            try:
-                prior_folder_contents.index(file)
-            except ValueError as e:
-                downloaded_files.append(file)
-            else:
-                pass
-        assert len(downloaded_files) > 0
 
-        vrt = create_vrt(
-            downloaded_files,
-            f"""{forecast_info["forecast_string"]}.vrt""",
-            bucket=aws_bucket,
+    progress["stage"] = "downloading, building VRTs and loading"
+    settings = pipeline.pipeline_settings_from_env()
+    refresh = pipeline.run_pipeline(
+        jobs,
+        [
+            (
+                "download",
+                refresh_jobs.checkpointed(
+                    job_id,
+                    "downloaded",
+                    refresh_download_stage,
+                    checkpoints,
+                    conn_details,
+                ),
+                settings["download_workers"],
+            ),
+            (
+                "vrt",
+                refresh_jobs.checkpointed(
+                    job_id,
+                    "vrt_built",
+                    refresh_vrt_stage,
+                    checkpoints,
+                    conn_details,
+                    restore=restore_vrt,
+                ),
+                settings["vrt_workers"],
+            ),
+            (
+                "load",
+                refresh_jobs.checkpointed(
+                    job_id, "loaded", refresh_load_stage, checkpoints, conn_details
+                ),
+                settings["load_workers"],
+            ),
+        ],
+        queue_size=settings["queue_size"],
+        max_concurrency=settings["max_concurrency"],
+    )
+    print("Stage timings:", refresh["timings"], "total seconds:", refresh["seconds"])
+    # nothing is published unless every variable was loaded
+    if refresh["errors"]:
+        stage, job, e = refresh["errors"][0]
+        print(
+            f"""{len(refresh["errors"])} variables failed, first in the {stage} stage:""",
+            job["forecast_info"]["forecast_string"],
         )
-        print(vrt)
-        assert isinstance(vrt, str)
+        raise e
+
+    for job in refresh["outputs"]:
+        forecast_info = job["forecast_info"]
+        results.append(job["download"])
+        results.append(job["psql"])
+        loaded_files.append(f"""{forecast_info["forecast_string"]}.vrt""")
+        sources[f"""{forecast_info["forecast_string"]}.vrt"""] = job["vrt"]
+
+    with TemporaryDirectory() as work_dir:
+        # switch readers over to the new runs once every variable is loaded
+        if loaded_files:
+            progress["stage"] = "publishing"
+            published = publish_current_runs(loaded_files, conn_details)
+            print("Published runs:", published)
+            for file_name in loaded_files:
+                refresh_jobs.record_checkpoint(
+                    job_id,
+                    file_name.removesuffix(".vrt"),
+                    "published",
+                    published,
+                    conn_details,
+                )
 
-        insert_variables = insert_variables_record_rotated_lat_lon(
-            forecast_info, conn_details
+        # precompute the shoveltime fields so forecasts are served without per request math,
+        # from the published runs so a run loaded by an earlier refresh or the subscriber is derived too
+        progress["stage"] = "deriving shoveltime"
+        derived_files = derive_published_runs(
+            sources, aws_bucket, conn_details, work_dir
         )
-        print(insert_variables)
+        sources.update(derived_files)
 
-        psql = load_to_postgis(
-            vrt, "public", "predictions", conn_details, srid="990001"
-        )
-        assert isinstance(psql, str)
-        print(psql)
-        results.append(psql)
+        # the API falls back to PostGIS while the local store is missing or stale
+        progress["stage"] = "refreshing local store"
+        try:
+            refresh_local_store(sources, conn_details)
+        except (AssertionError, OSError, subprocess.CalledProcessError) as e:
+            print("Error:", e)
+            results.append(f"Local store not refreshed: {e}")
 
     print("Done.")
     return results
 
 
 def delete_objects_from_bucket(
-    aws_bucket: str, file_list: list[dict[str, Any]]
+    aws_bucket: str,
+    file_list: list[dict[str, Any]],
+    dry_run: bool = False,
+    max_workers: int = DELETE_WORKERS,
 ) -> dict[str, Any]:
-    """Delete list of files from AWS bucket."""
+    """Delete list of files from AWS bucket.
+    Keys are deleted DELETE_BATCH_SIZE at a time, the most a delete_objects request takes,
+    with max_workers requests in flight. dry_run only totals what would be deleted.
+
+    Returns the deleted and failed counts, the errors of each key not deleted and the bytes reclaimed."""
+    sizes = {file["Key"]: file.get("Size", 0) for file in file_list}
+    if dry_run:
+        return {
+            "dry run": True,
+            "object count": len(sizes),
+            "bytes": sum(sizes.values()),
+        }
+
     print("Deleting AWS S3 objects...")
     s3_client = boto3.client("s3")
-    response = s3_client.delete_objects(
-        Bucket=aws_bucket,
-        Delete={"Objects": [{"Key": file["Key"]} for file in file_list]},
-    )
-    return response
+    keys = list(sizes)
+    batches = [
+        keys[start : start + DELETE_BATCH_SIZE]
+        for start in range(0, len(keys), DELETE_BATCH_SIZE)
+    ]
+
+    def delete_batch(batch: list[str]) -> dict[str, Any]:
+        return s3_client.delete_objects(
+            Bucket=aws_bucket,
+            Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True},
+        )
+
+    deleted: set[str] = set()
+    errors: list[dict[str, str]] = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(delete_batch, batch): batch for batch in batches}
+        for future in as_completed(futures):
+            batch = futures[future]
+            try:
+                response = future.result()
+            except (BotoCoreError, ClientError) as e:
+                print("Error:", e)
+                errors.extend({"Key": key, "Message": str(e)} for key in batch)
+                continue
+            # quiet mode only reports the keys which were not deleted
+            failed = response.get("Errors", [])
+            errors.extend(failed)
+            deleted.update(set(batch) - {error["Key"] for error in failed})
+
+    print(f"{len(deleted)} objects deleted, {len(errors)} errors.")
+    return {
+        "dry run": False,
+        "deleted count": len(deleted),
+        "error count": len(errors),
+        "bytes": sum(sizes[key] for key in deleted),
+        "errors": errors,
+    }
 
 
 def insert_variables_record_polar_stereo(
@@ -598,7 +1826,7 @@ def insert_variables_record_polar_stereo(
         ),
     )
 
-    with psycopg.connect(**conn_details, autocommit=True) as conn:
+    with connection_pool.connection(conn_details) as conn:
         with conn.cursor() as curr:
             res = curr.execute(sql_statement)
 
@@ -608,9 +1836,10 @@ def insert_variables_record_polar_stereo(
     }
 
 
-def insert_variables_record_rotated_lat_lon(
-    file_name_info: dict[str, str], conn_details: dict[str, str]
-) -> dict[str, Any]:
+def variables_record_rotated_lat_lon_statement(
+    file_name_info: dict[str, str]
+) -> sql.Composed:
+    """Upsert of the variables record of a rotated lat-lon run."""
     columns = [
         "filename",
         "forecast_base_string",
@@ -625,7 +1854,7 @@ def insert_variables_record_rotated_lat_lon(
     ]
     on_conflict_columns = columns[1:]
 
-    sql_statement = sql.SQL(
+    return sql.SQL(
         """INSERT INTO {table} ({columns}) VALUES (
         {val_filename},
         {val_forecast_base_string},
@@ -671,7 +1900,13 @@ def insert_variables_record_rotated_lat_lon(
         ),
     )
 
-    with psycopg.connect(**conn_details, autocommit=True) as conn:
+
+def insert_variables_record_rotated_lat_lon(
+    file_name_info: dict[str, str], conn_details: dict[str, str]
+) -> dict[str, Any]:
+    sql_statement = variables_record_rotated_lat_lon_statement(file_name_info)
+
+    with connection_pool.connection(conn_details) as conn:
         with conn.cursor() as curr:
             res = curr.execute(sql_statement)
 
@@ -682,17 +1917,40 @@ def insert_variables_record_rotated_lat_lon(
 
 
 def delete_variable_record(file_name: str, conn_details: dict[str, str]) -> list[tuple]:
-    """Deletes the records matching the VRT file name"""
-    sql_statement = sql.SQL(
-        """DELETE FROM public.variables WHERE filename = {val_filename}
-        RETURNING *"""
-    ).format(
-        val_filename=sql.Literal(file_name),
-    )
-
-    with psycopg.connect(**conn_details, autocommit=True) as conn:
-        with conn.cursor() as curr:
-            res = curr.execute(sql_statement).fetchall()
+    """Deletes the records matching the VRT file name and drops the partition of its tiles"""
+    return drop_runs([file_name], conn_details)
+
+
+def drop_runs(file_names: list[str], conn_details: dict[str, str]) -> list[tuple]:
+    """Detaches and drops the partitions of the runs (VRT file names) and deletes their records,
+    all in one transaction on one connection. Dropping a partition frees its disk at once, where
+    deleting the tiles would leave dead rows for autovacuum.
+
+    Returns the deleted variables records"""
+    if not file_names:
+        return []
+
+    with connection_pool.connection(conn_details) as conn:
+        with conn.transaction():
+            with conn.cursor() as curr:
+                # fail rather than queue live queries behind the detach
+                curr.execute("SET LOCAL lock_timeout = '10s'")
+                for file_name in file_names:
+                    # the partition and the leftovers of interrupted loads
+                    for table_name, attached in run_tables(curr, file_name):
+                        table = sql.Identifier("public", table_name)
+                        if attached:
+                            curr.execute(
+                                sql.SQL(
+                                    "ALTER TABLE public.predictions DETACH PARTITION {table}"
+                                ).format(table=table)
+                            )
+                        curr.execute(sql.SQL("DROP TABLE {table}").format(table=table))
+                res = curr.execute(
+                    """DELETE FROM public.variables WHERE filename = ANY(%s)
+                    RETURNING *""",
+                    (list(file_names),),
+                ).fetchall()
 
     return res
 
@@ -721,92 +1979,329 @@ def list_variables_records(
     return execute_sql_as_dataframe(conn_details, sql_statement)
 
 
+def run_identifier(key: str) -> str | None:
+    """forecast_string of the run a bucket object belongs to, None when the key names no run.
+    GRIB files are parsed with file_name_info, VRTs and manifests are named after their run."""
+    name = os.path.basename(key)
+    for suffix in (".manifest.json", ".vrt"):
+        if name.endswith(suffix):
+            return name.removesuffix(suffix)
+    for format in ("rotated_lat_lon", "polar_stereo"):
+        try:
+            return file_name_info(key, format)["forecast_string"]
+        except (AssertionError, ValueError, IndexError):
+            continue
+    return None
+
+
 def list_orphan_bucket_objects(
     filter_pattern: str, aws_bucket: str, conn_details: dict[str, str]
 ):
-    """Finds all orphaned bucket objects and returns the orphans containing the filter_pattern"""
+    """Finds all orphaned bucket objects and returns the orphans containing the filter_pattern.
+    An object is orphaned when the run it belongs to (see run_identifier) has no variables record,
+    objects belonging to no run are orphans too. Runs are looked up in a set, so the cost grows
+    with the number of objects only."""
     print("Searching for orphaned objects...")
-    complete_object_listing = get_s3_filelisting(aws_bucket=aws_bucket)
-
-    variables_in_postgis = list_variables_records(
-        conn_details=conn_details,
-        forecast_string_like_pattern=f"%{filter_pattern}%",
-    )
-    # print(f"""{len(variables_in_postgis["filename"])} variables in PostGIS.""")
-
-    orphaned_objects = []
-    for file in complete_object_listing:
-        orphan = True
-        if filter_pattern not in file["Key"]:
-            # print(
-            #     "Excluded by filter pattern. object name:",
-            #     file["Key"],
-            #     "filter_pattern:",
-            #     filter_pattern,
-            # )
-            continue
-        for forecast_string in variables_in_postgis["forecast_string"].values:
-            if forecast_string in file["Key"]:
-                # print(
-                #     "Valid. object name:",
-                #     file["Key"],
-                #     "forecast_string:",
-                #     forecast_string,
-                # )
-                orphan = False
-                break
-        if orphan:
-            print(
-                "Orphan. object name:",
-                file["Key"],
-                # "filter_pattern:",
-                # filter_pattern,
-            )
-            orphaned_objects.append(file)
+    runs = set(list_variables_records(conn_details=conn_details)["forecast_string"])
+
+    orphaned_objects = [
+        file
+        for file in iter_s3_objects(aws_bucket)
+        if filter_pattern in file["Key"] and run_identifier(file["Key"]) not in runs
+    ]
 
     print(f"{len(orphaned_objects)} orphaned objects.")
     return orphaned_objects
 
 
+def append_bands(
+    file_name: str,
+    increment_file_name: str,
+    band_count: int,
+    conn_details: dict[str, str],
+) -> dict[str, Any]:
+    """Appends the band of a forecast hour staged in predictions_increment to the tiles of the run (VRT file name).
+    Tiles are matched on their upper left corner, raster2pgsql cuts every file of the grid the same way.
+    Only tiles holding band_count bands are appended to, so an hour is never appended twice.
+    The staged hour is removed and the ledger entry of the run updated in the same transaction."""
+    append_statement = sql.SQL(
+        """
+        UPDATE public.predictions p
+        SET raster = ST_AddBand(p.raster, i.raster)
+        FROM public.predictions_increment i
+        WHERE p.filename = {val_filename}
+            AND i.filename = {val_increment_filename}
+            AND ST_UpperLeftX(p.raster) = ST_UpperLeftX(i.raster)
+            AND ST_UpperLeftY(p.raster) = ST_UpperLeftY(i.raster)
+            AND ST_NumBands(p.raster) = {val_band_count}
+        """
+    ).format(
+        val_filename=sql.Literal(file_name),
+        val_increment_filename=sql.Literal(increment_file_name),
+        val_band_count=sql.Literal(band_count),
+    )
+    delete_statement = sql.SQL(
+        """DELETE FROM public.predictions_increment WHERE filename = {val_increment_filename}"""
+    ).format(val_increment_filename=sql.Literal(increment_file_name))
+    # the checksum is of the tiles as first loaded and is not recomputed for every hour
+    ledger_statement = sql.SQL(
+        """UPDATE public.ingest_ledger
+        SET band_count = {val_band_count} + 1, checksum = NULL, loaded_at = now()
+        WHERE filename = {val_filename}"""
+    ).format(
+        val_filename=sql.Literal(file_name),
+        val_band_count=sql.Literal(band_count),
+    )
+
+    with connection_pool.connection(conn_details) as conn:
+        with conn.transaction():
+            with conn.cursor() as curr:
+                res = curr.execute(append_statement)
+                appended = res.rowcount
+                assert appended > 0, f"No tiles of {file_name} to append to"
+                curr.execute(delete_statement)
+                curr.execute(ledger_statement)
+
+    return {
+        "statusmessage": res.statusmessage,
+        "rowcount": appended,
+    }
+
+
+@contextmanager
+def run_lock(file_name: str, conn_details: dict[str, str]) -> Iterator[None]:
+    """Serializes the loading of a run (VRT file name) between the subscriber and full_refresh.
+    The advisory lock is held by a transaction open on a connection of its own, outside of the pool so a
+    lock holder never waits for a pooled connection held by another, and it is released if the process dies.
+    Not reentrant: a second run_lock on the same run blocks."""
+    with psycopg.connect(**conn_details, autocommit=True) as conn:
+        with conn.transaction():
+            conn.execute(
+                sql.SQL(
+                    "SELECT pg_advisory_xact_lock(hashtext({val_filename}))"
+                ).format(val_filename=sql.Literal(file_name))
+            )
+            yield
+
+
+def delete_increment(increment_file_name: str, conn_details: dict[str, str]) -> None:
+    """Removes the tiles of an hour staged in predictions_increment."""
+    with connection_pool.connection(conn_details) as conn:
+        conn.execute(
+            sql.SQL(
+                """DELETE FROM public.predictions_increment WHERE filename = {val_increment_filename}"""
+            ).format(val_increment_filename=sql.Literal(increment_file_name))
+        )
+
+
+def append_hour(
+    file_name: str,
+    key: str,
+    band_count: int,
+    aws_bucket: str,
+    conn_details: dict[str, str],
+) -> bool:
+    """Stages the file of the bucket key in predictions_increment and appends it as the band following the
+    band_count bands of the run (VRT file name), under the run's lock. Leftovers of the hour staged by a failed
+    attempt are removed first, and the staged tiles are removed again when the append fails.
+
+    Returns False when the band was appended already, by the subscriber or full_refresh"""
+    increment_file_name = os.path.basename(key)
+    with run_lock(file_name, conn_details):
+        loaded = run_band_count(file_name, conn_details)
+        if loaded > band_count:
+            return False
+        assert loaded == band_count, f"{file_name} has {loaded} hours, not {band_count}"
+
+        delete_increment(increment_file_name, conn_details)
+        try:
+            psql = load_to_postgis(
+                grib_cache.gdal_path(aws_bucket, key),
+                "public",
+                "predictions_increment",
+                conn_details,
+                srid="990001",
+                index=False,
+            )
+            assert isinstance(psql, str), psql
+            append_bands(file_name, increment_file_name, band_count, conn_details)
+        except Exception:
+            delete_increment(increment_file_name, conn_details)
+            raise
+    return True
+
+
+def append_missing_bands(
+    files: list[dict[str, Any]],
+    band_count: int,
+    file_name: str,
+    aws_bucket: str,
+    conn_details: dict[str, str],
+) -> str:
+    """Appends the hours of the files (in forecast hour order) following the band_count hours loaded
+    for the run (VRT file name), one band at a time as the subscriber does (see append_hour).
+    A published run stays served throughout, with the band count of the hours appended so far.
+
+    Returns a summary of the hours appended"""
+    appended = 0
+    for band, file in enumerate(files[band_count:], start=band_count):
+        if not append_hour(file_name, file["Key"], band, aws_bucket, conn_details):
+            continue
+        appended += 1
+        if is_run_published(file_name, conn_details):
+            publish_current_runs([file_name], conn_details)
+    return (
+        f"Appended {appended} of hours {band_count + 1} to {len(files)} of {file_name}"
+    )
+
+
+def run_band_count(file_name: str, conn_details: dict[str, str]) -> int:
+    """Number of bands (forecast hours) loaded for the run, 0 when it is not loaded."""
+    df = execute_sql_as_dataframe(
+        conn_details,
+        sql.SQL(
+            """SELECT band_count FROM public.ingest_ledger
+            WHERE filename = {val_filename}"""
+        ).format(val_filename=sql.Literal(file_name)),
+    )
+    return int(df["band_count"].iloc[0]) if len(df) > 0 else 0
+
+
+def run_status(file_name: str, conn_details: dict[str, str]) -> Optional[str]:
+    """Status of the run in the ingest ledger, 'loaded' or 'published'. None when it is not loaded."""
+    df = execute_sql_as_dataframe(
+        conn_details,
+        sql.SQL(
+            """SELECT status FROM public.ingest_ledger
+            WHERE filename = {val_filename}"""
+        ).format(val_filename=sql.Literal(file_name)),
+    )
+    return df["status"].iloc[0] if len(df) > 0 else None
+
+
+def is_run_published(file_name: str, conn_details: dict[str, str]) -> bool:
+    """True when the run (VRT file name) is in current_runs."""
+    df = execute_sql_as_dataframe(
+        conn_details,
+        sql.SQL(
+            """SELECT filename FROM public.current_runs WHERE filename = {val_filename}"""
+        ).format(val_filename=sql.Literal(file_name)),
+    )
+    return len(df) > 0
+
+
+def unpublish_stale_runs(
+    variables: list[str], conn_details: dict[str, str]
+) -> dict[str, Any]:
+    """Removes the variables from current_runs when an older run than the other published variables.
+    Used for the derived variables, which must match the runs they were computed from."""
+    sql_statement = sql.SQL(
+        """
+        DELETE FROM public.current_runs c
+        USING public.variables v
+        WHERE v.filename = c.filename
+            AND v.variable = ANY({val_variables})
+            AND c.forecast_start_timestamp < (
+                SELECT max(forecast_start_timestamp) FROM public.current_runs
+            )
+        """
+    ).format(val_variables=sql.Literal(variables))
+
+    with connection_pool.connection(conn_details) as conn:
+        with conn.cursor() as curr:
+            res = curr.execute(sql_statement)
+
+    return {
+        "statusmessage": res.statusmessage,
+        "rowcount": res.rowcount,
+    }
+
+
+def publish_current_runs(
+    file_names: list[str], conn_details: dict[str, str]
+) -> dict[str, Any]:
+    """Makes the fully loaded runs the ones served by the API.
+    All runs are swapped into the current_runs catalog in a single statement, so readers switch over atomically.
+    A run never replaces a more recent one. The ledger entries of the runs are marked published."""
+    sql_statement = sql.SQL(
+        """
+        WITH ledger AS (
+            UPDATE public.ingest_ledger SET status = 'published'
+            WHERE filename = ANY({val_filenames})
+            RETURNING filename, band_count
+        )
+        INSERT INTO public.current_runs (
+            forecast_base_string,
+            filename,
+            forecast_string,
+            forecast_start_timestamp,
+            band_count,
+            unit
+        )
+        SELECT
+            v.forecast_base_string,
+            v.filename,
+            v.forecast_string,
+            v.forecast_start_timestamp,
+            l.band_count,
+            d.unit
+        FROM variables v
+            INNER JOIN ledger l ON
+                l.filename = v.filename
+            LEFT JOIN variable_definitions d ON
+                d.model = v.model
+                AND d.variable = v.variable
+        WHERE v.filename = ANY({val_filenames})
+        ON CONFLICT (forecast_base_string) DO UPDATE
+        SET (filename, forecast_string, forecast_start_timestamp, band_count, unit, published_at) = (
+            EXCLUDED.filename,
+            EXCLUDED.forecast_string,
+            EXCLUDED.forecast_start_timestamp,
+            EXCLUDED.band_count,
+            EXCLUDED.unit,
+            now())
+        WHERE current_runs.forecast_start_timestamp <= EXCLUDED.forecast_start_timestamp
+        """
+    ).format(val_filenames=sql.Literal(file_names))
+
+    with connection_pool.connection(conn_details) as conn:
+        with conn.cursor() as curr:
+            res = curr.execute(sql_statement)
+
+    return {
+        "statusmessage": res.statusmessage,
+        "rowcount": res.rowcount,
+    }
+
+
 def list_latest_variable_records(conn_details: dict[str, str]) -> pd.DataFrame:
     """Return the most recent instance of each variable loaded."""
     sql_statement = sql.SQL(
         """
-        with latest as (
-            select
-                forecast_base_string ,
-                max(forecast_start_timestamp) as forecast_start_timestamp
-            from variables v
-            group by forecast_base_string
-        )
         select
-            v.*
+            v.*,
+            c.band_count,
+            c.unit,
+            c.published_at
         from variables v
-        inner join latest on
-            v.forecast_base_string = latest.forecast_base_string
-            and v.forecast_start_timestamp = latest.forecast_start_timestamp
+        inner join current_runs c on
+            v.filename = c.filename
     """
     )
     return execute_sql_as_dataframe(conn_details=conn_details, sql_query=sql_statement)
 
 
 def list_old_variable_records(conn_details: dict[str, str]) -> pd.DataFrame:
-    """Return out-dated instances of each variable loaded."""
+    """Return out-dated instances of each variable loaded.
+    Runs more recent than the published one (still loading) are not out-dated."""
     sql_statement = sql.SQL(
         """
-        with latest as (
-            select
-                forecast_base_string ,
-                max(forecast_start_timestamp) as forecast_start_timestamp
-            from variables v
-            group by forecast_base_string
-        )
         select
             v.*
         from variables v
-        inner join latest on
-            v.forecast_base_string = latest.forecast_base_string
-            and v.forecast_start_timestamp != latest.forecast_start_timestamp
+        inner join current_runs c on
+            v.forecast_base_string = c.forecast_base_string
+            and v.forecast_start_timestamp < c.forecast_start_timestamp
     """
     )
     return execute_sql_as_dataframe(conn_details=conn_details, sql_query=sql_statement)
@@ -817,9 +2312,9 @@ def does_prediction_data_exist(
 ) -> bool:
     sql_statement = sql.SQL(
         """
-        select distinct
+        select
 	        filename
-        from predictions p
+        from ingest_ledger
         where filename = {forecast_string}
         """
     ).format(forecast_string=sql.Literal(f"{forecast_string}.vrt"))
@@ -0,0 +1,77 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+import predictions
+
+
+class LRUCache:
+    """Thread safe, size bounded cache evicting the least recently used entry."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: OrderedDict[Hashable, Any] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+
+# Forecast responses keyed by grid cell and the forecast runs they were computed from.
+point_cache = LRUCache(int(os.environ.get("FORECAST_CACHE_SIZE", 5000)))
+
+
+async def forecast_cache_key(
+    conn_details: dict[str, str], latitude: float, longitude: float
+) -> Optional[tuple]:
+    """Returns the cache key of the coordinates: the grid cell plus the latest run of each variable.
+    None when the coordinates are outside of the grid."""
+    index = await predictions.grid_index_async(conn_details)
+    cell = index.locate(latitude, longitude)
+    if cell is None:
+        return None
+    return (*cell, index.runs)
+
+
+def invalidate() -> None:
+    """Drops all cached forecasts. Called whenever the variables table changes."""
+    point_cache.clear()
+    predictions.reset_latest_runs()
+
+
+def stats() -> dict[str, Any]:
+    return point_cache.stats()
@@ -0,0 +1,240 @@
+import os
+import re
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+
+import boto3
+
+# Local copies of the bucket's GRIB files and of the VRTs built from them, so a file downloaded
+# from the datamart is read from local disk by gdalbuildvrt and the loader rather than again from
+# the bucket through /vsis3/. The bucket stays the durable copy, files missing locally are fetched
+# from it. Objects are stored under their bucket key, which is named after the file_name_info
+# components of the file (gribs/{forecast_base_string}/{filename}).
+# The size is accounted for by the process owning the cache, processes must not share a directory:
+# each would only count its own files against the limit and evict the files of the others.
+# Files GDAL is reading are pinned (see pinned) and skipped by eviction, the cache can then grow past
+# the limit until they are released.
+CACHE_DIR = os.environ.get("GRIB_CACHE_DIR", "/tmp/grib_cache")
+# 0 disables the cache, every stage then reads the bucket through /vsis3/
+CACHE_MAX_MB = int(os.environ.get("GRIB_CACHE_MAX_MB", 8192))
+
+SOURCE_FILENAME = re.compile(r"<SourceFilename[^>]*>([^<]+)</SourceFilename>")
+
+
+class GribCache:
+    """Thread safe, size bounded file cache evicting the least recently used files.
+    Files are moved in with a rename, readers never see a partly written file.
+    Pinned files are never evicted."""
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.objects_dir = os.path.join(cache_dir, "objects")
+        self.vrt_dir = os.path.join(cache_dir, "vrt")
+        self.staging_dir = os.path.join(cache_dir, "staging")
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        # readers of each pinned path
+        self._pins: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_saved = 0
+        self.bytes_fetched = 0
+
+        for directory in (self.objects_dir, self.vrt_dir, self.staging_dir):
+            os.makedirs(directory, exist_ok=True)
+        # files left by an earlier process, oldest access first
+        existing = []
+        for directory in (self.objects_dir, self.vrt_dir):
+            for root, _, files in os.walk(directory):
+                for name in files:
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    existing.append((stat.st_atime, path, stat.st_size))
+        for _, path, size in sorted(existing):
+            self._entries[path] = size
+
+    def object_path(self, aws_bucket: str, key: str) -> str:
+        return os.path.join(self.objects_dir, aws_bucket, key)
+
+    def vrt_path(self, aws_bucket: str, output_path: str) -> str:
+        """Local VRT of a bucket VRT. Kept apart from the objects so GDAL writes absolute source paths."""
+        return os.path.join(self.vrt_dir, aws_bucket, output_path)
+
+    def staging_path(self) -> str:
+        return os.path.join(self.staging_dir, uuid.uuid4().hex)
+
+    def get(self, aws_bucket: str, key: str) -> Optional[str]:
+        """Path of the cached object, None when it is not cached."""
+        path = self.object_path(aws_bucket, key)
+        with self._lock:
+            if path in self._entries and os.path.exists(path):
+                self._entries.move_to_end(path)
+                self.hits += 1
+                self.bytes_saved += self._entries[path]
+                return path
+            # removed from the directory by hand
+            self._entries.pop(path, None)
+            self.misses += 1
+            return None
+
+    def admit(self, staged_path: str, path: str) -> str:
+        """Moves a fully written file into the cache at path, then evicts down to max_bytes.
+        The file just admitted and the pinned files are never evicted."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(staged_path, path)
+        size = os.path.getsize(path)
+        with self._lock:
+            self._entries[path] = size
+            self._entries.move_to_end(path)
+            total = sum(self._entries.values())
+            for evicted in list(self._entries):
+                if total <= self.max_bytes:
+                    break
+                if evicted == path or evicted in self._pins:
+                    continue
+                total -= self._entries.pop(evicted)
+                self.evictions += 1
+                try:
+                    os.remove(evicted)
+                except FileNotFoundError:
+                    pass
+        return path
+
+    @contextmanager
+    def pinned(self, paths: list[str]) -> Iterator[None]:
+        """Keeps the files at paths from being evicted until the block exits, including files
+        admitted while it runs. Pins are counted, each reader releases its own."""
+        with self._lock:
+            for path in paths:
+                self._pins[path] = self._pins.get(path, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                for path in paths:
+                    self._pins[path] -= 1
+                    if not self._pins[path]:
+                        del self._pins[path]
+
+    def copy_in(self, source_path: str, aws_bucket: str, key: str) -> str:
+        """Caches a local file uploaded to the bucket under key."""
+        staged = self.staging_path()
+        shutil.copyfile(source_path, staged)
+        return self.admit(staged, self.object_path(aws_bucket, key))
+
+    def fetch(self, aws_bucket: str, key: str) -> str:
+        """Path of the object, downloaded from the bucket when it is not cached."""
+        path = self.get(aws_bucket, key)
+        if path is not None:
+            return path
+
+        staged = self.staging_path()
+        try:
+            boto3.client("s3").download_file(aws_bucket, key, staged)
+            with self._lock:
+                self.bytes_fetched += os.path.getsize(staged)
+            return self.admit(staged, self.object_path(aws_bucket, key))
+        finally:
+            if os.path.exists(staged):
+                os.remove(staged)
+
+    def object_key(self, path: str) -> Optional[tuple[str, str]]:
+        """Bucket and key of a cached object path, None for paths outside of the objects."""
+        prefix = self.objects_dir + os.sep
+        if not path.startswith(prefix):
+            return None
+        aws_bucket, _, key = path.removeprefix(prefix).partition(os.sep)
+        return aws_bucket, key
+
+    def vrt_sources(self, vrt_path: str) -> list[str]:
+        """Cached objects a local VRT reads."""
+        with open(vrt_path) as f:
+            sources = SOURCE_FILENAME.findall(f.read())
+        return [source for source in sources if self.object_key(source) is not None]
+
+    def ensure_vrt_sources(self, vrt_path: str) -> None:
+        """Fetches the sources of a local VRT evicted since it was built."""
+        for source in self.vrt_sources(vrt_path):
+            self.fetch(*self.object_key(source))
+
+    def bucket_vrt(self, aws_bucket: str, vrt_path: str) -> str:
+        """XML of the local VRT with its sources pointing to the bucket, for the durable copy."""
+        with open(vrt_path) as f:
+            return f.read().replace(
+                os.path.join(self.objects_dir, aws_bucket) + os.sep,
+                f"/vsis3/{aws_bucket}/",
+            )
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size_bytes": sum(self._entries.values()),
+                "max_bytes": self.max_bytes,
+                "files": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "bytes_saved": self.bytes_saved,
+                "bytes_fetched": self.bytes_fetched,
+            }
+
+
+cache: Optional[GribCache] = (
+    GribCache(CACHE_DIR, CACHE_MAX_MB * 1024 * 1024) if CACHE_MAX_MB > 0 else None
+)
+
+
+def gdal_path(aws_bucket: str, key: str) -> str:
+    """Path GDAL reads the object from: the cached copy, or the bucket when the cache is disabled."""
+    if cache is None:
+        return f"/vsis3/{aws_bucket}/{key}"
+    return cache.fetch(aws_bucket, key)
+
+
+def vrt_gdal_path(aws_bucket: str, output_path: str) -> str:
+    """Path GDAL reads a VRT built by data_management.create_vrt from: the cached VRT, with its
+    evicted sources fetched back, or the bucket copy when it is not cached."""
+    if cache is not None:
+        path = cache.vrt_path(aws_bucket, output_path)
+        if os.path.exists(path):
+            cache.ensure_vrt_sources(path)
+            return path
+    return f"/vsis3/{aws_bucket}/{output_path}"
+
+
+@contextmanager
+def pinned(path: str) -> Iterator[str]:
+    """Pins a path returned by gdal_path or vrt_gdal_path, and the sources of a VRT, while GDAL reads it,
+    so the downloads of other loads running meanwhile cannot evict it. Files evicted before the pin are
+    fetched back. Other paths are read as they are."""
+    if cache is None:
+        yield path
+        return
+    if path.startswith(cache.vrt_dir + os.sep):
+        paths = [path, *cache.vrt_sources(path)]
+    elif cache.object_key(path) is not None:
+        paths = [path]
+    else:
+        yield path
+        return
+
+    with cache.pinned(paths):
+        for pinned_path in paths:
+            object_key = cache.object_key(pinned_path)
+            if object_key is not None:
+                cache.fetch(*object_key)
+        yield path
+
+
+def stats() -> dict[str, Any]:
+    if cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **cache.stats()}
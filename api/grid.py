@@ -0,0 +1,147 @@
+import math
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from psycopg import sql
+
+# Rotated lat-lon grid of the HRDPS (SRID 990001):
+# +proj=ob_tran +o_proj=longlat +o_lon_p=0 +o_lat_p=36.08852 +lon_0=-114.694858 +R=6371229 +no_defs
+O_LAT_P = 36.08852
+O_LON_P = 0.0
+LON_0 = -114.694858
+
+_SIN_O_LAT_P = math.sin(math.radians(O_LAT_P))
+_COS_O_LAT_P = math.cos(math.radians(O_LAT_P))
+
+
+def rotate(latitude, longitude):
+    """Transforms WGS84 coordinates into rotated grid coordinates (SRID 990001) in degrees.
+    Python equivalent of ST_Transform(ST_SetSRID(ST_MakePoint(longitude, latitude), 4326), 990001)
+    using the ob_tran forward formulas (Snyder's "Map projections: a working manual" 5-7 and 5-8b).
+
+    Accepts scalars or numpy arrays. Returns (x, y) i.e. (rotated longitude, rotated latitude)."""
+    lam = np.radians(np.subtract(longitude, LON_0))
+    phi = np.radians(latitude)
+    cos_phi = np.cos(phi)
+    cos_lam = np.cos(lam)
+
+    x = np.degrees(
+        np.arctan2(
+            cos_phi * np.sin(lam),
+            _SIN_O_LAT_P * cos_phi * cos_lam + _COS_O_LAT_P * np.sin(phi),
+        )
+    )
+    y = np.degrees(
+        np.arcsin(_SIN_O_LAT_P * np.sin(phi) - _COS_O_LAT_P * cos_phi * cos_lam)
+    )
+    return x + O_LON_P, y
+
+
+def tile_layout_query(filenames: list[str]) -> sql.Composed:
+    """Georeference of every tile of the files. Only the raster headers are read."""
+    return sql.SQL(
+        """
+        SELECT
+            rid,
+            filename,
+            ST_UpperLeftX(raster) AS upperleftx,
+            ST_UpperLeftY(raster) AS upperlefty,
+            ST_Width(raster) AS width,
+            ST_Height(raster) AS height,
+            ST_ScaleX(raster) AS scalex,
+            ST_ScaleY(raster) AS scaley
+        FROM predictions
+        WHERE filename = ANY({filenames})
+        """
+    ).format(filenames=sql.Literal(list(filenames)))
+
+
+class GridIndex:
+    """Maps coordinates to grid cells and to the tile + pixel holding them, without querying PostGIS.
+
+    Built from the tile layout (tile_layout_query) of the latest run of each variable.
+    raster2pgsql cuts every file into the same regular tiling so a cell's tile is cell // tile size.
+    Cells are (column, row) from the upper left corner of the whole grid, tile pixels are 1-based as used by ST_Value.
+    """
+
+    def __init__(self, layout: pd.DataFrame, runs: tuple):
+        # runs: (forecast_base_string, filename, forecast_start_timestamp, band_count) of the indexed files.
+        self.runs = runs
+        self.filenames = tuple(run[1] for run in runs)
+        self.tiles: dict[tuple[str, int, int], int] = {}
+        self.width = 0
+        self.height = 0
+        if len(layout) == 0:
+            return
+
+        self.scalex = float(layout["scalex"].iloc[0])
+        self.scaley = float(layout["scaley"].iloc[0])
+        self.upperleftx = float(layout["upperleftx"].min())
+        self.upperlefty = float(layout["upperlefty"].max())
+        self.tile_width = int(layout["width"].max())
+        self.tile_height = int(layout["height"].max())
+
+        columns = np.rint(
+            (layout["upperleftx"] - self.upperleftx) / self.scalex
+        ).astype(int)
+        rows = np.rint((layout["upperlefty"] - self.upperlefty) / self.scaley).astype(
+            int
+        )
+        self.width = int((columns + layout["width"]).max())
+        self.height = int((rows + layout["height"]).max())
+
+        for rid, filename, column, row in zip(
+            layout["rid"], layout["filename"], columns, rows
+        ):
+            self.tiles[
+                (filename, column // self.tile_width, row // self.tile_height)
+            ] = int(rid)
+
+    def locate(self, latitude: float, longitude: float) -> Optional[tuple[int, int]]:
+        """Returns the (column, row) grid cell of the coordinates or None when outside of the grid."""
+        if self.width == 0:
+            return None
+
+        x, y = rotate(latitude, longitude)
+        # rotated longitudes may be expressed in [0, 360) or [-180, 180)
+        x = (x - self.upperleftx) % 360 + self.upperleftx
+        column = math.floor((x - self.upperleftx) / self.scalex)
+        row = math.floor((y - self.upperlefty) / self.scaley)
+
+        if not (0 <= column < self.width and 0 <= row < self.height):
+            return None
+        return column, row
+
+    def locate_many(
+        self, latitudes: np.ndarray, longitudes: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Vectorized locate. Returns the column and row arrays, -1 where the coordinates are outside of the grid."""
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        if self.width == 0:
+            missing = np.full(latitudes.shape, -1)
+            return missing, missing.copy()
+
+        x, y = rotate(latitudes, longitudes)
+        x = (x - self.upperleftx) % 360 + self.upperleftx
+        columns = np.floor((x - self.upperleftx) / self.scalex)
+        rows = np.floor((y - self.upperlefty) / self.scaley)
+
+        inside = (
+            (columns >= 0) & (columns < self.width) & (rows >= 0) & (rows < self.height)
+        )
+        columns = np.where(inside, columns, -1).astype(int)
+        rows = np.where(inside, rows, -1).astype(int)
+        return columns, rows
+
+    def tile_pixels(self, column: int, row: int) -> list[tuple[int, int, int]]:
+        """Returns (rid, x, y) of the tile and 1-based pixel holding the cell, for each indexed file."""
+        tile_column, x = divmod(column, self.tile_width)
+        tile_row, y = divmod(row, self.tile_height)
+
+        tiles = []
+        for filename in self.filenames:
+            rid = self.tiles.get((filename, tile_column, tile_row))
+            if rid is not None:
+                tiles.append((rid, x + 1, y + 1))
+        return tiles
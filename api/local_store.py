@@ -0,0 +1,131 @@
+import json
+import os
+from typing import Any, Optional
+
+import grid
+import numpy as np
+import pandas as pd
+
+# Latest run of every variable as a (lines, samples, bands) float32 cube on local disk, written by
+# data_management.refresh_local_store. Band interleaved by pixel so the forecast hours of a cell
+# are contiguous and a lookup reads a single run of floats through the page cache, which every
+# uvicorn worker mapping the same files shares.
+STORE_DIR = os.environ.get("LOCAL_STORE_DIR", "/tmp/forecast_store")
+MANIFEST = "manifest.json"
+
+_store: Optional["LocalStore"] = None
+_store_version: Optional[tuple[str, int]] = None
+
+
+def cube_file_name(filename: str, band_count: int) -> str:
+    """Store file of the cube of a variables record (VRT file name).
+    Runs loaded incrementally gain bands, each band count gets its own file."""
+    return f"""{filename.removesuffix(".vrt")}.b{band_count}.f32"""
+
+
+def header_file_name(cube_file: str) -> str:
+    """ENVI header written by GDAL next to a cube, the extension is replaced by .hdr"""
+    return os.path.splitext(cube_file)[0] + ".hdr"
+
+
+def publish(store_dir: str, variables: list[dict[str, Any]], staged: list[str]) -> str:
+    """Moves the staged cube and header files into the store and swaps in the manifest describing
+    the runs. Every step is a rename on the same file system so readers see either the old or the
+    new store, never a partial one. Files of older runs are removed afterwards, readers still mapping
+    them keep their data until they reload.
+
+    Returns the path of the manifest."""
+    for path in staged:
+        os.replace(path, os.path.join(store_dir, os.path.basename(path)))
+
+    manifest_path = os.path.join(store_dir, MANIFEST)
+    with open(f"{manifest_path}.tmp", "w") as f:
+        json.dump({"variables": variables}, f, default=str)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+
+    referenced = {MANIFEST}
+    for variable in variables:
+        referenced.update({variable["file"], header_file_name(variable["file"])})
+    for entry in os.listdir(store_dir):
+        if entry not in referenced and entry.endswith((".f32", ".hdr")):
+            os.remove(os.path.join(store_dir, entry))
+    return manifest_path
+
+
+class LocalStore:
+    """Read only view of a published store, the cubes are memory mapped and never copied."""
+
+    def __init__(self, store_dir: str, manifest: dict[str, Any]):
+        self.variables = manifest["variables"]
+        self.runs = {
+            (variable["filename"], variable["shape"][2]) for variable in self.variables
+        }
+        self.cubes = [
+            np.memmap(
+                os.path.join(store_dir, variable["file"]),
+                dtype="<f4",
+                mode="r",
+                shape=tuple(variable["shape"]),
+            )
+            for variable in self.variables
+        ]
+
+    def serves(self, index: grid.GridIndex) -> bool:
+        """True when the store holds exactly the published runs of the index, on the same grid."""
+        published = {(run[1], run[3]) for run in index.runs}
+        return self.runs == published and all(
+            cube.shape[:2] == (index.height, index.width) for cube in self.cubes
+        )
+
+    def predictions_as_dfs(
+        self, latitude: float, longitude: float, column: int, row: int
+    ) -> list[pd.DataFrame]:
+        """Same results as predictions.predictions_query, one dataframe per variable."""
+        df_list = []
+        for variable, cube in zip(self.variables, self.cubes):
+            values = np.array(cube[row, column], dtype=np.float64)
+            if variable["nodata"] is not None:
+                values[values == variable["nodata"]] = np.nan
+            forecast_start_timestamp = pd.Timestamp(
+                variable["forecast_start_timestamp"]
+            )
+            df_list.append(
+                pd.DataFrame(
+                    {
+                        "band": np.arange(len(values)),
+                        "value": values,
+                        "unit": variable["unit"],
+                        "latitude": latitude,
+                        "longitude": longitude,
+                        "model": variable["model"],
+                        "variable": variable["variable"],
+                        "variable_description": variable["variable_description"],
+                        "leveltype": variable["leveltype"],
+                        "level": variable["level"],
+                        "forecast_start_timestamp": forecast_start_timestamp,
+                        "forecast_timestamp": forecast_start_timestamp
+                        + pd.to_timedelta(np.arange(len(values)), unit="h"),
+                    }
+                )
+            )
+        return df_list
+
+
+def current(store_dir: str = STORE_DIR) -> Optional[LocalStore]:
+    """Returns the published store, reloading it when the manifest was swapped. None when there is no store."""
+    global _store, _store_version
+    manifest_path = os.path.join(store_dir, MANIFEST)
+    try:
+        version = (store_dir, os.stat(manifest_path).st_mtime_ns)
+        if version != _store_version:
+            with open(manifest_path) as f:
+                _store = LocalStore(store_dir, json.load(f))
+            _store_version = version
+    except FileNotFoundError:
+        _store = None
+        _store_version = None
+    except (OSError, ValueError, KeyError) as e:
+        print("Local store unavailable:", e)
+        _store = None
+        _store_version = None
+    return _store
@@ -1,13 +1,22 @@
+import asyncio
+import json
 import logging
 import os
 import subprocess
+from contextlib import asynccontextmanager
 from datetime import datetime
 from typing import Any
 from urllib.parse import unquote
 
+import connection_pool
 import data_management
+import forecast_cache
 import geocoder
+import grib_cache
+import pandas as pd
 import predictions
+import refresh_jobs
+import refresh_queue
 
 # from data_management import (
 #     delete_objects_from_bucket,
@@ -22,8 +31,10 @@ import predictions
 #     list_variables_records,
 #     list_old_variable_records,
 # )
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel
 
 # Define connection details
 # password is read from .pgpass in home directory.
@@ -35,8 +46,29 @@ pg_connection_dict = {
     "host": os.environ["AWS_RDS_HOST"],
 }
 aws_bucket = os.environ["AWS_BUCKET"]
-
-app = FastAPI()
+max_batch_coordinates = int(os.environ.get("MAX_BATCH_COORDINATES", 10000))
+# 250k cells * 48 hours is ~48MB per float32 cube: with the two input cubes, the float32 and uint8
+# outputs and the response body a grid request peaks at ~250MB
+max_grid_cells = int(os.environ.get("MAX_GRID_CELLS", 250000))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Opens the shared PostGIS connection pools on start up and closes them on shut down.
+    Also runs the refresh scheduler unless REFRESH_SCHEDULE is set to 0."""
+    connection_pool.open_pool(pg_connection_dict)
+    await connection_pool.open_async_pool(pg_connection_dict)
+    scheduler = None
+    if refresh_queue.SCHEDULE_ENABLED:
+        scheduler = asyncio.create_task(refresh_queue.schedule(refreshes))
+    yield
+    if scheduler is not None:
+        scheduler.cancel()
+    await connection_pool.close_async_pool()
+    connection_pool.close_pool()
+
+
+app = FastAPI(lifespan=lifespan)
 
 origins = ["http://shouldishovel.com"]
 
@@ -54,18 +86,8 @@ def read_root():
     return {"Hello": "World"}
 
 
-@app.get("/forecast/coordinates")
-def get_forecast(
-    latitude: float,
-    longitude: float,
-):
-    """Returns the forecast for a set of coordiantes"""
-    dfs = predictions.get_predictions_as_dfs(
-        conn_details=pg_connection_dict,
-        latitude=latitude,
-        longitude=longitude,
-    )
-
+def forecast_results(dfs: list[pd.DataFrame]) -> dict[str, Any] | str:
+    """Applies the shoveltime algorithm and shapes the predictions into the forecast response."""
     # no results
     if len(dfs[0]) == 0:
         return "no results"
@@ -80,21 +102,152 @@ def get_forecast(
     return results
 
 
+@app.get("/forecast/coordinates")
+async def get_forecast(
+    latitude: float,
+    longitude: float,
+):
+    """Returns the forecast for a set of coordiantes"""
+    cache_key = await forecast_cache.forecast_cache_key(
+        conn_details=pg_connection_dict,
+        latitude=latitude,
+        longitude=longitude,
+    )
+    # outside of the forecast grid
+    if cache_key is None:
+        return "no results"
+
+    # the cache is shared by the whole grid cell, the coordinates are those of each request
+    cached = forecast_cache.point_cache.get(cache_key)
+    if cached is not None:
+        return with_coordinates(cached, latitude, longitude)
+
+    dfs = await predictions.get_predictions_as_dfs_async(
+        conn_details=pg_connection_dict,
+        latitude=latitude,
+        longitude=longitude,
+    )
+    results = forecast_results(dfs)
+    if isinstance(results, dict):
+        results = {
+            key: value
+            for key, value in results.items()
+            if key not in ("latitude", "longitude")
+        }
+
+    forecast_cache.point_cache.put(cache_key, results)
+    return with_coordinates(results, latitude, longitude)
+
+
+def with_coordinates(
+    results: dict[str, Any] | str, latitude: float, longitude: float
+) -> dict[str, Any] | str:
+    """Forecast response of a grid cell for the requested coordinates."""
+    if not isinstance(results, dict):
+        return results
+    return {"latitude": latitude, "longitude": longitude, **results}
+
+
+class Coordinates(BaseModel):
+    latitude: float
+    longitude: float
+
+
+@app.post("/forecast/coordinates/batch")
+async def get_forecast_batch(coordinates: list[Coordinates]):
+    """Returns the forecast for many coordinates using a single database query.
+
+    Results are streamed as newline delimited JSON, one line per coordinate in the order provided.
+    Coordinates without a forecast get a line with an error instead of data."""
+    if len(coordinates) > max_batch_coordinates:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {max_batch_coordinates} coordinates per request.",
+        )
+
+    results = await predictions.get_batch_predictions_async(
+        conn_details=pg_connection_dict,
+        coordinates=[(coords.latitude, coords.longitude) for coords in coordinates],
+    )
+    return StreamingResponse(
+        (json.dumps(result) + "\n" for result in results),
+        media_type="application/x-ndjson",
+    )
+
+
+@app.get("/forecast/grid")
+async def get_forecast_grid(
+    min_latitude: float,
+    min_longitude: float,
+    max_latitude: float,
+    max_longitude: float,
+    resolution: float = 0.05,
+):
+    """Returns estimated snow depth and shoveltime per hour on a regular lat/lon grid covering the bounding box, for map overlays.
+
+    The body is binary: estimated_snow_depth as little endian float32 followed by shovel_time as uint8,
+    each shaped (hours, rows, columns) in C order. Row 0 is the northern edge and column 0 the western edge,
+    cells are `resolution` degrees wide. The X-Grid-* headers describe the layout."""
+    if min_latitude >= max_latitude or min_longitude >= max_longitude:
+        raise HTTPException(status_code=422, detail="Empty bounding box.")
+    if resolution <= 0:
+        raise HTTPException(status_code=422, detail="Resolution must be positive.")
+
+    cells = ((max_latitude - min_latitude) / resolution) * (
+        (max_longitude - min_longitude) / resolution
+    )
+    if cells > max_grid_cells:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Grid of {int(cells)} cells exceeds {max_grid_cells}. Use a coarser resolution or a smaller bounding box.",
+        )
+
+    grid = await predictions.get_grid_predictions_async(
+        conn_details=pg_connection_dict,
+        min_latitude=min_latitude,
+        min_longitude=min_longitude,
+        max_latitude=max_latitude,
+        max_longitude=max_longitude,
+        resolution=resolution,
+    )
+    if grid["shape"][0] == 0:
+        raise HTTPException(
+            status_code=404,
+            detail="No forecast available. The bounding box is outside of the forecast grid.",
+        )
+    forecast_start_timestamp = grid["forecast_start_timestamp"]
+    return Response(
+        content=grid["estimated_snow_depth"].astype("<f4").tobytes()
+        + grid["shovel_time"].tobytes(),
+        media_type="application/octet-stream",
+        headers={
+            "X-Grid-Shape": ",".join(str(size) for size in grid["shape"]),
+            "X-Grid-Bounds": f"{min_longitude},{min_latitude},{max_longitude},{max_latitude}",
+            "X-Grid-Resolution": str(resolution),
+            "X-Grid-Layers": "estimated_snow_depth:float32,shovel_time:uint8",
+            "X-Forecast-Start": forecast_start_timestamp.isoformat()
+            if forecast_start_timestamp is not None
+            else "",
+        },
+    )
+
+
 @app.get("/forecast/address")
-def get_forecast_from_address(address: str):
+async def get_forecast_from_address(address: str):
     """Returns the forecast for an address"""
-    latitude, longitude = get_address_coordinates(address=address)
+    latitude, longitude = await get_address_coordinates(address=address)
     if (not latitude) or (not longitude):
         return f"Coordinates not found for address. Try being more specific."
 
-    return get_forecast(latitude, longitude)
+    return await get_forecast(latitude, longitude)
 
 
 @app.get("/address/")
-def get_address_coordinates(address: str) -> tuple[float, float]:
+async def get_address_coordinates(address: str) -> tuple[float, float]:
     """Queries geocoding API to get coordinates from address. Returns tuple of nulls if no single result was found"""
     address_unquoted = unquote(address)
-    g = geocoder.google(address_unquoted)
+    # geocoder only offers a blocking client, run it off the event loop.
+    g = await asyncio.to_thread(geocoder.google, address_unquoted)
     if g.error == "ZERO_RESULTS":
         logging.warn(f"{g.error}: {address_unquoted}")
     if g.error == "REQUEST_DENIED":
@@ -110,7 +263,7 @@ def get_address_coordinates(address: str) -> tuple[float, float]:
 def return_latest_forecast(
     forecast_hour: int,
     url_path: str = "WXO-DD/model_hrdps/continental/2.5km/grib2",
-    domain: str = "https://hpfx.collab.science.gc.ca",
+    domain: str = data_management.DATAMART_DOMAIN,
 ) -> dict[str, str]:
     """Queries the canadian weather service to determine what is the most recent forecast set available based on the folders which exists."""
     return data_management.find_latest_forecast(
@@ -120,9 +273,9 @@ def return_latest_forecast(
     )
 
 
-@app.get("/data_mangement/refresh_weather_data")
-def refresh_weather_data():
-    """Redownloads the latest available weather forecasts."""
+def refresh_task(progress: dict[str, Any]) -> list[str]:
+    """Redownloads the latest available weather forecasts, then deletes the old runs and orphaned files.
+    Runs on the refresh queue, progress is updated with the current stage."""
     variables_hrdps_polar = [
         {"variable": "SNOD", "level_type": "SFC", "level": "0"},  # Snow Depth in meters
         {
@@ -132,36 +285,61 @@ def refresh_weather_data():
         },  # Temperature 2m above ground in kelvin
     ]
 
-    variables_hrdps_rotated_lat_lon = [
-        {"variable": "TMP", "level_type": "Sfc", "level": ""},  # Temperature
-        {
-            "variable": "CONDASNOW",
-            "level_type": "Sfc",
-            "level": "",
-        },  # Conditional amount of snow
-        # {"variable": "CSNOW", "level_type": "Sfc", "level": ""}, # Probability of snow
-    ]
+    variables_hrdps_rotated_lat_lon = data_management.ROTATED_LAT_LON_VARIABLES
 
+    progress["stage"] = "testing database connection"
     db_conn_status = test_db_connection()
     if db_conn_status.returncode != 0:
-        return db_conn_status
+        raise RuntimeError(db_conn_status.stderr.decode())
 
     results = data_management.full_refresh(
         variables_hrdps_rotated_lat_lon,
         aws_bucket=aws_bucket,
         conn_details=pg_connection_dict,
         last_forecast_hour=48,
+        progress=progress,
     )
+    forecast_cache.invalidate()
 
     # delete old variables
+    progress["stage"] = "deleting old variables"
     delete_old_variables()
 
     # delete orphaned files
+    progress["stage"] = "deleting orphaned objects"
     delete_orphan_objects()
 
+    progress["stage"] = "done"
     return results
 
 
+refreshes = refresh_queue.RefreshQueue(refresh_task)
+
+
+@app.get("/data_mangement/refresh_weather_data")
+def refresh_weather_data():
+    """Queues a refresh of the latest available weather forecasts and returns its job at once.
+    While a refresh is queued or running, that job is returned instead of queueing another one.
+    Follow it with /data_management/refresh_status."""
+    return refreshes.submit("request")
+
+
+@app.get("/data_management/refresh_status")
+def refresh_status(job_id: str = ""):
+    """Returns the status, stage and elapsed seconds of the refresh job, of the last one without job_id.
+    Once the refresh has found the model run, the stages completed by each variable and the bytes
+    downloaded are included from its persistent job (refresh_run)."""
+    job = refreshes.status(job_id or None)
+    if job is None:
+        raise HTTPException(status_code=404, detail="No such refresh job.")
+
+    if job["progress"].get("refresh_job"):
+        job["refresh_run"] = refresh_jobs.job_status(
+            job["progress"]["refresh_job"], pg_connection_dict
+        )
+    return job
+
+
 @app.get("/data_management/list_s3_contents")
 def list_s3_contents(prefix: str = "") -> list[dict[str, Any]]:
     """Returns list of the S3 bucket contents filtered for files starting with the prefix."""
@@ -191,6 +369,24 @@ def test_db_connection():
     return status
 
 
+@app.get("/data_management/connection_pool_stats")
+def get_connection_pool_stats() -> dict[str, Any]:
+    """Returns the connection pool size and pool wait metrics."""
+    return connection_pool.pool_stats()
+
+
+@app.get("/data_management/forecast_cache_stats")
+def get_forecast_cache_stats() -> dict[str, Any]:
+    """Returns the forecast cache size and hit/miss/eviction counts."""
+    return forecast_cache.stats()
+
+
+@app.get("/data_management/grib_cache_stats")
+def get_grib_cache_stats() -> dict[str, Any]:
+    """Returns the GRIB file cache size, hit ratio and the bytes read locally rather than from the bucket."""
+    return grib_cache.stats()
+
+
 @app.get("/data_management/delete_objects")
 def delete_objects_with_prefix(prefix: str) -> dict[str, Any]:
     """Delete files matching the provided prefix from the AWS S3 bucket.
@@ -221,18 +417,22 @@ def get_filename_components(fullpath: str, format: str) -> dict[str, str]:
 @app.get("/data_management/delete_variable")
 def delete_variable(file_name: str):
     """Deletes the variable with the given filename."""
-    return data_management.delete_variable_record(
+    deleted = data_management.delete_variable_record(
         file_name=file_name, conn_details=pg_connection_dict
     )
+    forecast_cache.invalidate()
+    return deleted
 
 
 @app.get("/data_management/delete_old_variables")
 def delete_old_variables():
     """Deletes all old variables leaving only the latest version of each variable."""
-    results = []
-    for var in list_old_variables():
-        results.append(delete_variable(var["filename"]))
-    return results
+    deleted = data_management.drop_runs(
+        [var["filename"] for var in list_old_variables()],
+        conn_details=pg_connection_dict,
+    )
+    forecast_cache.invalidate()
+    return deleted
 
 
 @app.get("/data_management/list_variables")
@@ -254,8 +454,9 @@ def list_orphan_objects(filter_pattern: str = ""):
 
 
 @app.get("/data_management/delete_orphaned_bucket_objects")
-def delete_orphan_objects(filter_pattern: str = ""):
-    """Deletes all orphaned bucket objects."""
+def delete_orphan_objects(filter_pattern: str = "", dry_run: bool = False):
+    """Deletes all orphaned bucket objects.
+    With dry_run the objects are only counted along with the bytes deleting them would reclaim."""
     orphaned_objects = data_management.list_orphan_bucket_objects(
         filter_pattern=filter_pattern,
         aws_bucket=aws_bucket,
@@ -266,7 +467,7 @@ def delete_orphan_objects(filter_pattern: str = ""):
         return f"No orphaned objects found to be deleted."
 
     return data_management.delete_objects_from_bucket(
-        aws_bucket=aws_bucket, file_list=orphaned_objects
+        aws_bucket=aws_bucket, file_list=orphaned_objects, dry_run=dry_run
     )
 
 
@@ -0,0 +1,111 @@
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, Iterable
+
+# (name, function, worker count) of a pipeline stage. The function gets the output of the previous stage.
+Stage = tuple[str, Callable[[Any], Any], int]
+
+_DONE = object()
+
+
+def pipeline_settings_from_env() -> dict[str, int]:
+    """Parallelism of the refresh pipeline stages (see data_management.full_refresh) read from the environment."""
+    return {
+        "download_workers": int(os.environ.get("REFRESH_DOWNLOAD_WORKERS", 2)),
+        "vrt_workers": int(os.environ.get("REFRESH_VRT_WORKERS", 2)),
+        "load_workers": int(os.environ.get("REFRESH_LOAD_WORKERS", 1)),
+        "queue_size": int(os.environ.get("REFRESH_QUEUE_SIZE", 2)),
+        "max_concurrency": int(os.environ.get("REFRESH_MAX_CONCURRENCY", 4)),
+    }
+
+
+def run_pipeline(
+    items: Iterable[Any],
+    stages: list[Stage],
+    queue_size: int = 2,
+    max_concurrency: int = 0,
+) -> dict[str, Any]:
+    """Runs every item through the stages in order.
+
+    Each stage has its own worker threads reading from a bounded queue, so the stages overlap: the
+    second item goes through the first stage while the first item is in the second one.
+    max_concurrency (0 for no limit) caps the stage functions running at once across all stages.
+    An item failing in a stage is recorded and goes no further, the other items carry on.
+
+    Returns the outputs of the last stage, the errors as (stage, item, exception) and the
+    busy time of each stage."""
+    queues: list[queue.Queue] = [queue.Queue(maxsize=queue_size) for _ in stages]
+    slots = threading.BoundedSemaphore(
+        max_concurrency or sum(workers for _, _, workers in stages)
+    )
+    lock = threading.Lock()
+    outputs: list[Any] = []
+    errors: list[tuple[str, Any, Exception]] = []
+    timings = {
+        name: {"count": 0, "seconds": 0.0, "max seconds": 0.0} for name, _, _ in stages
+    }
+
+    def work(index: int) -> None:
+        name, function, _ = stages[index]
+        while True:
+            item = queues[index].get()
+            if item is _DONE:
+                return
+
+            with slots:
+                start = time.perf_counter()
+                try:
+                    output = function(item)
+                except Exception as e:
+                    print("Error:", name, e)
+                    with lock:
+                        errors.append((name, item, e))
+                    continue
+                finally:
+                    # time spent working, waiting for a slot is not counted
+                    elapsed = time.perf_counter() - start
+                    with lock:
+                        timings[name]["count"] += 1
+                        timings[name]["seconds"] += elapsed
+                        timings[name]["max seconds"] = max(
+                            timings[name]["max seconds"], elapsed
+                        )
+
+            if index + 1 < len(stages):
+                queues[index + 1].put(output)
+            else:
+                with lock:
+                    outputs.append(output)
+
+    threads = [
+        [
+            threading.Thread(target=work, args=(index,), name=f"{name}-{worker}")
+            for worker in range(workers)
+        ]
+        for index, (name, _, workers) in enumerate(stages)
+    ]
+    for stage_threads in threads:
+        for thread in stage_threads:
+            thread.start()
+
+    start = time.perf_counter()
+    for item in items:
+        queues[0].put(item)
+    # a stage is done once the previous one is done and its queue is drained
+    for index, stage_threads in enumerate(threads):
+        for _ in stage_threads:
+            queues[index].put(_DONE)
+        for thread in stage_threads:
+            thread.join()
+
+    for stage_timings in timings.values():
+        stage_timings["seconds"] = round(stage_timings["seconds"], 3)
+        stage_timings["max seconds"] = round(stage_timings["max seconds"], 3)
+    return {
+        "outputs": outputs,
+        "errors": errors,
+        "timings": timings,
+        "seconds": round(time.perf_counter() - start, 3),
+    }
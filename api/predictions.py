@@ -1,7 +1,16 @@
-from typing import Any, Mapping, Optional, Sequence, TypeAlias, Union
+import math
+import os
+import time
+from datetime import timedelta
+from typing import Any, Iterator, Mapping, Optional, Sequence, TypeAlias, Union
 
+import connection_pool
+import grid
+import local_store
+import numpy as np
 import pandas as pd
-import psycopg
+import raster_loader
+import shovel_time
 from psycopg import sql
 
 Query: TypeAlias = Union[bytes, "sql.SQL", "sql.Composed"]
@@ -14,7 +23,7 @@ def execute_sql_as_dataframe(
     params: Optional[Params] = None,
 ) -> pd.DataFrame:
     """Execute SQL query and return results in a DataFrame"""
-    with psycopg.connect(**conn_details, autocommit=True) as conn:
+    with connection_pool.connection(conn_details) as conn:
         with conn.cursor() as curr:
             res = curr.execute(sql_query, params).fetchall()
             # print(f"Rows impacted: {curr.rowcount}")
@@ -26,73 +35,156 @@ def execute_sql_as_dataframe(
             return pd.DataFrame()
 
 
-def get_predictions_as_dfs(
-    conn_details: dict[str, str], latitude: float, longitude: float
-) -> list[pd.DataFrame]:
-    """Obtains the nearest prediction to the coordinates provided returing the data in a dataframe."""
-    query = sql.SQL(
+async def execute_sql_as_dataframe_async(
+    conn_details: dict[str, str],
+    sql_query: Query,
+    params: Optional[Params] = None,
+) -> pd.DataFrame:
+    """Async version of execute_sql_as_dataframe"""
+    async with connection_pool.async_connection(conn_details) as conn:
+        async with conn.cursor() as curr:
+            await curr.execute(sql_query, params)
+            res = await curr.fetchall()
+
+            if curr.description:
+                columns = [col.name for col in curr.description]
+                df = pd.DataFrame(res, columns=columns)
+                return df
+            return pd.DataFrame()
+
+
+# Latest run of each variable and the grid index of their tiles.
+# The runs are reloaded every LATEST_RUNS_TTL seconds (or after reset_latest_runs()) and the
+# grid index is rebuilt only when a new run has been loaded.
+LATEST_RUNS_TTL = float(os.environ.get("LATEST_RUNS_TTL", 60))
+_latest_runs: Optional[tuple] = None
+_latest_runs_loaded_at = 0.0
+_grid_index: Optional[grid.GridIndex] = None
+
+
+def latest_runs_query() -> sql.SQL:
+    """Published run of each variable, see data_management.publish_current_runs."""
+    return sql.SQL(
         """
-        WITH coords AS (
-            SELECT
-                {latitude} AS latitude,
-                {longitude} AS longitude
-        ),
-        pt AS (
-            SELECT
-                ST_Transform(ST_SetSRID(ST_MakePoint(longitude, latitude), 4326), 990001) AS pt
-            FROM coords
-        ),
-        latest as (
-            SELECT
-                forecast_base_string,
-                max(forecast_start_timestamp) as forecast_start_timestamp
-            FROM variables v
-            group by forecast_base_string
-        ),
-        var_details AS (
         SELECT
-            v2.filename ,
-            v2.forecast_string ,
-            v2.variable ,
-            v2.model ,
-            v2.leveltype ,
-            v2."level" ,
-            v2.forecast_start_timestamp
-        FROM variables v2
-        INNER JOIN latest ON
-            latest.forecast_start_timestamp = v2.forecast_start_timestamp
-            AND latest.forecast_base_string = v2.forecast_base_string
+            forecast_base_string,
+            filename,
+            forecast_start_timestamp,
+            band_count
+        FROM current_runs
+        ORDER BY forecast_base_string
+        """
+    )
+
+
+def _latest_runs_are_stale() -> bool:
+    return (
+        _latest_runs is None
+        or time.monotonic() - _latest_runs_loaded_at > LATEST_RUNS_TTL
+    )
+
+
+def _set_latest_runs(df: pd.DataFrame) -> tuple:
+    global _latest_runs, _latest_runs_loaded_at
+    _latest_runs = tuple(df.itertuples(index=False, name=None))
+    _latest_runs_loaded_at = time.monotonic()
+    return _latest_runs
+
+
+def _grid_index_is_current(runs: tuple) -> bool:
+    return _grid_index is not None and _grid_index.runs == runs
+
+
+def _set_grid_index(layout: pd.DataFrame, runs: tuple) -> grid.GridIndex:
+    global _grid_index
+    _grid_index = grid.GridIndex(layout, runs)
+    print(f"Grid index built: {len(_grid_index.tiles)} tiles.")
+    return _grid_index
+
+
+def grid_index(conn_details: dict[str, str]) -> grid.GridIndex:
+    """Returns the grid index of the latest runs, building it when a new run was loaded."""
+    runs = _latest_runs
+    if _latest_runs_are_stale():
+        runs = _set_latest_runs(
+            execute_sql_as_dataframe(conn_details, latest_runs_query())
+        )
+    if _grid_index_is_current(runs):
+        return _grid_index
+
+    filenames = [run[1] for run in runs]
+    layout = execute_sql_as_dataframe(conn_details, grid.tile_layout_query(filenames))
+    return _set_grid_index(layout, runs)
+
+
+async def grid_index_async(conn_details: dict[str, str]) -> grid.GridIndex:
+    """Async version of grid_index"""
+    runs = _latest_runs
+    if _latest_runs_are_stale():
+        runs = _set_latest_runs(
+            await execute_sql_as_dataframe_async(conn_details, latest_runs_query())
+        )
+    if _grid_index_is_current(runs):
+        return _grid_index
+
+    filenames = [run[1] for run in runs]
+    layout = await execute_sql_as_dataframe_async(
+        conn_details, grid.tile_layout_query(filenames)
+    )
+    return _set_grid_index(layout, runs)
+
+
+def reset_latest_runs() -> None:
+    """Forces the latest runs to be reloaded on the next lookup. Called whenever the variables table changes."""
+    global _latest_runs
+    _latest_runs = None
+
+
+def predictions_query(
+    latitude: float, longitude: float, tiles: list[tuple[int, int, int]]
+) -> sql.Composed:
+    """Query returning the predictions of the tile pixels (rid, x, y) located by the grid index.
+    All bands of a pixel are read in one st_pixelvalues call, the band count comes from the raster itself."""
+    return sql.SQL(
+        """
+        WITH tiles (rid, x, y) AS (
+            VALUES {tiles}
         )
         SELECT
             b - 1 AS band,
-            ST_Value(raster, b, pt.pt) as value,
-            variable_definitions.unit,
-            latitude,
-            longitude,
-            var_details.model,
-            var_details.variable,
+            pixel.value,
+            c.unit,
+            {latitude} AS latitude,
+            {longitude} AS longitude,
+            v.model,
+            v.variable,
             variable_definitions.description AS "variable_description",
-            leveltype ,
-            var_details.level,
-            forecast_start_timestamp ,
-            forecast_start_timestamp + interval '1 hour' * (b -1) AS forecast_timestamp
-        FROM predictions p
-            CROSS JOIN coords
-            CROSS JOIN pt
-            CROSS JOIN generate_series(1, 48) b
-            INNER JOIN var_details on var_details.filename = p.filename
+            v.leveltype ,
+            v.level,
+            v.forecast_start_timestamp ,
+            v.forecast_start_timestamp + interval '1 hour' * (b -1) AS forecast_timestamp
+        FROM tiles
+            INNER JOIN predictions p ON p.rid = tiles.rid
+            INNER JOIN current_runs c ON c.filename = p.filename
+            INNER JOIN variables v ON v.filename = c.filename
+            CROSS JOIN LATERAL
+                unnest(st_pixelvalues(p.raster, tiles.x, tiles.y)) WITH ORDINALITY AS pixel(value, b)
             LEFT JOIN variable_definitions ON
-                var_details.variable = variable_definitions.variable
-                AND var_details.model = variable_definitions.model
-        WHERE ST_Intersects(pt.pt, st_convexhull(raster))
-        ORDER BY latitude, longitude, variable, leveltype, level, forecast_timestamp;
+                v.variable = variable_definitions.variable
+                AND v.model = variable_definitions.model
+        ORDER BY variable, leveltype, level, forecast_timestamp;
     """
     ).format(
+        tiles=sql.SQL(", ").join(
+            sql.SQL("({}, {}, {})").format(*map(sql.Literal, tile)) for tile in tiles
+        ),
         latitude=sql.Literal(latitude),
         longitude=sql.Literal(longitude),
-        # table=sql.Identifier(table),
     )
-    df = execute_sql_as_dataframe(conn_details, query)
+
+
+def split_by_variable(df: pd.DataFrame) -> list[pd.DataFrame]:
+    """Splits the query results into a dataframe per variable."""
     if len(df) > 0:
         df_list = []
         for var in df["variable"].unique():
@@ -101,6 +193,352 @@ def get_predictions_as_dfs(
     return [df]
 
 
+def get_predictions_as_dfs(
+    conn_details: dict[str, str], latitude: float, longitude: float
+) -> list[pd.DataFrame]:
+    """Obtains the nearest prediction to the coordinates provided returing the data in a dataframe.
+    Served from the local store when it holds the published runs, from PostGIS otherwise."""
+    index = grid_index(conn_details)
+    cell = index.locate(latitude, longitude)
+    store = local_store.current()
+    if cell is not None and store is not None and store.serves(index):
+        return store.predictions_as_dfs(latitude, longitude, *cell)
+
+    tiles = index.tile_pixels(*cell) if cell is not None else []
+    if not tiles:
+        return [pd.DataFrame()]
+
+    query = predictions_query(latitude, longitude, tiles)
+    return split_by_variable(execute_sql_as_dataframe(conn_details, query))
+
+
+async def get_predictions_as_dfs_async(
+    conn_details: dict[str, str], latitude: float, longitude: float
+) -> list[pd.DataFrame]:
+    """Async version of get_predictions_as_dfs"""
+    index = await grid_index_async(conn_details)
+    cell = index.locate(latitude, longitude)
+    store = local_store.current()
+    if cell is not None and store is not None and store.serves(index):
+        return store.predictions_as_dfs(latitude, longitude, *cell)
+
+    tiles = index.tile_pixels(*cell) if cell is not None else []
+    if not tiles:
+        return [pd.DataFrame()]
+
+    query = predictions_query(latitude, longitude, tiles)
+    return split_by_variable(await execute_sql_as_dataframe_async(conn_details, query))
+
+
+def batch_predictions_query(pixels: list[tuple[int, int, int, int]]) -> sql.Composed:
+    """Set based version of predictions_query.
+    Returns one row per (cell, variable) with all band values in an array, for the (cell, rid, x, y) pixels."""
+    cells, rids, xs, ys = zip(*pixels)
+    return sql.SQL(
+        """
+        WITH pixels AS (
+            SELECT *
+            FROM unnest({cells}::int[], {rids}::int[], {xs}::int[], {ys}::int[]) AS t(cell, rid, x, y)
+        )
+        SELECT
+            pixels.cell,
+            v.variable,
+            c.unit,
+            c.forecast_start_timestamp,
+            st_pixelvalues(p.raster, pixels.x, pixels.y) AS values
+        FROM pixels
+            INNER JOIN predictions p ON p.rid = pixels.rid
+            INNER JOIN current_runs c ON c.filename = p.filename
+            INNER JOIN variables v ON v.filename = c.filename
+        """
+    ).format(
+        cells=sql.Literal(list(cells)),
+        rids=sql.Literal(list(rids)),
+        xs=sql.Literal(list(xs)),
+        ys=sql.Literal(list(ys)),
+    )
+
+
+def column_name(variable: str, unit: str) -> str:
+    """Name of a variable's values in the results.
+    Raw forecasts are named after their unit (C, mm, ...), or the variable when it has none, derived variables after
+    the shoveltime field they hold."""
+    return shovel_time.DERIVED_VARIABLES.get(
+        variable, unit if isinstance(unit, str) else variable
+    )
+
+
+def shovel_time_fields(columns: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+    """Shoveltime fields of the (..., hours) arrays keyed by column_name.
+    Uses the fields derived at ingest when they were loaded, otherwise computes them from snowfall and temperature.
+    """
+    derived = shovel_time.DERIVED_VARIABLES.values()
+    if all(field in columns for field in derived):
+        return {
+            "estimated_snow_depth": columns["estimated_snow_depth"],
+            "shovel_time": columns["shovel_time"] >= 1,
+        }
+    if "mm" in columns and "C" in columns:
+        return shovel_time.shovel_time_fields(columns["mm"], columns["C"])
+    return {}
+
+
+def _json_values(values: np.ndarray) -> list:
+    """Array as a JSON friendly list, NaN (nodata) becomes null."""
+    if values.dtype.kind != "f":
+        return values.tolist()
+    return [None if math.isnan(value) else value for value in values.tolist()]
+
+
+async def get_batch_predictions_async(
+    conn_details: dict[str, str], coordinates: list[tuple[float, float]]
+) -> Iterator[dict[str, Any]]:
+    """Forecasts many (latitude, longitude) coordinates with a single query.
+    Coordinates are grouped by grid cell, each cell's pixels are read once and the shoveltime algorithm
+    is applied to all cells in one vectorized call.
+
+    Returns an iterator of the results in the order of the coordinates, with an error for coordinates without predictions.
+    """
+    index = await grid_index_async(conn_details)
+    latitudes, longitudes = np.array(coordinates, dtype=np.float64).reshape(-1, 2).T
+    columns, rows = index.locate_many(latitudes, longitudes)
+    inside = columns >= 0
+
+    # positions of the unique cells, -1 outside of the grid
+    cell_ids = rows * index.width + columns
+    unique_cells, inverse = np.unique(cell_ids[inside], return_inverse=True)
+    point_cells = np.full(len(coordinates), -1)
+    point_cells[inside] = inverse
+
+    pixels = [
+        (position, *tile)
+        for position, cell_id in enumerate(unique_cells.tolist())
+        for tile in index.tile_pixels(cell_id % index.width, cell_id // index.width)
+    ]
+    df = pd.DataFrame(
+        columns=["cell", "variable", "unit", "forecast_start_timestamp", "values"]
+    )
+    if pixels:
+        df = await execute_sql_as_dataframe_async(
+            conn_details, batch_predictions_query(pixels)
+        )
+
+    # (cells, hours) matrix of each variable, NaN where a cell has no data
+    hours = max((len(values) for values in df["values"]), default=0)
+    matrices = {}
+    # the unit comes from a LEFT JOIN, variables without one are kept
+    for (variable, unit), variable_df in df.groupby(["variable", "unit"], dropna=False):
+        matrix = np.full((len(unique_cells), hours), np.nan)
+        for cell, values in zip(variable_df["cell"], variable_df["values"]):
+            matrix[cell, : len(values)] = np.array(values, dtype=np.float64)
+        matrices[column_name(variable, unit)] = matrix
+    start_timestamps = df.groupby("cell")["forecast_start_timestamp"].min()
+    fields = shovel_time_fields(matrices)
+
+    def results() -> Iterator[dict[str, Any]]:
+        for (latitude, longitude), cell in zip(coordinates, point_cells.tolist()):
+            if cell < 0 or cell not in start_timestamps.index:
+                yield {
+                    "latitude": latitude,
+                    "longitude": longitude,
+                    "error": "No forecast available. Coordinates are outside of the forecast grid.",
+                }
+                continue
+
+            forecast_start_timestamp = start_timestamps[cell]
+            data = {
+                "band": list(range(hours)),
+                "forecast_timestamp": [
+                    (forecast_start_timestamp + timedelta(hours=band)).isoformat()
+                    for band in range(hours)
+                ],
+            }
+            for name, matrix in {**matrices, **fields}.items():
+                data[name] = _json_values(matrix[cell])
+
+            yield {
+                "latitude": latitude,
+                "longitude": longitude,
+                "forecast_start_timestamp": forecast_start_timestamp.isoformat(),
+                "data": data,
+            }
+
+    return results()
+
+
+# Raw forecasts the shoveltime fields are computed from when the derived variables are not loaded
+SHOVEL_TIME_INPUTS = ("CONDASNOW", "TMP")
+
+
+def grid_query(
+    min_latitude: float,
+    min_longitude: float,
+    max_latitude: float,
+    max_longitude: float,
+    resolution: float,
+) -> sql.Composed:
+    """Query resampling the tiles covering the bounding box onto a regular lat/lon (4326) grid of the given resolution.
+    Only the variables shovel_time_fields reads are selected: the derived variables when they are all
+    published, SHOVEL_TIME_INPUTS otherwise.
+    Each tile is clipped and warped on its own so the database never holds more than a tile at a time.
+    Returns one row per tile with its bands as raster WKB, see raster_loader.raster_bands."""
+    return sql.SQL(
+        """
+        WITH bbox AS (
+            SELECT
+                ST_MakeEnvelope({min_longitude}, {min_latitude}, {max_longitude}, {max_latitude}, 4326) AS geom,
+                ST_Transform(
+                    ST_Segmentize(ST_MakeEnvelope({min_longitude}, {min_latitude}, {max_longitude}, {max_latitude}, 4326), {resolution}),
+                    990001
+                ) AS geom_990001,
+                ST_MakeEmptyRaster(1, 1, {min_longitude}, {max_latitude}, {resolution}, -{resolution}, 0, 0, 4326) AS alignto
+        ),
+        published AS (
+            SELECT v.variable, c.filename, c.unit, c.forecast_start_timestamp, c.band_count
+            FROM current_runs c
+                INNER JOIN variables v ON v.filename = c.filename
+            WHERE v.variable = ANY({derived}) OR v.variable = ANY({inputs})
+        ),
+        served AS (
+            SELECT * FROM published
+            WHERE variable = ANY(
+                CASE WHEN (SELECT count(*) FROM published WHERE variable = ANY({derived})) = {derived_count}
+                THEN {derived} ELSE {inputs} END
+            )
+        ),
+        resampled AS (
+            SELECT
+                s.variable,
+                s.unit,
+                s.forecast_start_timestamp,
+                max(s.band_count) OVER () AS hours,
+                ST_Clip(
+                    ST_Transform(ST_Clip(p.raster, bbox.geom_990001, true), bbox.alignto),
+                    bbox.geom,
+                    true
+                ) AS raster
+            FROM served s
+                INNER JOIN predictions p ON p.filename = s.filename
+                CROSS JOIN bbox
+            WHERE ST_Intersects(st_convexhull(p.raster), bbox.geom_990001)
+        )
+        SELECT
+            variable,
+            unit,
+            forecast_start_timestamp,
+            hours,
+            ST_AsBinary(raster) AS wkb
+        FROM resampled
+        WHERE raster IS NOT NULL
+        """
+    ).format(
+        min_latitude=sql.Literal(min_latitude),
+        min_longitude=sql.Literal(min_longitude),
+        max_latitude=sql.Literal(max_latitude),
+        max_longitude=sql.Literal(max_longitude),
+        resolution=sql.Literal(resolution),
+        derived=sql.Literal(list(shovel_time.DERIVED_VARIABLES)),
+        derived_count=sql.Literal(len(shovel_time.DERIVED_VARIABLES)),
+        inputs=sql.Literal(list(SHOVEL_TIME_INPUTS)),
+    )
+
+
+async def get_grid_predictions_async(
+    conn_details: dict[str, str],
+    min_latitude: float,
+    min_longitude: float,
+    max_latitude: float,
+    max_longitude: float,
+    resolution: float,
+    chunk_cells: int = 10000,
+    fetch_tiles: int = 100,
+) -> dict[str, Any]:
+    """Estimated snow depth and shoveltime per hour on a regular lat/lon grid covering the bounding box.
+    Row 0 is the northern edge and column 0 the western edge. The grid has no hours when no published
+    tile covers the bounding box.
+
+    The tiles are streamed from a server side cursor fetch_tiles at a time and pasted into the cubes
+    as they arrive, and the shoveltime algorithm runs over chunk_cells cells at a time, so beyond
+    the inputs and the float32 / uint8 outputs memory use does not grow with the size of the grid."""
+    # rounded first so floating point noise does not add a row or column
+    width = math.ceil(round((max_longitude - min_longitude) / resolution, 6))
+    height = math.ceil(round((max_latitude - min_latitude) / resolution, 6))
+
+    # paste the resampled tiles into a (hours, height, width) cube per variable
+    cubes: dict[str, np.ndarray] = {}
+    hours = 0
+    forecast_start_timestamp = None
+    async with connection_pool.async_connection(conn_details) as conn:
+        # server side cursors live in a transaction, the connection is in autocommit mode
+        async with conn.transaction():
+            async with conn.cursor(name="grid_tiles", binary=True) as curr:
+                curr.itersize = fetch_tiles
+                await curr.execute(
+                    grid_query(
+                        min_latitude,
+                        min_longitude,
+                        max_latitude,
+                        max_longitude,
+                        resolution,
+                    )
+                )
+                async for variable, unit, start_timestamp, hours, wkb in curr:
+                    if (
+                        forecast_start_timestamp is None
+                        or start_timestamp < forecast_start_timestamp
+                    ):
+                        forecast_start_timestamp = start_timestamp
+                    cube = cubes.setdefault(
+                        column_name(variable, unit),
+                        np.full((hours, height, width), np.nan, dtype=np.float32),
+                    )
+                    upperleftx, upperlefty, values = raster_loader.raster_bands(wkb)
+                    column = round((upperleftx - min_longitude) / resolution)
+                    top = round((max_latitude - upperlefty) / resolution)
+                    target = cube[
+                        : values.shape[0],
+                        max(top, 0) : top + values.shape[1],
+                        max(column, 0) : column + values.shape[2],
+                    ]
+                    source = values[
+                        : target.shape[0],
+                        max(-top, 0) : max(-top, 0) + target.shape[1],
+                        max(-column, 0) : max(-column, 0) + target.shape[2],
+                    ]
+                    np.copyto(target, source, where=np.isnan(target))
+
+    estimated_snow_depth = np.full((hours, height, width), np.nan, dtype=np.float32)
+    shovel = np.zeros((hours, height, width), dtype=np.uint8)
+    # outside of the forecast grid, or nothing published
+    if hours == 0:
+        return {
+            "forecast_start_timestamp": None,
+            "shape": (hours, height, width),
+            "estimated_snow_depth": estimated_snow_depth,
+            "shovel_time": shovel,
+        }
+    # (points, hours) views for the kernel
+    columns = {name: cube.reshape(hours, -1).T for name, cube in cubes.items()}
+    depth_out = estimated_snow_depth.reshape(hours, -1).T
+    shovel_out = shovel.reshape(hours, -1).T
+    for start in range(0, width * height, chunk_cells):
+        chunk = slice(start, start + chunk_cells)
+        fields = shovel_time_fields(
+            {name: points[chunk] for name, points in columns.items()}
+        )
+        if not fields:
+            break
+        depth_out[chunk] = fields["estimated_snow_depth"]
+        shovel_out[chunk] = fields["shovel_time"]
+
+    return {
+        "forecast_start_timestamp": forecast_start_timestamp,
+        "shape": (hours, height, width),
+        "estimated_snow_depth": estimated_snow_depth,
+        "shovel_time": shovel,
+    }
+
+
 def df_details(df: pd.DataFrame) -> dict:
     for col in ["value", "band", "forecast_timestamp"]:
         assert col in df.columns
@@ -112,67 +550,25 @@ def format_predictions(df_list: list[pd.DataFrame]) -> pd.DataFrame:
     if len(df_list[0]) == 0:
         return df_list[0]
 
-    # https://en.wikipedia.org/wiki/Enthalpy_of_fusion
-    LATENT_HEAT_OF_FUSION = 333.55  # joules per gram needed to change phase of water from solid to liquid with no change in temperature
-
-    # https://glossary.ametsoc.org/wiki/Snow_density#:~:text=Freshly%20fallen%20snow%20usually%20has,American%20Meteorological%20Society%20(AMS).
-    SNOW_DENSITY = 0.2  # Conservative estimate.
-
-    # Rough estimate based on little to no airflow. https://www.engineeringtoolbox.com/convective-heat-transfer-d_430.html
-    HEAT_TRANSFER_COEFFICIENT = (
-        25  # joules per second per square meter for each K of temperature difference.
-    )
-
-    SHOVEL_DEPTH_THRESHOLD = 10  # millimeters
-
     def df_format(df: pd.DataFrame) -> pd.DataFrame:
-        for col in ["band", "forecast_timestamp", "value", "unit"]:
+        for col in ["band", "forecast_timestamp", "value", "variable", "unit"]:
             assert col in df.columns
 
+        details = df_details(df)
         return (
             df.loc[:, ["band", "forecast_timestamp", "value"]]
-            .rename(columns={"value": df_details(df)["unit"]})
+            .rename(
+                columns={"value": column_name(details["variable"], details["unit"])}
+            )
             .set_index(["band", "forecast_timestamp"])
         )
 
-    def energy_balance(df: pd.DataFrame) -> list:
-        for col in ["snow_latent_heat_equivalent", "interval_heat_transfer_potential"]:
-            assert col in df.columns
-
-        energy_balance = []
-        for row in combined_df.itertuples():
-            incremental_latent_energy = row.snow_latent_heat_equivalent + min(
-                row.interval_heat_transfer_potential, 0
-            )
-            if not energy_balance:
-                energy_balance.append(max(incremental_latent_energy, 0))
-                continue
-            energy_balance.append(
-                max(energy_balance[-1] + incremental_latent_energy, 0)
-            )
-        return energy_balance
-
     # Main logic starts here
     combined_df = pd.concat([df_format(df) for df in df_list], axis="columns")
-    # 1 mm of precipitation over 1 sqm = 1 liter which is approx 1kg. Snow has a lower density and we want the result in grams.
-    combined_df["snow_weight"] = combined_df["mm"] * SNOW_DENSITY * 1000
-    combined_df["snow_latent_heat_equivalent"] = (
-        combined_df["snow_weight"] * LATENT_HEAT_OF_FUSION
-    )
-    combined_df["interval_heat_transfer_potential"] = (
-        60 * 60 * HEAT_TRANSFER_COEFFICIENT * combined_df["C"] * -1
-    )
     combined_df = combined_df.assign(
-        snow_latent_heat_balance=energy_balance(combined_df)
-    )
-    combined_df["estimated_snow_depth"] = (
-        combined_df["snow_latent_heat_balance"]
-        / LATENT_HEAT_OF_FUSION
-        / SNOW_DENSITY
-        / 1000
-    )
-    combined_df["shovel_time"] = (
-        combined_df["estimated_snow_depth"] >= SHOVEL_DEPTH_THRESHOLD
+        **shovel_time_fields(
+            {column: combined_df[column].to_numpy() for column in combined_df.columns}
+        )
     )
 
     return combined_df.reset_index()
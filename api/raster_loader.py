@@ -0,0 +1,203 @@
+import json
+import os
+import struct
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Iterator, Optional
+
+import connection_pool
+import numpy as np
+from psycopg import sql
+
+# Loads rasters into PostGIS without raster2pgsql | psql: the tiles are encoded as PostGIS raster WKB
+# in process and streamed over a pooled connection with a binary COPY.
+# https://github.com/postgis/postgis/blob/master/raster/doc/RFC2-WellKnownBinaryFormat
+TILE_SIZE = int(os.environ.get("LOAD_TILE_SIZE", 128))
+ENCODE_WORKERS = int(os.environ.get("LOAD_ENCODE_WORKERS", 4))
+
+WKB_LITTLE_ENDIAN = 1
+WKB_VERSION = 0
+PIXEL_TYPE_32BF = 10
+PIXEL_TYPE_64BF = 11
+FLOAT_PIXEL_TYPES = {PIXEL_TYPE_32BF: "<f4", PIXEL_TYPE_64BF: "<f8"}
+BAND_HAS_NODATA = 0x40
+# endianness, version, band count, scale x/y, upper left x/y, skew x/y, srid, width, height
+WKB_HEADER = struct.Struct("<BHHddddddiHH")
+WKB_BAND_HEADER = struct.Struct("<Bf")
+
+
+def raster_metadata(dataset_path: str) -> dict[str, Any]:
+    """Size, georeference and nodata values of a GDAL dataset, read with gdalinfo."""
+    gdalinfo = subprocess.run(
+        ["gdalinfo", "-json", dataset_path], capture_output=True, check=True
+    )
+    info = json.loads(gdalinfo.stdout)
+    return {
+        "width": info["size"][0],
+        "height": info["size"][1],
+        "geotransform": info["geoTransform"],
+        "nodata": [band.get("noDataValue") for band in info["bands"]],
+    }
+
+
+def raster_wkb(
+    bands: np.ndarray,
+    geotransform: list[float],
+    srid: int,
+    nodata: list[Optional[float]],
+) -> bytes:
+    """Encodes a (bands, height, width) array as little endian float32 PostGIS raster WKB.
+    geotransform is the GDAL geotransform of the upper left pixel."""
+    band_count, height, width = bands.shape
+    upperleftx, scalex, skewx, upperlefty, skewy, scaley = geotransform
+    parts = [
+        WKB_HEADER.pack(
+            WKB_LITTLE_ENDIAN,
+            WKB_VERSION,
+            band_count,
+            scalex,
+            scaley,
+            upperleftx,
+            upperlefty,
+            skewx,
+            skewy,
+            srid,
+            width,
+            height,
+        )
+    ]
+    for band, band_nodata in zip(bands, nodata):
+        if band_nodata is None:
+            parts.append(WKB_BAND_HEADER.pack(PIXEL_TYPE_32BF, 0))
+        else:
+            parts.append(
+                WKB_BAND_HEADER.pack(PIXEL_TYPE_32BF | BAND_HAS_NODATA, band_nodata)
+            )
+        parts.append(np.ascontiguousarray(band, dtype="<f4").tobytes())
+    return b"".join(parts)
+
+
+def raster_bands(wkb: bytes) -> tuple[float, float, np.ndarray]:
+    """Decodes little endian float PostGIS raster WKB (ST_AsBinary of the tiles), 32BF as written by raster_wkb
+    or 64BF as written by raster2pgsql from GRIB files.
+
+    Returns the upper left x and y and the (bands, height, width) float32 values with nodata as NaN"""
+    (
+        endianness,
+        _,
+        band_count,
+        _,
+        _,
+        upperleftx,
+        upperlefty,
+        _,
+        _,
+        _,
+        width,
+        height,
+    ) = WKB_HEADER.unpack_from(wkb)
+    assert endianness == WKB_LITTLE_ENDIAN, "WKB is not little endian"
+    bands = np.empty((band_count, height, width), dtype=np.float32)
+    offset = WKB_HEADER.size
+    for band in range(band_count):
+        flags = wkb[offset]
+        pixel_type = flags & 0x0F
+        assert (
+            pixel_type in FLOAT_PIXEL_TYPES
+        ), f"Band pixel type {pixel_type} is not 32BF or 64BF"
+        dtype = np.dtype(FLOAT_PIXEL_TYPES[pixel_type])
+        band_nodata = np.frombuffer(wkb, dtype=dtype, count=1, offset=offset + 1)[0]
+        offset += 1 + dtype.itemsize
+        values = np.frombuffer(
+            wkb, dtype=dtype, count=width * height, offset=offset
+        ).reshape(height, width)
+        offset += dtype.itemsize * width * height
+        bands[band] = values
+        if flags & BAND_HAS_NODATA:
+            bands[band][values == band_nodata] = np.nan
+    return upperleftx, upperlefty, bands
+
+
+def tile_windows(
+    width: int, height: int, tile_size: int
+) -> Iterator[tuple[int, int, int, int]]:
+    """(row, column, height, width) of the tiles cutting the grid from its upper left corner,
+    row by row. Tiles on the right and bottom edges are cut short like raster2pgsql does."""
+    for row in range(0, height, tile_size):
+        for column in range(0, width, tile_size):
+            yield row, column, min(tile_size, height - row), min(
+                tile_size, width - column
+            )
+
+
+def encode_tiles(
+    cube: np.ndarray,
+    metadata: dict[str, Any],
+    srid: int,
+    tile_size: int = TILE_SIZE,
+    workers: int = ENCODE_WORKERS,
+) -> Iterator[bytes]:
+    """WKB of every tile of the (bands, lines, samples) cube, in tile_windows order.
+    Tiles are encoded by a pool of threads a batch at a time, so only a few batches are ever held in memory."""
+    upperleftx, scalex, skewx, upperlefty, skewy, scaley = metadata["geotransform"]
+
+    def encode(window: tuple[int, int, int, int]) -> bytes:
+        row, column, height, width = window
+        geotransform = [
+            upperleftx + column * scalex + row * skewx,
+            scalex,
+            skewx,
+            upperlefty + column * skewy + row * scaley,
+            skewy,
+            scaley,
+        ]
+        return raster_wkb(
+            cube[:, row : row + height, column : column + width],
+            geotransform,
+            srid,
+            metadata["nodata"],
+        )
+
+    windows = list(tile_windows(metadata["width"], metadata["height"], tile_size))
+    batch_size = workers * 4
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for start in range(0, len(windows), batch_size):
+            yield from executor.map(encode, windows[start : start + batch_size])
+
+
+def copy_tiles(
+    tiles: Iterator[bytes],
+    file_name: str,
+    schema: str,
+    table_name: str,
+    conn_details: dict[str, str],
+) -> dict[str, Any]:
+    """Streams the WKB tiles into a temporary bytea table with a binary COPY and inserts them as rasters,
+    in a single transaction. The raster type has no binary input so ST_RastFromWKB does the conversion."""
+    with connection_pool.connection(conn_details) as conn:
+        with conn.transaction():
+            with conn.cursor() as curr:
+                curr.execute(
+                    """CREATE TEMPORARY TABLE raster_wkb_staging (
+                        wkb bytea NOT NULL,
+                        filename text NOT NULL
+                    ) ON COMMIT DROP"""
+                )
+                with curr.copy(
+                    "COPY raster_wkb_staging (wkb, filename) FROM STDIN (FORMAT BINARY)"
+                ) as copy:
+                    copy.set_types(["bytea", "text"])
+                    for wkb in tiles:
+                        copy.write_row((wkb, file_name))
+
+                res = curr.execute(
+                    sql.SQL(
+                        """INSERT INTO {table} (raster, filename)
+                        SELECT ST_RastFromWKB(wkb), filename FROM raster_wkb_staging"""
+                    ).format(table=sql.Identifier(schema, table_name))
+                )
+
+    return {
+        "statusmessage": res.statusmessage,
+        "rowcount": res.rowcount,
+    }
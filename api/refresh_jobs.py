@@ -0,0 +1,163 @@
+from typing import Any, Callable, Optional
+
+import connection_pool
+from predictions import execute_sql_as_dataframe
+from psycopg import sql
+from psycopg.types.json import Jsonb
+
+# Refreshes are persistent jobs, one per model run, with a checkpoint per variable run and stage
+# (tables refresh_jobs and refresh_checkpoints). A refresh of a run already attempted resumes the
+# job: every stage with a checkpoint is skipped and its recorded output reused.
+STAGES = ("discovered", "downloaded", "vrt_built", "loaded", "published")
+
+
+def job_id(date: str, model_run: str) -> str:
+    """Identifier of the refresh job of a model run, the run prefix of its file names (YYYYMMDDTHHZ)."""
+    return f"{date}T{model_run}Z"
+
+
+def start_job(job_id: str, conn_details: dict[str, str]) -> dict[str, Any]:
+    """Creates the job of the model run, or marks an earlier attempt as running again.
+
+    Returns the job record"""
+    sql_statement = sql.SQL(
+        """
+        INSERT INTO public.refresh_jobs (job_id, status)
+        VALUES ({val_job_id}, 'running')
+        ON CONFLICT (job_id) DO UPDATE
+        SET (status, error, attempts, updated_at) = (
+            'running', NULL, refresh_jobs.attempts + 1, now())
+        RETURNING *
+        """
+    ).format(val_job_id=sql.Literal(job_id))
+    return execute_sql_as_dataframe(conn_details, sql_statement).to_dict("records")[0]
+
+
+def finish_job(
+    job_id: str, conn_details: dict[str, str], error: Optional[Exception] = None
+) -> None:
+    """Marks the job completed, or failed with the error."""
+    sql_statement = sql.SQL(
+        """
+        UPDATE public.refresh_jobs
+        SET (status, error, updated_at) = ({val_status}, {val_error}, now())
+        WHERE job_id = {val_job_id}
+        """
+    ).format(
+        val_job_id=sql.Literal(job_id),
+        val_status=sql.Literal("failed" if error else "completed"),
+        val_error=sql.Literal(repr(error) if error else None),
+    )
+    with connection_pool.connection(conn_details) as conn:
+        conn.execute(sql_statement)
+
+
+def job_checkpoints(
+    job_id: str, conn_details: dict[str, str]
+) -> dict[tuple[str, str], Any]:
+    """Outputs of the completed stages of the job by (forecast_string, stage)."""
+    df = execute_sql_as_dataframe(
+        conn_details,
+        sql.SQL(
+            """SELECT forecast_string, stage, output FROM public.refresh_checkpoints
+            WHERE job_id = {val_job_id}"""
+        ).format(val_job_id=sql.Literal(job_id)),
+    )
+    return {
+        (row["forecast_string"], row["stage"]): row["output"]
+        for row in df.to_dict("records")
+    }
+
+
+def record_checkpoint(
+    job_id: str,
+    forecast_string: str,
+    stage: str,
+    output: Any,
+    conn_details: dict[str, str],
+) -> None:
+    """Records the completion of a stage of a variable run with its JSON serializable output."""
+    assert stage in STAGES, stage
+    sql_statement = sql.SQL(
+        """
+        INSERT INTO public.refresh_checkpoints (job_id, forecast_string, stage, output)
+        VALUES ({val_job_id}, {val_forecast_string}, {val_stage}, {val_output})
+        ON CONFLICT (job_id, forecast_string, stage) DO UPDATE
+        SET (output, completed_at) = (EXCLUDED.output, now())
+        """
+    ).format(
+        val_job_id=sql.Literal(job_id),
+        val_forecast_string=sql.Literal(forecast_string),
+        val_stage=sql.Literal(stage),
+        val_output=sql.Literal(Jsonb(output)),
+    )
+    with connection_pool.connection(conn_details) as conn:
+        conn.execute(sql_statement)
+
+
+def checkpointed(
+    job_id: str,
+    stage: str,
+    function: Callable[[dict[str, Any]], dict[str, Any]],
+    checkpoints: dict[tuple[str, str], Any],
+    conn_details: dict[str, str],
+    restore: Optional[Callable[[dict[str, Any]], dict[str, Any]]] = None,
+) -> Callable[[dict[str, Any]], dict[str, Any]]:
+    """Wraps a data_management.full_refresh pipeline stage so it is skipped when the job has a
+    checkpoint for it, the recorded output being merged into the job instead. Otherwise the keys the
+    stage adds to the job are recorded as its checkpoint once it succeeds.
+    restore adjusts a job rebuilt from a checkpoint, for outputs which may not be valid anymore."""
+
+    def run(job: dict[str, Any]) -> dict[str, Any]:
+        forecast_string = job["forecast_info"]["forecast_string"]
+        output = checkpoints.get((forecast_string, stage))
+        if output is not None:
+            print("Checkpoint", stage, "resumed:", forecast_string)
+            job = {**job, **output}
+            return restore(job) if restore else job
+
+        result = function(job)
+        record_checkpoint(
+            job_id,
+            forecast_string,
+            stage,
+            {key: value for key, value in result.items() if key not in job},
+            conn_details,
+        )
+        return result
+
+    return run
+
+
+def job_status(job_id: str, conn_details: dict[str, str]) -> Optional[dict[str, Any]]:
+    """The job record with the stages completed by each variable run and the bytes of the files
+    downloaded so far, with those actually transferred. None when there is no such job."""
+    jobs = execute_sql_as_dataframe(
+        conn_details,
+        sql.SQL("SELECT * FROM public.refresh_jobs WHERE job_id = {val_job_id}").format(
+            val_job_id=sql.Literal(job_id)
+        ),
+    ).to_dict("records")
+    if not jobs:
+        return None
+
+    stages: dict[str, list[str]] = {}
+    downloaded_bytes = 0
+    transferred_bytes = 0
+    for (forecast_string, stage), output in job_checkpoints(
+        job_id, conn_details
+    ).items():
+        stages.setdefault(forecast_string, []).append(stage)
+        if stage == "downloaded":
+            for file in output["manifest"]["files"]:
+                downloaded_bytes += file["Size"]
+                transferred_bytes += file["Size"] if file.get("transferred") else 0
+    return {
+        **jobs[0],
+        "stages": {
+            forecast_string: sorted(completed, key=STAGES.index)
+            for forecast_string, completed in stages.items()
+        },
+        "downloaded bytes": downloaded_bytes,
+        "transferred bytes": transferred_bytes,
+    }
@@ -0,0 +1,135 @@
+import asyncio
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Optional
+
+# Refreshes run one at a time on a background thread, the request submitting one returns at once
+# with the id of the job. A refresh submitted while another is queued or running gets that job back.
+MAX_FINISHED_JOBS = 20
+# The scheduler submits a refresh every SCHEDULE_INTERVAL, SCHEDULE_OFFSET past the hour. A model run
+# is published hours after it starts and at no set time, so it is looked for throughout its block:
+# refreshes finding a run already loaded skip it at the cost of a few ledger lookups.
+SCHEDULE_ENABLED = os.environ.get("REFRESH_SCHEDULE", "1") == "1"
+SCHEDULE_INTERVAL = timedelta(
+    minutes=float(os.environ.get("REFRESH_SCHEDULE_INTERVAL_MINUTES", 60))
+)
+SCHEDULE_OFFSET = timedelta(
+    minutes=float(os.environ.get("REFRESH_SCHEDULE_OFFSET_MINUTES", 5))
+)
+
+
+class RefreshQueue:
+    """Runs the submitted refreshes on a single worker thread.
+    task gets a progress dict of the job it can update with its current stage."""
+
+    def __init__(self, task: Callable[[dict[str, Any]], Any]):
+        self.task = task
+        self.jobs: OrderedDict[str, dict[str, Any]] = OrderedDict()
+        self._queue: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker: Optional[threading.Thread] = None
+
+    def submit(self, trigger: str) -> dict[str, Any]:
+        """Queues a refresh unless one is queued or running already.
+
+        Returns the status of the job"""
+        with self._lock:
+            for job in self.jobs.values():
+                if job["status"] in ("queued", "running"):
+                    return self._snapshot(job)
+
+            job = {
+                "job_id": uuid.uuid4().hex,
+                "trigger": trigger,
+                "status": "queued",
+                "submitted_at": datetime.now(timezone.utc),
+                "started_at": None,
+                "finished_at": None,
+                "seconds": None,
+                "results": None,
+                "error": None,
+                "progress": {},
+            }
+            self.jobs[job["job_id"]] = job
+            finished = [
+                job_id
+                for job_id, job in self.jobs.items()
+                if job["status"] in ("completed", "failed")
+            ]
+            for job_id in finished[: max(0, len(finished) - MAX_FINISHED_JOBS)]:
+                del self.jobs[job_id]
+
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(
+                    target=self._work, name="refresh", daemon=True
+                )
+                self._worker.start()
+            self._queue.put(job)
+            print("Refresh queued:", job["job_id"], trigger)
+            return self._snapshot(job)
+
+    def _work(self) -> None:
+        while True:
+            job = self._queue.get()
+            with self._lock:
+                job["status"] = "running"
+                job["started_at"] = datetime.now(timezone.utc)
+            start = time.perf_counter()
+            try:
+                results = self.task(job["progress"])
+            except Exception as e:
+                print("Refresh failed:", job["job_id"], e)
+                with self._lock:
+                    job["status"] = "failed"
+                    job["error"] = repr(e)
+            else:
+                with self._lock:
+                    job["status"] = "completed"
+                    job["results"] = results
+            finally:
+                with self._lock:
+                    job["finished_at"] = datetime.now(timezone.utc)
+                    job["seconds"] = round(time.perf_counter() - start, 3)
+
+    def _snapshot(self, job: dict[str, Any]) -> dict[str, Any]:
+        snapshot = {**job, "progress": dict(job["progress"])}
+        if job["status"] == "running":
+            snapshot["seconds"] = round(
+                (datetime.now(timezone.utc) - job["started_at"]).total_seconds(), 3
+            )
+        return snapshot
+
+    def status(self, job_id: Optional[str] = None) -> Optional[dict[str, Any]]:
+        """Status of the job, of the last submitted one without job_id. None when it is unknown."""
+        with self._lock:
+            if job_id is None:
+                job = next(reversed(self.jobs.values()), None)
+            else:
+                job = self.jobs.get(job_id)
+            return self._snapshot(job) if job is not None else None
+
+
+def next_scheduled_refresh(
+    current_date: datetime,
+    interval: timedelta = SCHEDULE_INTERVAL,
+    offset: timedelta = SCHEDULE_OFFSET,
+) -> datetime:
+    """First refresh slot after current_date, slots are every interval from midnight plus offset."""
+    day_start = current_date.replace(hour=0, minute=0, second=0, microsecond=0)
+    slots = (current_date - day_start - offset) // interval + 1
+    return day_start + offset + slots * interval
+
+
+async def schedule(refresh_queue: RefreshQueue) -> None:
+    """Submits a refresh on the model run cadence, see next_scheduled_refresh. Runs until cancelled."""
+    while True:
+        current_date = datetime.now(timezone.utc)
+        due = next_scheduled_refresh(current_date)
+        print("Next scheduled refresh:", due)
+        await asyncio.sleep((due - current_date).total_seconds())
+        refresh_queue.submit("schedule")
@@ -0,0 +1,61 @@
+import numpy as np
+
+# https://en.wikipedia.org/wiki/Enthalpy_of_fusion
+LATENT_HEAT_OF_FUSION = 333.55  # joules per gram needed to change phase of water from solid to liquid with no change in temperature
+
+# https://glossary.ametsoc.org/wiki/Snow_density#:~:text=Freshly%20fallen%20snow%20usually%20has,American%20Meteorological%20Society%20(AMS).
+SNOW_DENSITY = 0.2  # Conservative estimate.
+
+# Rough estimate based on little to no airflow. https://www.engineeringtoolbox.com/convective-heat-transfer-d_430.html
+HEAT_TRANSFER_COEFFICIENT = (
+    25  # joules per second per square meter for each K of temperature difference.
+)
+
+SHOVEL_DEPTH_THRESHOLD = 10  # millimeters
+
+# Variables precomputed at ingest (data_management.derive_shovel_time) and the field each one holds.
+DERIVED_VARIABLES = {
+    "SNOWDEPTHEST": "estimated_snow_depth",
+    "SHOVELTIME": "shovel_time",
+}
+
+
+def clipped_cumulative_sum(increments: np.ndarray) -> np.ndarray:
+    """Running sum over the last axis (hours) which is clipped at zero after every hour.
+    Works on a single series (hours,) or on many points at once (points, hours)."""
+    increments = np.asarray(increments, dtype=np.float64)
+    balance = np.empty_like(increments)
+    running = np.zeros(increments.shape[:-1])
+    for hour in range(increments.shape[-1]):
+        running = np.maximum(running + increments[..., hour], 0)
+        balance[..., hour] = running
+    return balance
+
+
+def shovel_time_fields(
+    snowfall_mm: np.ndarray, temperature_c: np.ndarray
+) -> dict[str, np.ndarray]:
+    """Applies the shoveltime algorithm to hourly snowfall (mm) and temperature (C).
+    Inputs are (hours,) or (points, hours) arrays, every output has the same shape."""
+    # 1 mm of precipitation over 1 sqm = 1 liter which is approx 1kg. Snow has a lower density and we want the result in grams.
+    snow_weight = np.asarray(snowfall_mm) * SNOW_DENSITY * 1000
+    snow_latent_heat_equivalent = snow_weight * LATENT_HEAT_OF_FUSION
+    interval_heat_transfer_potential = (
+        60 * 60 * HEAT_TRANSFER_COEFFICIENT * np.asarray(temperature_c) * -1
+    )
+    # Melting only removes snow (negative potential), it never adds any.
+    snow_latent_heat_balance = clipped_cumulative_sum(
+        snow_latent_heat_equivalent + np.minimum(interval_heat_transfer_potential, 0)
+    )
+    estimated_snow_depth = (
+        snow_latent_heat_balance / LATENT_HEAT_OF_FUSION / SNOW_DENSITY / 1000
+    )
+
+    return {
+        "snow_weight": snow_weight,
+        "snow_latent_heat_equivalent": snow_latent_heat_equivalent,
+        "interval_heat_transfer_potential": interval_heat_transfer_potential,
+        "snow_latent_heat_balance": snow_latent_heat_balance,
+        "estimated_snow_depth": estimated_snow_depth,
+        "shovel_time": estimated_snow_depth >= SHOVEL_DEPTH_THRESHOLD,
+    }
@@ -0,0 +1,129 @@
+import threading
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Iterator
+
+import data_management
+import pytest
+
+FORECAST_HOUR = 48
+
+
+class DatamartServer(ThreadingHTTPServer):
+    # every candidate run is probed at once
+    request_queue_size = 64
+
+
+class Datamart:
+    """Local stand in for the datamart answering the HEAD requests of find_latest_forecast.
+    Only the forecast hour directories of the published runs exist."""
+
+    def __init__(self):
+        self.published: set[str] = set()
+        self.requests: list[str] = []
+        datamart = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_HEAD(self) -> None:
+                datamart.requests.append(self.path)
+                self.send_response(200 if self.path in datamart.published else 404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+        self.server = DatamartServer(("127.0.0.1", 0), Handler)
+        self.domain = f"http://127.0.0.1:{self.server.server_port}/"
+
+    def publish(self, run: datetime) -> dict[str, str]:
+        """Publishes the run, returns the result expected from find_latest_forecast."""
+        date, forecast = run.strftime("%Y%m%d"), run.strftime("%H")
+        path = data_management.HRDPS_URL_PATH
+        self.published.add(f"/{date}/{path}/{forecast}/{FORECAST_HOUR:03}/")
+        return {
+            "baseurl": f"{self.domain.strip('/')}/{date}/{path}/{forecast}/",
+            "date": date,
+            "forecast": forecast,
+        }
+
+
+@pytest.fixture
+def datamart(monkeypatch) -> Iterator[Datamart]:
+    monkeypatch.setattr(data_management, "_latest_forecasts", {})
+    datamart = Datamart()
+    thread = threading.Thread(target=datamart.server.serve_forever, daemon=True)
+    thread.start()
+    yield datamart
+    # probes left in flight by find_latest_forecast
+    for thread in threading.enumerate():
+        if thread.name == "probe-session":
+            thread.join()
+    datamart.server.shutdown()
+    datamart.server.server_close()
+
+
+def current_block() -> datetime:
+    now = datetime.now(timezone.utc)
+    return data_management.next_model_run(now) - timedelta(
+        hours=data_management.MODEL_RUN_HOURS
+    )
+
+
+def test_newest_published_run(datamart):
+    yesterday = current_block() - timedelta(days=1)
+    expected = datamart.publish(yesterday)
+    datamart.publish(yesterday - timedelta(hours=6))
+    datamart.publish(yesterday - timedelta(days=2))
+
+    latest = data_management.find_latest_forecast(FORECAST_HOUR, domain=datamart.domain)
+    assert latest == expected
+
+
+def test_runs_not_due_are_not_probed(datamart):
+    data_management.find_latest_forecast(FORECAST_HOUR, domain=datamart.domain)
+    today = datetime.now(timezone.utc)
+    for path in datamart.requests:
+        date, forecast = path.split("/")[1], path.split("/")[-3]
+        run = datetime.strptime(f"{date}{forecast} +0000", "%Y%m%d%H %z")
+        assert run <= today
+    # 5 days of 4 runs, less the runs later today
+    assert 17 <= len(datamart.requests) <= 20
+
+
+def test_nothing_published(datamart):
+    latest = data_management.find_latest_forecast(FORECAST_HOUR, domain=datamart.domain)
+    assert latest == {"baseurl": "", "date": "", "forecast": ""}
+
+    # not kept, the next call probes again
+    probes = len(datamart.requests)
+    data_management.find_latest_forecast(FORECAST_HOUR, domain=datamart.domain)
+    assert len(datamart.requests) > probes
+
+
+def test_current_run_is_kept_until_the_next_run(datamart):
+    expected = datamart.publish(current_block())
+    assert (
+        data_management.find_latest_forecast(FORECAST_HOUR, domain=datamart.domain)
+        == expected
+    )
+
+    probes = len(datamart.requests)
+    assert (
+        data_management.find_latest_forecast(FORECAST_HOUR, domain=datamart.domain)
+        == expected
+    )
+    assert len(datamart.requests) == probes
+
+
+def test_older_run_is_probed_again(datamart, monkeypatch):
+    monkeypatch.setattr(data_management, "LATEST_FORECAST_RETRY_SECONDS", 0)
+    datamart.publish(current_block() - timedelta(hours=6))
+    data_management.find_latest_forecast(FORECAST_HOUR, domain=datamart.domain)
+
+    # the run of the current block may be published any time
+    expected = datamart.publish(current_block())
+    assert (
+        data_management.find_latest_forecast(FORECAST_HOUR, domain=datamart.domain)
+        == expected
+    )
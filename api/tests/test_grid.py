@@ -0,0 +1,97 @@
+import grid
+import numpy as np
+import pandas as pd
+import pytest
+
+# ST_Transform(ST_SetSRID(ST_MakePoint(longitude, latitude), 4326), 990001) as computed by PROJ
+# (latitude, longitude, x, y)
+TRANSFORMED = {
+    "Toronto": (43.6532, -79.3832, 24.787991548431354, -4.0435239891259025),
+    "Vancouver": (49.2827, -123.1207, -5.500534599701578, -4.301780647915087),
+    "Miami": (25.7617, -80.1918, 32.90565300434513, -20.105935110153897),
+    "Iqaluit": (63.7467, -68.5170, 19.421807359235224, 16.305666342612078),
+    "Honolulu": (21.3069, -157.8583, -42.5658066335538, -19.579531306083826),
+}
+
+# HRDPS continental grid: 2540 x 1290 cells of 0.0225 degrees, first cell centered on
+# rotated longitude -14.82122 and the last row on rotated latitude 16.700001
+SCALE = 0.0225
+UPPERLEFTX = -14.82122 - SCALE / 2
+UPPERLEFTY = 16.700001 + SCALE / 2
+WIDTH = 2540
+HEIGHT = 1290
+TILE_SIZE = 128
+
+
+def hrdps_layout(filename: str) -> pd.DataFrame:
+    """Tile layout (grid.tile_layout_query) of a run cut into TILE_SIZE tiles like raster2pgsql does."""
+    tiles = [
+        {
+            "rid": row // TILE_SIZE * 100 + column // TILE_SIZE,
+            "filename": filename,
+            "upperleftx": UPPERLEFTX + column * SCALE,
+            "upperlefty": UPPERLEFTY - row * SCALE,
+            "width": min(TILE_SIZE, WIDTH - column),
+            "height": min(TILE_SIZE, HEIGHT - row),
+            "scalex": SCALE,
+            "scaley": -SCALE,
+        }
+        for row in range(0, HEIGHT, TILE_SIZE)
+        for column in range(0, WIDTH, TILE_SIZE)
+    ]
+    return pd.DataFrame(tiles)
+
+
+@pytest.fixture(scope="module")
+def index() -> grid.GridIndex:
+    runs = (("CMC_hrdps_continental_TMP", "TMP.vrt", None, 48),)
+    return grid.GridIndex(hrdps_layout("TMP.vrt"), runs)
+
+
+@pytest.mark.parametrize("city", TRANSFORMED)
+def test_rotate_matches_st_transform(city):
+    latitude, longitude, x, y = TRANSFORMED[city]
+    assert grid.rotate(latitude, longitude) == pytest.approx((x, y), abs=1e-9)
+
+
+def test_rotate_arrays():
+    latitudes, longitudes, xs, ys = map(np.array, zip(*TRANSFORMED.values()))
+    x, y = grid.rotate(latitudes, longitudes)
+    np.testing.assert_allclose(x, xs, atol=1e-9)
+    np.testing.assert_allclose(y, ys, atol=1e-9)
+
+
+def test_grid_extent(index):
+    assert (index.width, index.height) == (WIDTH, HEIGHT)
+    assert (index.tile_width, index.tile_height) == (TILE_SIZE, TILE_SIZE)
+
+
+def test_locate_inside(index):
+    assert index.locate(*TRANSFORMED["Toronto"][:2]) == (1760, 922)
+    assert index.locate(*TRANSFORMED["Vancouver"][:2]) == (414, 933)
+
+
+@pytest.mark.parametrize("city", ["Miami", "Honolulu"])
+def test_locate_outside(index, city):
+    assert index.locate(*TRANSFORMED[city][:2]) is None
+
+
+def test_locate_many_matches_locate(index):
+    latitudes, longitudes, _, _ = map(np.array, zip(*TRANSFORMED.values()))
+    columns, rows = index.locate_many(latitudes, longitudes)
+    for latitude, longitude, column, row in zip(latitudes, longitudes, columns, rows):
+        assert index.locate(latitude, longitude) == (
+            None if column == -1 else (column, row)
+        )
+
+
+def test_tile_pixels(index):
+    # Toronto, tile 13 of row 7, 1-based pixel
+    assert index.tile_pixels(1760, 922) == [(713, 97, 27)]
+
+
+def test_empty_layout():
+    empty = grid.GridIndex(hrdps_layout("TMP.vrt").iloc[0:0], ())
+    assert empty.locate(*TRANSFORMED["Toronto"][:2]) is None
+    columns, rows = empty.locate_many(np.array([43.6532]), np.array([-79.3832]))
+    assert columns.tolist() == rows.tolist() == [-1]
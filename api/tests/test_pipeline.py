@@ -0,0 +1,81 @@
+import threading
+import time
+
+import pipeline
+
+
+def test_items_go_through_every_stage():
+    result = pipeline.run_pipeline(
+        range(10),
+        [
+            ("double", lambda item: item * 2, 2),
+            ("increment", lambda item: item + 1, 3),
+        ],
+    )
+    assert sorted(result["outputs"]) == [item * 2 + 1 for item in range(10)]
+    assert result["errors"] == []
+    assert result["timings"]["double"]["count"] == 10
+    assert result["timings"]["increment"]["count"] == 10
+
+
+def test_failed_items_stop_others_carry_on():
+    def check(item: int) -> int:
+        if item % 3 == 0:
+            raise ValueError(item)
+        return item
+
+    result = pipeline.run_pipeline(
+        range(7), [("check", check, 2), ("identity", lambda item: item, 1)]
+    )
+    assert sorted(result["outputs"]) == [1, 2, 4, 5]
+    assert sorted(item for stage, item, _ in result["errors"]) == [0, 3, 6]
+    assert {stage for stage, _, _ in result["errors"]} == {"check"}
+    assert all(isinstance(e, ValueError) for _, _, e in result["errors"])
+    # failed items are timed but not passed on
+    assert result["timings"]["check"]["count"] == 7
+    assert result["timings"]["identity"]["count"] == 4
+
+
+def test_max_concurrency_caps_running_stages():
+    lock = threading.Lock()
+    running = 0
+    peak = 0
+
+    def work(item: int) -> int:
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        time.sleep(0.01)
+        with lock:
+            running -= 1
+        return item
+
+    result = pipeline.run_pipeline(
+        range(20),
+        [("first", work, 4), ("second", work, 4)],
+        queue_size=4,
+        max_concurrency=2,
+    )
+    assert sorted(result["outputs"]) == list(range(20))
+    assert peak <= 2
+
+
+def test_stages_overlap():
+    """The first item reaches the second stage while the first stage works on the others."""
+    started = threading.Event()
+
+    def first(item: int) -> int:
+        if item > 0:
+            assert started.wait(5)
+        return item
+
+    def second(item: int) -> int:
+        started.set()
+        return item
+
+    result = pipeline.run_pipeline(
+        range(3), [("first", first, 1), ("second", second, 1)]
+    )
+    assert result["errors"] == []
+    assert sorted(result["outputs"]) == [0, 1, 2]
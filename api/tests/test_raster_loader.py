@@ -0,0 +1,111 @@
+import struct
+
+import numpy as np
+import pytest
+import raster_loader
+
+GEOTRANSFORM = [-14.83247, 0.0225, 0.0, 16.711251, 0.0, -0.0225]
+
+
+def test_wkb_round_trip():
+    bands = np.arange(2 * 3 * 4, dtype=np.float32).reshape(2, 3, 4)
+    bands[1, 2, 3] = 9999
+    wkb = raster_loader.raster_wkb(bands, GEOTRANSFORM, 990001, [None, 9999])
+
+    upperleftx, upperlefty, decoded = raster_loader.raster_bands(wkb)
+    assert (upperleftx, upperlefty) == (GEOTRANSFORM[0], GEOTRANSFORM[3])
+    assert decoded.dtype == np.float32
+    assert np.isnan(decoded[1, 2, 3])
+    decoded[1, 2, 3] = 9999
+    assert np.array_equal(decoded, bands)
+
+
+def test_wkb_header():
+    bands = np.zeros((3, 5, 7), dtype=np.float32)
+    wkb = raster_loader.raster_wkb(bands, GEOTRANSFORM, 990001, [0.0] * 3)
+    assert raster_loader.WKB_HEADER.unpack_from(wkb) == (
+        raster_loader.WKB_LITTLE_ENDIAN,
+        raster_loader.WKB_VERSION,
+        3,
+        0.0225,
+        -0.0225,
+        -14.83247,
+        16.711251,
+        0.0,
+        0.0,
+        990001,
+        7,
+        5,
+    )
+    band_size = raster_loader.WKB_BAND_HEADER.size + 4 * 5 * 7
+    assert len(wkb) == raster_loader.WKB_HEADER.size + 3 * band_size
+
+
+def test_decode_64bf():
+    """Tiles loaded by raster2pgsql from GRIB files are 64BF."""
+    values = np.array([[[1.5, -3.0], [-9999.0, 2.25]]])
+    wkb = raster_loader.WKB_HEADER.pack(
+        raster_loader.WKB_LITTLE_ENDIAN,
+        0,
+        1,
+        1.0,
+        -1.0,
+        10.0,
+        20.0,
+        0.0,
+        0.0,
+        990001,
+        2,
+        2,
+    )
+    wkb += struct.pack(
+        "<Bd", raster_loader.PIXEL_TYPE_64BF | raster_loader.BAND_HAS_NODATA, -9999.0
+    )
+    wkb += values.astype("<f8").tobytes()
+
+    upperleftx, upperlefty, decoded = raster_loader.raster_bands(wkb)
+    assert (upperleftx, upperlefty) == (10.0, 20.0)
+    np.testing.assert_array_equal(decoded, [[[1.5, -3.0], [np.nan, 2.25]]])
+
+
+def test_decode_rejects_integer_bands():
+    wkb = raster_loader.WKB_HEADER.pack(
+        raster_loader.WKB_LITTLE_ENDIAN, 0, 1, 1.0, -1.0, 0.0, 0.0, 0.0, 0.0, 0, 1, 1
+    )
+    # 32BSI
+    wkb += struct.pack("<Bi", 7, 0) + struct.pack("<i", 1)
+    with pytest.raises(AssertionError):
+        raster_loader.raster_bands(wkb)
+
+
+def test_tile_windows_cut_edges():
+    assert list(raster_loader.tile_windows(5, 3, 2)) == [
+        (0, 0, 2, 2),
+        (0, 2, 2, 2),
+        (0, 4, 2, 1),
+        (2, 0, 1, 2),
+        (2, 2, 1, 2),
+        (2, 4, 1, 1),
+    ]
+
+
+def test_encode_tiles_georeference():
+    cube = np.arange(2 * 5 * 7, dtype=np.float32).reshape(2, 5, 7)
+    metadata = {
+        "width": 7,
+        "height": 5,
+        "geotransform": GEOTRANSFORM,
+        "nodata": [None, None],
+    }
+    tiles = list(
+        raster_loader.encode_tiles(cube, metadata, 990001, tile_size=4, workers=2)
+    )
+    windows = list(raster_loader.tile_windows(7, 5, 4))
+    assert len(tiles) == len(windows)
+    for wkb, (row, column, height, width) in zip(tiles, windows):
+        upperleftx, upperlefty, bands = raster_loader.raster_bands(wkb)
+        assert upperleftx == pytest.approx(GEOTRANSFORM[0] + column * GEOTRANSFORM[1])
+        assert upperlefty == pytest.approx(GEOTRANSFORM[3] + row * GEOTRANSFORM[5])
+        assert np.array_equal(
+            bands, cube[:, row : row + height, column : column + width]
+        )
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+import shovel_time
+from benchmarks import energy_balance_loop
+
+
+@pytest.fixture
+def forecasts() -> tuple[np.ndarray, np.ndarray]:
+    """Hourly snowfall and temperature of 200 points over 48 hours."""
+    rng = np.random.default_rng(0)
+    points, hours = 200, 48
+    snowfall = np.where(
+        rng.random((points, hours)) < 0.6, 0, rng.gamma(1, 3, (points, hours))
+    )
+    temperature = rng.normal(-3, 5, (points, hours))
+    return snowfall, temperature
+
+
+@pytest.fixture
+def fields(forecasts) -> dict[str, np.ndarray]:
+    return shovel_time.shovel_time_fields(*forecasts)
+
+
+def test_energy_balance_matches_loop(fields):
+    looped = [
+        energy_balance_loop(latent, potential)
+        for latent, potential in zip(
+            fields["snow_latent_heat_equivalent"].tolist(),
+            fields["interval_heat_transfer_potential"].tolist(),
+        )
+    ]
+    assert np.array_equal(np.array(looped), fields["snow_latent_heat_balance"])
+
+
+def test_single_series_matches_points(forecasts, fields):
+    snowfall, temperature = forecasts
+    series = shovel_time.shovel_time_fields(snowfall[3], temperature[3])
+    for name, values in series.items():
+        assert np.array_equal(values, fields[name][3]), name
+
+
+def test_clipped_cumulative_sum():
+    balance = shovel_time.clipped_cumulative_sum(np.array([1.0, -3.0, 2.0, -1.0, 4.0]))
+    assert balance.tolist() == [1.0, 0.0, 2.0, 1.0, 5.0]
+
+
+def test_shovel_time_threshold():
+    # 12 mm of snow below freezing, none of it melts
+    fields = shovel_time.shovel_time_fields(
+        np.array([6.0, 6.0, 0.0]), np.array([-5.0, -5.0, -5.0])
+    )
+    np.testing.assert_allclose(fields["estimated_snow_depth"], [6.0, 12.0, 12.0])
+    assert fields["shovel_time"].tolist() == [False, True, True]
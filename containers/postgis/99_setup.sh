@@ -2,19 +2,46 @@
 
 set -e
 
+# Only runs on a new postgis-db-volume, containers/postgis/migrate.sql applies schema changes to an existing one.
 echo "Apply custom setup to $POSTGRES_DB"
 psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "$POSTGRES_DB" <<-EOSQL
     CREATE EXTENSION IF NOT EXISTS postgis_raster;
     INSERT INTO spatial_ref_sys (srid, proj4text) values (990000, '+proj=stere +lat_0=90 +lat_ts=60 +lon_0=252 +x_0=0 +y_0=0 +R=6371229 +units=m +no_defs');
     INSERT INTO spatial_ref_sys (srid, proj4text) values (990001, '+proj=ob_tran +o_proj=longlat +o_lon_p=0 +o_lat_p=36.08852 +lon_0=-114.694858 +R=6371229 +no_defs');
 
+    -- Tiles partitioned by run. Each load of a run stages its tiles in a table of its own (data_management.load_run)
+    -- which is attached as the run's partition once indexed, in place of the partition of an earlier load,
+    -- and detached and dropped when the run is deleted.
     CREATE TABLE public.predictions (
-        rid serial PRIMARY KEY,
+        rid serial,
 	    raster raster NOT NULL,
-	    filename text NOT NULL
-    );
+	    filename text NOT NULL,
+        PRIMARY KEY (rid, filename)
+    ) PARTITION BY LIST (filename);
     CREATE INDEX ON "public"."predictions" USING gist (st_convexhull("raster"));
 
+    -- Forecast hours loaded by the subscriber (subscriber.py) before their band is appended to the run in predictions.
+    CREATE TABLE public.predictions_increment (
+        rid serial PRIMARY KEY,
+        raster raster NOT NULL,
+        filename text NOT NULL
+    );
+
+    -- One row per loaded run, written by data_management.load_run in the transaction attaching the run,
+    -- so lookups of what is loaded never touch the tiles.
+    CREATE TABLE public.ingest_ledger (
+        filename text NOT NULL,
+        forecast_string text NOT NULL,
+        variable text NOT NULL,
+        status text NOT NULL,
+        band_count integer NOT NULL,
+        tile_count integer NOT NULL,
+        checksum text NULL,
+        loaded_at timestamptz NOT NULL DEFAULT now(),
+        CONSTRAINT ingest_ledger_pk PRIMARY KEY (filename),
+        CONSTRAINT ingest_ledger_status_check CHECK (status IN ('loaded', 'published'))
+    );
+
     CREATE TABLE public.variable_definitions (
         model text NOT NULL,
         variable text NOT NULL,
@@ -41,6 +68,58 @@ psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "$POSTGRES_DB" <<-E
         CONSTRAINT variables_pk PRIMARY KEY (filename)
     );
 
+    -- Catalog of the run currently served for each variable.
+    -- Rows are only written once a run is fully loaded (publish_current_runs) so readers never see a half-loaded run.
+    CREATE TABLE public.current_runs (
+        forecast_base_string text NOT NULL,
+        filename text NOT NULL,
+        forecast_string text NOT NULL,
+        forecast_start_timestamp timestamptz NOT NULL,
+        band_count integer NOT NULL,
+        unit text NULL,
+        published_at timestamptz NOT NULL DEFAULT now(),
+        CONSTRAINT current_runs_pk PRIMARY KEY (forecast_base_string),
+        CONSTRAINT current_runs_filename_key UNIQUE (filename)
+    );
+
+    -- Refresh of a model run (data_management.full_refresh) and the stages completed by each of its
+    -- variable runs, so an interrupted refresh resumes where it stopped (refresh_jobs.py).
+    CREATE TABLE public.refresh_jobs (
+        job_id text NOT NULL,
+        status text NOT NULL,
+        error text NULL,
+        attempts integer NOT NULL DEFAULT 1,
+        created_at timestamptz NOT NULL DEFAULT now(),
+        updated_at timestamptz NOT NULL DEFAULT now(),
+        CONSTRAINT refresh_jobs_pk PRIMARY KEY (job_id),
+        CONSTRAINT refresh_jobs_status_check CHECK (status IN ('running', 'completed', 'failed'))
+    );
+
+    CREATE TABLE public.refresh_checkpoints (
+        job_id text NOT NULL,
+        forecast_string text NOT NULL,
+        stage text NOT NULL,
+        output jsonb NULL,
+        completed_at timestamptz NOT NULL DEFAULT now(),
+        CONSTRAINT refresh_checkpoints_pk PRIMARY KEY (job_id, forecast_string, stage),
+        CONSTRAINT refresh_checkpoints_fk FOREIGN KEY (job_id) REFERENCES public.refresh_jobs(job_id) ON DELETE CASCADE,
+        CONSTRAINT refresh_checkpoints_stage_check CHECK (stage IN ('discovered', 'downloaded', 'vrt_built', 'loaded', 'published'))
+    );
+
+    -- All band values of a pixel in a single pass over the tile.
+    -- The tile is clipped down to the pixel so it is decoded once, rather than once per band by separate ST_Value calls.
+    CREATE FUNCTION public.st_pixelvalues(rast raster, x integer, y integer)
+    RETURNS double precision[] AS \$\$
+        SELECT array_agg((pixel.dv).valarray[1][1] ORDER BY (pixel.dv).nband)
+        FROM (
+            SELECT ST_DumpValues(
+                ST_Clip(rast, ST_Buffer(ST_PixelAsCentroid(rast, x, y), abs(ST_ScaleX(rast)) / 4), true)
+            ) AS dv
+        ) pixel;
+    \$\$ LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE;
+
     ALTER TABLE public.predictions ADD CONSTRAINT predictions_fk FOREIGN KEY (filename) REFERENCES public.variables(filename) ON DELETE CASCADE ON UPDATE CASCADE;
+    ALTER TABLE public.ingest_ledger ADD CONSTRAINT ingest_ledger_fk FOREIGN KEY (filename) REFERENCES public.variables(filename) ON DELETE CASCADE ON UPDATE CASCADE;
+    ALTER TABLE public.current_runs ADD CONSTRAINT current_runs_fk FOREIGN KEY (filename) REFERENCES public.variables(filename) ON DELETE CASCADE ON UPDATE CASCADE;
     ALTER TABLE public.variables ADD CONSTRAINT variables_fk FOREIGN KEY (model,variable) REFERENCES public.variable_definitions(model,variable);
 EOSQL
\ No newline at end of file
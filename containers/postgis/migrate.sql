@@ -0,0 +1,161 @@
+-- Brings a database created by an earlier 99_setup.sh up to the current schema, keeping the loaded runs.
+-- 99_setup.sh only runs when the postgis-db-volume is first initialized, this script is for existing volumes:
+--     make migrate-db
+-- or  docker exec -i postgis psql -v ON_ERROR_STOP=1 -U postgres -d postgres < containers/postgis/migrate.sql
+-- It can be run again, every step is skipped once applied. The tiles of each run are copied into a partition
+-- of their own, the database needs free disk for a second copy of predictions while it runs.
+-- Stop the backend and the subscriber first, predictions is locked for the whole migration.
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS public.predictions_increment (
+    rid serial PRIMARY KEY,
+    raster raster NOT NULL,
+    filename text NOT NULL
+);
+
+-- Unpartitioned predictions (rid PRIMARY KEY) to one partition per run (see data_management.load_run)
+DO $$
+DECLARE
+    run record;
+    partition text;
+BEGIN
+    IF (SELECT relkind FROM pg_class WHERE oid = 'public.predictions'::regclass) = 'p' THEN
+        RAISE NOTICE 'predictions is partitioned already';
+        RETURN;
+    END IF;
+
+    ALTER TABLE public.predictions RENAME TO predictions_unpartitioned;
+    ALTER INDEX IF EXISTS public.predictions_pkey RENAME TO predictions_unpartitioned_pkey;
+    ALTER INDEX IF EXISTS public.predictions_st_convexhull_idx RENAME TO predictions_unpartitioned_st_convexhull_idx;
+
+    CREATE TABLE public.predictions (
+        rid integer NOT NULL DEFAULT nextval('public.predictions_rid_seq'),
+        raster raster NOT NULL,
+        filename text NOT NULL,
+        PRIMARY KEY (rid, filename)
+    ) PARTITION BY LIST (filename);
+    -- the sequence would be dropped with the old table
+    ALTER SEQUENCE public.predictions_rid_seq OWNED BY public.predictions.rid;
+    CREATE INDEX ON public.predictions USING gist (st_convexhull(raster));
+
+    -- tiles of files without a variables record were unreachable, they are left out
+    FOR run IN
+        SELECT DISTINCT p.filename
+        FROM public.predictions_unpartitioned p
+            INNER JOIN public.variables v ON v.filename = p.filename
+    LOOP
+        -- data_management.run_table_name
+        partition := 'predictions_' || left(md5(run.filename), 16);
+        EXECUTE format('CREATE TABLE public.%I (LIKE public.predictions INCLUDING DEFAULTS)', partition);
+        EXECUTE format(
+            'INSERT INTO public.%I (rid, raster, filename)
+            SELECT rid, raster, filename FROM public.predictions_unpartitioned WHERE filename = %L',
+            partition, run.filename);
+        EXECUTE format('ALTER TABLE public.%I ADD PRIMARY KEY (rid, filename)', partition);
+        EXECUTE format('CREATE INDEX ON public.%I USING gist (st_convexhull(raster))', partition);
+        EXECUTE format('ALTER TABLE public.%I ADD CONSTRAINT %I CHECK (filename = %L)',
+            partition, partition || '_bound', run.filename);
+        EXECUTE format('ALTER TABLE public.predictions ATTACH PARTITION public.%I FOR VALUES IN (%L)',
+            partition, run.filename);
+        EXECUTE format('ALTER TABLE public.%I DROP CONSTRAINT %I', partition, partition || '_bound');
+        RAISE NOTICE 'Attached % as %', run.filename, partition;
+    END LOOP;
+
+    DROP TABLE public.predictions_unpartitioned;
+    ALTER TABLE public.predictions ADD CONSTRAINT predictions_fk FOREIGN KEY (filename) REFERENCES public.variables(filename) ON DELETE CASCADE ON UPDATE CASCADE;
+END
+$$;
+
+CREATE TABLE IF NOT EXISTS public.ingest_ledger (
+    filename text NOT NULL,
+    forecast_string text NOT NULL,
+    variable text NOT NULL,
+    status text NOT NULL,
+    band_count integer NOT NULL,
+    tile_count integer NOT NULL,
+    checksum text NULL,
+    loaded_at timestamptz NOT NULL DEFAULT now(),
+    CONSTRAINT ingest_ledger_pk PRIMARY KEY (filename),
+    CONSTRAINT ingest_ledger_status_check CHECK (status IN ('loaded', 'published')),
+    CONSTRAINT ingest_ledger_fk FOREIGN KEY (filename) REFERENCES public.variables(filename) ON DELETE CASCADE ON UPDATE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS public.current_runs (
+    forecast_base_string text NOT NULL,
+    filename text NOT NULL,
+    forecast_string text NOT NULL,
+    forecast_start_timestamp timestamptz NOT NULL,
+    band_count integer NOT NULL,
+    unit text NULL,
+    published_at timestamptz NOT NULL DEFAULT now(),
+    CONSTRAINT current_runs_pk PRIMARY KEY (forecast_base_string),
+    CONSTRAINT current_runs_filename_key UNIQUE (filename),
+    CONSTRAINT current_runs_fk FOREIGN KEY (filename) REFERENCES public.variables(filename) ON DELETE CASCADE ON UPDATE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS public.refresh_jobs (
+    job_id text NOT NULL,
+    status text NOT NULL,
+    error text NULL,
+    attempts integer NOT NULL DEFAULT 1,
+    created_at timestamptz NOT NULL DEFAULT now(),
+    updated_at timestamptz NOT NULL DEFAULT now(),
+    CONSTRAINT refresh_jobs_pk PRIMARY KEY (job_id),
+    CONSTRAINT refresh_jobs_status_check CHECK (status IN ('running', 'completed', 'failed'))
+);
+
+CREATE TABLE IF NOT EXISTS public.refresh_checkpoints (
+    job_id text NOT NULL,
+    forecast_string text NOT NULL,
+    stage text NOT NULL,
+    output jsonb NULL,
+    completed_at timestamptz NOT NULL DEFAULT now(),
+    CONSTRAINT refresh_checkpoints_pk PRIMARY KEY (job_id, forecast_string, stage),
+    CONSTRAINT refresh_checkpoints_fk FOREIGN KEY (job_id) REFERENCES public.refresh_jobs(job_id) ON DELETE CASCADE,
+    CONSTRAINT refresh_checkpoints_stage_check CHECK (stage IN ('discovered', 'downloaded', 'vrt_built', 'loaded', 'published'))
+);
+
+CREATE OR REPLACE FUNCTION public.st_pixelvalues(rast raster, x integer, y integer)
+RETURNS double precision[] AS $$
+    SELECT array_agg((pixel.dv).valarray[1][1] ORDER BY (pixel.dv).nband)
+    FROM (
+        SELECT ST_DumpValues(
+            ST_Clip(rast, ST_Buffer(ST_PixelAsCentroid(rast, x, y), abs(ST_ScaleX(rast)) / 4), true)
+        ) AS dv
+    ) pixel;
+$$ LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE;
+
+-- Ledger entries of the runs loaded before the ledger existed, without a checksum
+INSERT INTO public.ingest_ledger (filename, forecast_string, variable, status, band_count, tile_count)
+SELECT v.filename, v.forecast_string, v.variable, 'published', min(ST_NumBands(p.raster)), count(*)
+FROM public.variables v
+    INNER JOIN public.predictions p ON p.filename = v.filename
+GROUP BY v.filename, v.forecast_string, v.variable
+ON CONFLICT (filename) DO NOTHING;
+
+-- The latest run of each variable is served until the next refresh publishes a newer one
+INSERT INTO public.current_runs (
+    forecast_base_string,
+    filename,
+    forecast_string,
+    forecast_start_timestamp,
+    band_count,
+    unit
+)
+SELECT DISTINCT ON (v.forecast_base_string)
+    v.forecast_base_string,
+    v.filename,
+    v.forecast_string,
+    v.forecast_start_timestamp,
+    l.band_count,
+    d.unit
+FROM public.variables v
+    INNER JOIN public.ingest_ledger l ON l.filename = v.filename
+    LEFT JOIN public.variable_definitions d ON
+        d.model = v.model
+        AND d.variable = v.variable
+ORDER BY v.forecast_base_string, v.forecast_start_timestamp DESC
+ON CONFLICT (forecast_base_string) DO NOTHING;
+
+COMMIT;